@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: admission control for the inference endpoints
+
+Inference requests are admitted for the number of images they carry before
+any work starts. Admitted images count against a global limit until their
+request or job is done; a request which would go over it is turned away at
+once with 503 and a Retry-After estimate, rather than queueing behind
+minutes of work. Bulk requests (more than one image, and background jobs)
+may only use part of the limit and get 429 beyond it, so there is always
+room for interactive single-image requests, which the batch scheduler also
+runs first. Requests with more images than --max_images_per_request get
+413.
+
+A request's deadline comes from its X-Request-Timeout header, in seconds,
+or --request_timeout. It is passed down to the pipeline and the batch
+scheduler, which drop the images of callers who have given up.
+"""
+
+import math
+import time
+import threading
+from collections import deque
+try:
+    from recognition_server import metrics
+    from recognition_server.batching import PRIORITY_INTERACTIVE, PRIORITY_BULK
+except:
+    import metrics
+    from batching import PRIORITY_INTERACTIVE, PRIORITY_BULK
+
+
+# seconds of completed work used to estimate throughput, for Retry-After
+RATE_WINDOW = 30.0
+# header in which a caller gives its timeout, in seconds
+TIMEOUT_HEADER = 'X-Request-Timeout'
+
+
+class Rejected(Exception):
+    """
+    raised when a request is not admitted. status is the HTTP status, and
+    retry_after the seconds after which it may be worth trying again, or None
+    """
+
+    def __init__(self, message, status, retry_after = None):
+        Exception.__init__(self, message)
+        self.error_dict = {'error': message}
+        self.status = status
+        self.retry_after = retry_after
+
+    def headers(self):
+        if self.retry_after is None:
+            return {}
+        return {'Retry-After': str(self.retry_after)}
+
+
+def priority_for(count):
+    """single images are interactive, anything bigger is bulk"""
+    return PRIORITY_INTERACTIVE if count <= 1 else PRIORITY_BULK
+
+
+def deadline_for(headers, default_timeout = 0):
+    """
+    returns the time.monotonic() deadline of a request from its headers, or
+    from default_timeout seconds if the header is missing. None for no deadline
+    """
+    try:
+        timeout = float(headers.get(TIMEOUT_HEADER) or default_timeout or 0)
+    except ValueError:
+        timeout = default_timeout
+    if not timeout or timeout <= 0:
+        return None
+    return time.monotonic() + timeout
+
+
+def expired(deadline):
+    """whether a deadline has passed"""
+    return deadline is not None and time.monotonic() > deadline
+
+
+class Ticket(object):
+    """
+    the images admitted for one request or job. Releasing it gives their
+    room back, and can be done once, or by leaving a with block
+    """
+
+    def __init__(self, controller, count, priority):
+        self.controller = controller
+        self.count = count
+        self.priority = priority
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class AdmissionController(object):
+    """
+    admits requests while fewer than max_queued images are in progress. Bulk
+    requests may only use bulk_share of that. A request is always admitted
+    when nothing else is in progress, so one at the per-request limit can run
+    """
+
+    def __init__(self, max_queued = 512, bulk_share = 0.75,
+                 max_images_per_request = 1000):
+        self.max_queued = max(1, int(max_queued))
+        self.bulk_limit = max(1, int(self.max_queued * bulk_share))
+        self.max_images_per_request = max(1, int(max_images_per_request))
+        self._lock = threading.Lock()
+        # priority -> images in progress
+        self._in_progress = {PRIORITY_INTERACTIVE: 0, PRIORITY_BULK: 0}
+        # (finish time, images) of recently released tickets
+        self._finished = deque()
+        self.counters = dict.fromkeys(['admitted', 'too_large', 'bulk_limit',
+                                       'queue_full'], 0)
+
+    def admit(self, count, priority = None):
+        """
+        admits a request for count images, returning a Ticket, or raises
+        Rejected with status 413, 429 or 503
+        """
+        if priority is None:
+            priority = priority_for(count)
+        if count > self.max_images_per_request:
+            self._reject('too_large')
+            raise Rejected('too many images, at most %d per request'
+                           % self.max_images_per_request, 413)
+        with self._lock:
+            total = sum(self._in_progress.values())
+            bulk = self._in_progress[PRIORITY_BULK]
+            if total and priority == PRIORITY_BULK and bulk + count > self.bulk_limit:
+                reason = 'bulk_limit'
+            elif total and total + count > self.max_queued:
+                reason = 'queue_full'
+            else:
+                self._in_progress[priority] += count
+                self.counters['admitted'] += 1
+                return Ticket(self, count, priority)
+            retry_after = self._retry_after(total + count - self.max_queued
+                                            if reason == 'queue_full' else
+                                            bulk + count - self.bulk_limit)
+        self._reject(reason)
+        if reason == 'bulk_limit':
+            raise Rejected('too many bulk requests, try again later', 429, retry_after)
+        raise Rejected('server is overloaded, try again later', 503, retry_after)
+
+    def _reject(self, reason):
+        metrics.SHED.inc(reason = reason)
+        with self._lock:
+            self.counters[reason] += 1
+
+    def _release(self, ticket):
+        now = time.monotonic()
+        with self._lock:
+            self._in_progress[ticket.priority] -= ticket.count
+            self._finished.append((now, ticket.count))
+            self._trim(now)
+
+    def _trim(self, now):
+        while self._finished and self._finished[0][0] < now - RATE_WINDOW:
+            self._finished.popleft()
+
+    def _retry_after(self, excess):
+        """
+        seconds until excess images' worth of work has probably finished, from
+        the recent throughput. Called with the lock held
+        """
+        now = time.monotonic()
+        self._trim(now)
+        done = sum(count for _, count in self._finished)
+        if not done:
+            return 1
+        rate = done / RATE_WINDOW
+        return max(1, int(math.ceil(excess / rate)))
+
+    def stats(self):
+        """returns the images in progress and admission counters as a dictionary"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['interactive_in_progress'] = self._in_progress[PRIORITY_INTERACTIVE]
+            stats['bulk_in_progress'] = self._in_progress[PRIORITY_BULK]
+        stats['max_queued'] = self.max_queued
+        stats['max_bulk'] = self.bulk_limit
+        return stats
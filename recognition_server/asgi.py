@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: serve the image API on an asyncio event loop, as an ASGI app
+
+Flask's threaded server holds a thread for each request until it is done, and
+inference requests spend most of that time waiting for image downloads. Here
+the routes which download images ('infer', 'inferundone' and 'imagesinfer')
+run as coroutines: downloads are awaited on the event loop through
+async_fetch.AsyncHTTPPool, so thousands can be in flight at the cost of their
+buffers rather than a thread each. Decoding runs on the bounded decode threads,
+the batched forward pass is awaited without holding a thread, and image store
+calls run on a small thread pool. They are admitted, prioritised and given
+deadlines like the Flask routes, see admission.py, and take the same ?model=
+argument.
+
+Every other route, and the ones above with '?async=true', are passed to the
+Flask app through a WSGI adapter on the same thread pool, so the API and its
+responses are the same with either front end. Run with '--frontend asgi', which
+needs uvicorn, or point any ASGI server at recognition_server.asgi:app .
+"""
+
+import io
+import re
+import sys
+import time
+import json
+import asyncio
+import logging
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from recognition_server import recognition_server as server
+    from recognition_server import tf_operations
+    from recognition_server import workers
+    from recognition_server import metrics
+    from recognition_server import admission
+    from recognition_server import batching
+    from recognition_server import model_registry
+except:
+    import recognition_server as server
+    import tf_operations
+    import workers
+    import metrics
+    import admission
+    import batching
+    import model_registry
+
+
+logger = logging.getLogger(__name__)
+
+# threads for Flask routes and image store calls
+WSGI_THREADS = 32
+
+_executor = ThreadPoolExecutor(WSGI_THREADS, thread_name_prefix = 'asgi')
+_done = object()
+
+
+def run_blocking(fn, *args):
+    """runs fn(*args) on the thread pool, and returns its result"""
+    return asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+def json_body(body):
+    """returns the JSON request body, or None if there is none"""
+    try:
+        return json.loads(body.decode('utf-8')) if body else None
+    except ValueError:
+        return None
+
+
+def admit(count, headers):
+    """admits a request for count images, as recognition_server.admit does"""
+    ticket = server.admission_control.admit(count)
+    deadline = admission.deadline_for(headers, tf_operations.FLAGS.request_timeout)
+    return ticket, deadline
+
+
+def request_model(query):
+    """
+    returns the model chosen with ?model=, or None for the default model. 
+    Raises model_registry.UnknownModel for a model which isn't served
+    """
+    model = query.get('model', [''])[-1] or None
+    if model is not None:
+        tf_operations.get_registry().spec(model)
+    return model
+
+
+def missed_deadline(updates):
+    return any(tf_operations.missed_deadline(update) for update in updates)
+
+
+# the natively async routes, which mirror the Flask routes of the same name
+async def infer(img_id, body, headers, model = None):
+    img = await run_blocking(server.images.get, img_id)
+    if img is None:
+        return 404, {'error': 'not found'}
+    if not json_body(body):
+        return 400, {'error': 'missing json data'}
+    ticket, deadline = admit(1, headers)
+    with ticket:
+        update = await tf_operations.infer_image_async(
+            img['url'], batching.PRIORITY_INTERACTIVE, deadline, model)
+    if missed_deadline([update]):
+        return 504, tf_operations.DEADLINE_EXCEEDED
+    [update] = await run_blocking(server.save_updates, [(img_id, update)])
+    return 200, {'img': dict(img, **update)}
+
+
+async def infer_undone(body, headers, model = None):
+    undone_imgs, remaining = await run_blocking(server.take_undone)
+    if len(undone_imgs) == 0:
+        return 404, {'error': 'not found'}
+    ticket, deadline = admit(len(undone_imgs), headers)
+    with ticket:
+        updates = await tf_operations.infer_images_async(
+            [img['url'] for img in undone_imgs], ticket.priority, deadline, model)
+    await run_blocking(server.save_updates, [
+        (img['id'], update) for img, update in zip(undone_imgs, updates)])
+    if missed_deadline(updates):
+        return 504, tf_operations.DEADLINE_EXCEEDED
+    updates = [tf_operations.split_update(update)[0] for update in updates]
+    done_imgs = [dict(img, **update) for img, update in zip(undone_imgs, updates)]
+    return 200, {'images': done_imgs, 'remaining': remaining}
+
+
+async def add_imgs_infer(body, headers, model = None):
+    json_str = json_body(body)
+    if not json_str or not isinstance(json_str.get('new_imgs'), list):
+        return 400, {'error': 'missing json data'}
+    img_data = json_str['new_imgs']
+    # URL is required, other fields not
+    valid_imgs = [img for img in img_data if img.get('url') != None]
+    ticket, deadline = admit(len(valid_imgs), headers)
+    with ticket:
+        updates = await tf_operations.infer_images_async(
+            [img['url'] for img in valid_imgs], ticket.priority, deadline, model)
+    new_images = await run_blocking(server.add_inferred, valid_imgs, updates)
+    if missed_deadline(updates):
+        return 504, tf_operations.DEADLINE_EXCEEDED
+    return (410 if len(valid_imgs) < len(img_data) else 201), new_images
+
+
+# (method, path pattern, Flask rule, handler)
+ROUTES = [
+    ('PUT', re.compile(r'/img/api/v1\.0/infer/(\d+)$'), '/img/api/v1.0/infer/<int:img_id>',
+     lambda match, body, headers, model: infer(int(match.group(1)), body, headers, model)),
+    ('PUT', re.compile(r'/img/api/v1\.0/inferundone$'), '/img/api/v1.0/inferundone',
+     lambda match, body, headers, model: infer_undone(body, headers, model)),
+    ('POST', re.compile(r'/img/api/v1\.0/imagesinfer$'), '/img/api/v1.0/imagesinfer',
+     lambda match, body, headers, model: add_imgs_infer(body, headers, model)),
+]
+
+
+def find_route(scope):
+    """returns the native route for a request and its path match, or None"""
+    query = urllib.parse.parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    # background jobs are started by the Flask routes
+    if query.get('async', [''])[-1].lower() in ('1', 'true', 'yes'):
+        return None
+    for method, pattern, rule, handler in ROUTES:
+        match = pattern.match(scope['path'])
+        if match and scope['method'] == method:
+            return rule, handler, match
+    return None
+
+
+async def read_body(receive, max_bytes = 0):
+    """
+    reads the request body, or returns None once it is bigger than max_bytes,
+    if max_bytes isn't 0
+    """
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        size += len(chunks[-1])
+        if max_bytes and size > max_bytes:
+            return None
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+async def send_json(send, status, obj, headers = None):
+    body = (server.app.json.dumps(obj) + '\n').encode('utf-8')
+    headers = dict(headers or {}, **{'Content-Type': 'application/json',
+                                     'Content-Length': str(len(body))})
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers.items()]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def call_native(scope, body, send, route):
+    rule, handler, match = route
+    start = time.perf_counter()
+    headers = {name.decode('latin-1').title(): value.decode('latin-1')
+               for name, value in scope.get('headers', [])}
+    query = urllib.parse.parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    response_headers = None
+    try:
+        status, obj = await handler(match, body, headers, request_model(query))
+    except admission.Rejected as e:
+        status, obj, response_headers = e.status, e.error_dict, e.headers()
+    except model_registry.UnknownModel as e:
+        status, obj = 404, e.error_dict
+    except Exception:
+        logger.exception('error handling %s %s', scope['method'], scope['path'])
+        status, obj = 500, {'error': 'internal server error'}
+    await send_json(send, status, obj, response_headers)
+    metrics.REQUESTS.inc(endpoint = rule, method = scope['method'], status = str(status))
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                    endpoint = rule, method = scope['method'])
+
+
+def wsgi_environ(scope, body):
+    """builds the WSGI environ for an ASGI HTTP request"""
+    server_addr = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_addr[0],
+        'SERVER_PORT': str(server_addr[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+async def call_wsgi(wsgi_app, scope, body, send):
+    """
+    runs a WSGI app for an ASGI HTTP request on the thread pool, and sends
+    its response a chunk at a time, so streamed responses stay streamed
+    """
+    started = []
+
+    def start_response(status, headers, exc_info = None):
+        started[:] = [status, headers]
+
+    result = await run_blocking(wsgi_app, wsgi_environ(scope, body), start_response)
+    try:
+        chunks = iter(result)
+        # the status may only be known once the first chunk is made
+        chunk = await run_blocking(next, chunks, _done)
+        status, headers = started
+        await send({'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                for name, value in headers]})
+        while chunk is not _done:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk,
+                            'more_body': True})
+            chunk = await run_blocking(next, chunks, _done)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await run_blocking(result.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            tf_operations.close_async_pool()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """the ASGI app"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+    body = await read_body(receive, tf_operations.FLAGS.max_upload_bytes)
+    if body is None:
+        await send_json(send, 413, {'error': 'request too large'})
+        return
+    route = find_route(scope)
+    if route is not None:
+        await call_native(scope, body, send, route)
+    else:
+        await call_wsgi(server.app, scope, body, send)
+
+
+def serve(sock = None, worker = None):
+    """
+    serves the ASGI app with uvicorn, on --host and --port, or on an already
+    listening socket. A worker also serves the Flask app on a loopback port,
+    for requests passed on by other workers
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('--frontend asgi needs uvicorn, e.g. pip install uvicorn')
+    FLAGS = tf_operations.FLAGS
+    if sock is None:
+        config = uvicorn.Config(app, host = FLAGS.host, port = FLAGS.port,
+                                lifespan = 'on')
+        uvicorn.Server(config).run()
+        return
+    if worker is not None:
+        workers.serve_internal(server.app, worker)
+    config = uvicorn.Config(app, lifespan = 'on')
+    uvicorn.Server(config).run(sockets = [sock])
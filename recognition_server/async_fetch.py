@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: asyncio image downloads, for the ASGI front end
+
+HTTPPool blocks a thread for the whole of each download, so a slow remote
+host holds on to a thread which could be decoding or serving. AsyncHTTPPool
+does the same job on an asyncio event loop: waiting for a host costs a
+coroutine and its buffers, not a thread, so thousands of downloads can be in
+flight at once. Like HTTPPool it keeps idle keep-alive connections per host,
+limits requests in flight per host (and in total), follows redirects and
+retries failed requests with exponential backoff. It speaks plain HTTP/1.1
+over asyncio streams, with TLS for https.
+
+fetch_image() is the asyncio counterpart of fetcher.fetch_image().
+"""
+
+import io
+import time
+import asyncio
+import http.client
+import ssl
+import urllib.parse
+try:
+    from recognition_server import fetcher
+    from recognition_server import metrics
+    from recognition_server.http_pool import RETRY_STATUSES, REDIRECT_STATUSES, MAX_REDIRECTS
+except:
+    import fetcher
+    import metrics
+    from http_pool import RETRY_STATUSES, REDIRECT_STATUSES, MAX_REDIRECTS
+
+
+# most header lines accepted in a response
+MAX_HEADER_LINES = 100
+# bytes read from a response body at a time
+CHUNK_SIZE = 64 * 1024
+# errors after which a request is retried
+RETRY_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                http.client.HTTPException, ValueError)
+
+
+class BodyTooLarge(Exception):
+    """raised when a response body is larger than the limit"""
+
+
+class NotAnImage(Exception):
+    """raised when a response body does not start with an image magic number"""
+
+
+class AsyncResponse(object):
+    """a complete response: status, headers (an http.client.HTTPMessage) and body"""
+
+    def __init__(self, status, headers, body, url):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.url = url
+
+
+class AsyncHTTPPool(object):
+    """
+    pool of keep-alive HTTP and HTTPS connections for one event loop, with
+    limits on requests in flight per host and in total. timeout applies to
+    each attempt at a request, from connecting to the end of the body
+    """
+
+    def __init__(self, max_per_host = 8, timeout = 10.0, retries = 2,
+                 backoff = 0.1, max_total = 1000, ssl_context = None):
+        self.max_per_host = max(1, int(max_per_host))
+        self.timeout = timeout
+        self.retries = max(0, int(retries))
+        self.backoff = backoff
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self._total = asyncio.Semaphore(max(1, int(max_total)))
+        # (scheme, host, port) -> list of idle (reader, writer) pairs
+        self._idle = {}
+        # (scheme, host, port) -> semaphore limiting requests in flight
+        self._slots = {}
+        self.counters = dict.fromkeys(
+            ['requests', 'retries', 'connections_opened', 'connections_reused',
+             'in_flight'], 0)
+
+    def _slot(self, key):
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = asyncio.Semaphore(self.max_per_host)
+        return slot
+
+    async def _acquire(self, key):
+        """takes an idle connection for key, or opens a new one"""
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                self.counters['connections_reused'] += 1
+                return reader, writer, True
+            writer.close()
+        self.counters['connections_opened'] += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            reader, writer = await asyncio.open_connection(
+                host, port, ssl = self.ssl_context, server_hostname = host)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return reader, writer, False
+
+    def _release(self, key, reader, writer, reusable):
+        """returns a connection to the pool, or closes it"""
+        idle = self._idle.setdefault(key, [])
+        if reusable and len(idle) < self.max_per_host:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def get(self, url, headers = None, max_bytes = None, images_only = False):
+        """
+        sends a GET request and returns the AsyncResponse, with the whole
+        body. Redirects are followed. Connection errors and some 5xx
+        responses are retried with exponential backoff. Raises BodyTooLarge
+        if the body is longer than max_bytes. With images_only, raises 
+        NotAnImage as soon as a successful response's body turns out not to
+        be an image, and error responses are returned without their body
+        """
+        async with self._total:
+            self.counters['in_flight'] += 1
+            try:
+                for _ in range(MAX_REDIRECTS + 1):
+                    response = await self._get_once(url, headers, max_bytes,
+                                                    images_only)
+                    location = response.headers.get('Location')
+                    if response.status not in REDIRECT_STATUSES or not location:
+                        return response
+                    url = urllib.parse.urljoin(url, location)
+            finally:
+                self.counters['in_flight'] -= 1
+        raise http.client.HTTPException('too many redirects for %s' % url)
+
+    async def _get_once(self, url, headers, max_bytes, images_only):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('unsupported URL %s' % url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % parts.netloc.rsplit('@', 1)[-1],
+                 'Accept-Encoding: identity']
+        lines += ['%s: %s' % item for item in (headers or {}).items()]
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        self.counters['requests'] += 1
+
+        attempt = 0
+        while True:
+            try:
+                async with self._slot(key):
+                    response = await asyncio.wait_for(
+                        self._request(key, request, max_bytes, images_only),
+                        self.timeout)
+            except (BodyTooLarge, NotAnImage):
+                raise
+            except RETRY_ERRORS as e:
+                if getattr(e, 'stale', False):
+                    # a reused connection was closed by the server while
+                    # idle, so try again at once on a fresh one
+                    continue
+                if attempt >= self.retries:
+                    raise
+            else:
+                response.url = url
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+            attempt += 1
+            self.counters['retries'] += 1
+            await asyncio.sleep(self.backoff * (2 ** (attempt - 1)))
+
+    async def _request(self, key, request, max_bytes, images_only = False):
+        reader, writer, reused = await self._acquire(key)
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                error = ConnectionResetError('connection closed before the response')
+                error.stale = reused
+                raise error
+            version, status = self._parse_status(status_line)
+            header_lines = []
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                header_lines.append(line)
+                if len(header_lines) > MAX_HEADER_LINES:
+                    raise http.client.HTTPException('too many headers')
+            headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines) + b'\r\n'))
+            if images_only and status >= 400 and status not in RETRY_STATUSES:
+                # an error page, which the caller doesn't want
+                body, reusable = b'', False
+            else:
+                body, reusable = await self._read_body(reader, headers, status, max_bytes,
+                                                       images_only and status < 300)
+        except BaseException:
+            writer.close()
+            raise
+        reusable = (reusable and version == 'HTTP/1.1' and
+                    headers.get('Connection', '').lower() != 'close')
+        self._release(key, reader, writer, reusable)
+        return AsyncResponse(status, headers, body, None)
+
+    @staticmethod
+    def _parse_status(line):
+        parts = line.decode('latin-1').rstrip('\r\n').split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/') or not parts[1].isdigit():
+            raise http.client.BadStatusLine(line)
+        return parts[0], int(parts[1])
+
+    @staticmethod
+    def _check_first(chunk):
+        """raises NotAnImage if the first chunk of a body is not an image, as fetcher does"""
+        if fetcher.sniff_format(chunk) is None and len(chunk) >= 8:
+            raise NotAnImage()
+
+    @classmethod
+    async def _read_body(cls, reader, headers, status, max_bytes, images_only = False):
+        """
+        returns the body, and whether the connection can be reused after it.
+        With images_only, its first chunk is checked before the rest is read
+        """
+        if status in (204, 304) or 100 <= status < 200:
+            return b'', True
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            size = 0
+            while True:
+                chunk_size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if chunk_size == 0:
+                    # skip any trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks), True
+                size += chunk_size
+                if max_bytes is not None and size > max_bytes:
+                    raise BodyTooLarge()
+                chunks.append(await reader.readexactly(chunk_size))
+                if images_only and len(chunks) == 1:
+                    cls._check_first(chunks[0])
+                await reader.readline()
+        length = headers.get('Content-Length')
+        if length is not None:
+            length = int(length)
+            if max_bytes is not None and length > max_bytes:
+                raise BodyTooLarge()
+            if not images_only:
+                return await reader.readexactly(length), True
+            first = await reader.readexactly(min(length, CHUNK_SIZE))
+            cls._check_first(first)
+            return first + await reader.readexactly(length - len(first)), True
+        # no length, the body ends when the server closes the connection
+        chunks = []
+        size = 0
+        while True:
+            chunk = await reader.read(CHUNK_SIZE)
+            if not chunk:
+                return b''.join(chunks), False
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                raise BodyTooLarge()
+            if images_only and not chunks:
+                cls._check_first(chunk)
+            chunks.append(chunk)
+
+    def close(self):
+        """closes all idle connections"""
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for _, writer in conns:
+                writer.close()
+
+    def stats(self):
+        """returns request and connection counters as a dictionary"""
+        stats = dict(self.counters)
+        stats['idle_connections'] = sum(len(c) for c in self._idle.values())
+        return stats
+
+
+async def fetch_image(url, max_bytes = 20 * 1024 * 1024, request_headers = None,
+                      pool = None):
+    """
+    downloads the image at url into memory and checks it, without blocking
+    the event loop while waiting. Returns a fetcher.FetchedImage, with
+    not_modified set if the server answered 304. Raises fetcher.FetchError
+    """
+    start = time.perf_counter()
+    try:
+        response = await pool.get(url, request_headers, max_bytes, images_only = True)
+    except BodyTooLarge:
+        raise fetcher.FetchError("image too large")
+    except NotAnImage:
+        # the rest of the body isn't downloaded
+        raise fetcher.FetchError("file cannot be opened")
+    except Exception:
+        # bad address, refused connection, timeout etc.
+        raise fetcher.FetchError("invalid URL")
+    finally:
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start, stage = 'fetch')
+    headers = dict(response.headers.items())
+    if response.status == 304:
+        return fetcher.FetchedImage(None, headers, not_modified = True)
+    if response.status >= 400:
+        raise fetcher.FetchError("invalid URL")
+    # only the image header is read, so this is quick enough for the loop
+    with metrics.STAGE_SECONDS.time(stage = 'validate'):
+        image_format = fetcher.check_image_data(response.body)
+    return fetcher.FetchedImage(response.body, headers, image_format)
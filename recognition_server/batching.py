@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: dynamic micro-batching of inference requests
+
+Concurrent requests each preprocess their own image and submit it to a
+BatchScheduler. A single worker thread collects submitted images until either
+the maximum batch size is reached or the oldest image has waited the maximum
+time, then runs one batched forward pass on the inference engine and hands
+each row of predictions back to the caller waiting for it. An optional
+postprocess function is run on the whole batch of predictions first, e.g. to
+pick the top classes of every image at once.
+
+Images are taken in priority order, so interactive requests are not stuck
+behind bulk ones, and in order of submission within a priority. An image
+can carry a deadline, after which its caller has given up: it is dropped
+rather than run, and its Future raises DeadlineExceeded.
+"""
+
+import threading
+import itertools
+import time
+import queue
+from concurrent.futures import Future
+try:
+    from recognition_server import metrics
+except:
+    import metrics
+
+
+# image priorities, lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+# queued behind everything else, to stop the worker
+_STOP = float('inf')
+
+
+class DeadlineExceeded(Exception):
+    """the deadline of a queued image passed before it was run"""
+
+
+class BatchScheduler(object):
+    """
+    queues preprocessed images in front of an InferenceEngine and runs them
+    through the engine in batches. Keeps batch occupancy statistics
+    """
+
+    def __init__(self, engine, max_batch_size = 16, max_wait_ms = 5.0,
+                 postprocess = None):
+        self.engine = engine
+        # called with the predictions of a batch, must return something
+        # indexable by row
+        self.postprocess = postprocess
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.PriorityQueue()
+        # keeps images of the same priority in order
+        self._sequence = itertools.count()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._running = False
+        # batch size -> number of batches run with that size
+        self.batch_sizes = {}
+        self.num_batches = 0
+        self.num_images = 0
+        self.num_expired = 0
+
+    def start(self):
+        """starts the worker thread, if it is not already running"""
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target = self._run,
+                                            name = 'batch-scheduler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """stops the worker thread once the queued images have been run"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            thread = self._thread
+        self._put_stop()
+        thread.join()
+
+    def _put_stop(self):
+        self._queue.put((_STOP, next(self._sequence), None, None, None, None))
+
+    def submit(self, image_tensor, priority = PRIORITY_INTERACTIVE, deadline = None):
+        """
+        queues a preprocessed image. Returns a Future, whose result is the 1-D
+        array of prediction scores for that image, or its row of the 
+        postprocessed batch. deadline is a time.monotonic() time, after which
+        the image is dropped and the Future raises DeadlineExceeded
+        """
+        self.start()
+        future = Future()
+        self._queue.put((priority, next(self._sequence), image_tensor, future,
+                         time.perf_counter(), deadline))
+        return future
+
+    def predict(self, image_tensor, priority = PRIORITY_INTERACTIVE, deadline = None):
+        """queues a preprocessed image and waits for its prediction scores"""
+        return self.submit(image_tensor, priority, deadline).result()
+
+    def _collect(self):
+        """
+        blocks for the first queued image, then collects more until the batch
+        is full or the wait time has passed. Returns None when stopping
+        """
+        item = self._queue.get()
+        if item[0] == _STOP:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout = timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] == _STOP:
+                # run what we have, then stop on the next call
+                self._put_stop()
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        """worker loop, runs one forward pass per collected batch"""
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            batch = self._drop_expired(batch)
+            if not batch:
+                continue
+            futures = [item[3] for item in batch]
+            started = time.perf_counter()
+            for item in batch:
+                metrics.STAGE_SECONDS.observe(started - item[4], stage = 'queue')
+            metrics.BATCH_SIZE.observe(len(batch))
+            try:
+                with metrics.STAGE_SECONDS.time(stage = 'inference'):
+                    predictions = self.engine.predict_batch(
+                        [item[2] for item in batch])
+                if self.postprocess is not None:
+                    with metrics.STAGE_SECONDS.time(stage = 'postprocess'):
+                        predictions = self.postprocess(predictions)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            with self._lock:
+                self.num_batches += 1
+                self.num_images += len(batch)
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            for i, future in enumerate(futures):
+                future.set_result(predictions[i])
+
+    def _drop_expired(self, batch):
+        """fails the images whose deadline has passed, returns the rest"""
+        now = time.monotonic()
+        live = []
+        for item in batch:
+            deadline = item[5]
+            if deadline is not None and now > deadline:
+                item[3].set_exception(DeadlineExceeded())
+            else:
+                live.append(item)
+        expired = len(batch) - len(live)
+        if expired:
+            metrics.SHED.inc(expired, reason = 'deadline')
+            with self._lock:
+                self.num_expired += expired
+        return live
+
+    def stats(self):
+        """returns batch size and occupancy statistics as a dictionary"""
+        with self._lock:
+            num_batches = self.num_batches
+            num_images = self.num_images
+            num_expired = self.num_expired
+            batch_sizes = dict(self.batch_sizes)
+        if num_batches:
+            mean_batch_size = num_images / num_batches
+        else:
+            mean_batch_size = 0.0
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'num_batches': num_batches,
+            'num_images': num_images,
+            'num_expired': num_expired,
+            'mean_batch_size': round(mean_batch_size, 3),
+            # fraction of the available batch slots that were used
+            'mean_occupancy': round(mean_batch_size / self.max_batch_size, 3),
+            'batch_sizes': batch_sizes,
+            'queue_depth': self._queue.qsize()
+        }
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: reproducible offline benchmark of the recognition service
+
+Serves a synthetic image corpus from a local HTTP server, so no test images
+are downloaded from the internet, and drives the Flask app at a set
+concurrency, either in-process through Flask's test client or over real
+sockets. For each of the infer, inferundone and imagesinfer functions it
+reports p50/p95/p99 request latency, images per second and how resident
+memory grows over the run, and writes the results to a JSON file which can
+be compared with the results of another commit:
+
+    python -m recognition_server.benchmark --images 200 --concurrency 8 \\
+        --bench_output new.json
+    python -m recognition_server.benchmark --compare old.json new.json
+
+Any server flag, e.g. --max_batch_size or --model_variant, can be given too.
+The corpus is generated from a fixed seed, so every run sees the same images.
+Each scenario uses images no other scenario has seen, and the result cache is
+cleared between scenarios, so results measure inference rather than the cache.
+Images are kept in an in-memory store which starts empty.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+import http.client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+SCENARIOS = ['infer', 'inferundone', 'imagesinfer']
+# seconds between resident memory samples
+RSS_INTERVAL = 0.5
+
+
+def make_image(index, seed = 0):
+    """
+    returns the encoded bytes and file extension of synthetic image number
+    index: random shapes on a noisy background, in a mix of sizes and formats
+    """
+    rng = np.random.RandomState(seed * 1000003 + index)
+    width, height = [(640, 480), (1600, 1200), (300, 300), (1024, 768),
+                     (250, 400)][index % 5]
+    pixels = rng.randint(0, 256, (height // 8, width // 8, 3)).astype(np.uint8)
+    img = Image.fromarray(pixels).resize((width, height), Image.BILINEAR)
+    draw = ImageDraw.Draw(img)
+    for _ in range(6):
+        x0, y0 = rng.randint(0, width), rng.randint(0, height)
+        x1, y1 = x0 + rng.randint(20, width // 2), y0 + rng.randint(20, height // 2)
+        colour = tuple(int(c) for c in rng.randint(0, 256, 3))
+        if rng.rand() < 0.5:
+            draw.ellipse([x0, y0, x1, y1], fill = colour)
+        else:
+            draw.rectangle([x0, y0, x1, y1], fill = colour)
+    image_format, extension = [('JPEG', 'jpg'), ('JPEG', 'jpg'), ('PNG', 'png'),
+                               ('JPEG', 'jpg'), ('GIF', 'gif')][index % 5]
+    buf = io.BytesIO()
+    img.save(buf, format = image_format)
+    return buf.getvalue(), extension
+
+
+class _CorpusHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        data = self.server.files.get(self.path.split('?')[0])
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/' + self.path.rsplit('.', 1)[-1])
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class CorpusServer(object):
+    """
+    serves count synthetic images from a local HTTP server, with keep-alive.
+    The images are generated before the server starts, so generating them
+    is not part of any measurement
+    """
+
+    def __init__(self, count, seed = 0):
+        self.paths = []
+        files = {}
+        for index in range(count):
+            data, extension = make_image(index, seed)
+            path = '/corpus/%05d.%s' % (index, extension)
+            files[path] = data
+            self.paths.append(path)
+        self.total_bytes = sum(len(data) for data in files.values())
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _CorpusHandler)
+        self._server.daemon_threads = True
+        self._server.files = files
+        self._thread = threading.Thread(target = self._server.serve_forever,
+                                        name = 'corpus-server')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def urls(self, start, count):
+        """returns the URLs of count images, starting at image number start"""
+        port = self._server.server_address[1]
+        return ['http://127.0.0.1:%d%s' % (port, path)
+                for path in self.paths[start:start + count]]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class InProcessDriver(object):
+    """sends requests to the app through Flask's test client, one per thread"""
+
+    name = 'in-process'
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body = None):
+        """sends a request, returns the status code and decoded JSON body"""
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method = method, json = body)
+        return response.status_code, json.loads(response.data)
+
+    def close(self):
+        pass
+
+
+class SocketDriver(object):
+    """
+    serves the app with a threaded WSGI server on a local port, and sends
+    requests over keep-alive HTTP connections, one per thread
+    """
+
+    name = 'sockets'
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        self._server = make_server('127.0.0.1', 0, app, threaded = True)
+        self.port = self._server.server_port
+        self._thread = threading.Thread(target = self._server.serve_forever,
+                                        name = 'benchmark-server')
+        self._thread.daemon = True
+        self._thread.start()
+        self._local = threading.local()
+
+    def request(self, method, path, body = None):
+        """sends a request, returns the status code and decoded JSON body"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = http.client.HTTPConnection(
+                '127.0.0.1', self.port, timeout = 300)
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            conn.request(method, path, data, headers)
+            response = conn.getresponse()
+            payload = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self._local.conn = None
+            raise
+        return response.status, json.loads(payload)
+
+    def close(self):
+        self._server.shutdown()
+
+
+class RSSSampler(object):
+    """samples the resident memory of this process in the background"""
+
+    def __init__(self, resident_memory, interval = RSS_INTERVAL):
+        self.resident_memory = resident_memory
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._start = time.time()
+        self._thread = threading.Thread(target = self._run, name = 'rss-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self.samples.append((round(time.time() - self._start, 3),
+                                 self.resident_memory()))
+            if self._stop.wait(self.interval):
+                return
+
+    def stop(self):
+        """stops sampling, returns the memory summary as a dictionary"""
+        self._stop.set()
+        self._thread.join()
+        self.samples.append((round(time.time() - self._start, 3),
+                             self.resident_memory()))
+        values = [rss for _, rss in self.samples]
+        return {
+            'rss_start_mb': round(values[0] / 1e6, 2),
+            'rss_end_mb': round(values[-1] / 1e6, 2),
+            'rss_max_mb': round(max(values) / 1e6, 2),
+            'rss_growth_mb': round((values[-1] - values[0]) / 1e6, 2),
+            'rss_samples': [[t, round(rss / 1e6, 2)] for t, rss in self.samples]
+        }
+
+
+def latency_summary(latencies):
+    """returns count, mean and p50/p95/p99/max of latencies in milliseconds"""
+    ms = np.asarray(latencies, dtype = np.float64) * 1000
+    if len(ms) == 0:
+        return {'requests': 0}
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        'requests': len(ms),
+        'mean_ms': round(float(ms.mean()), 3),
+        'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3),
+        'p99_ms': round(float(p99), 3),
+        'max_ms': round(float(ms.max()), 3)
+    }
+
+
+def count_errors(imgs):
+    """counts images whose results are an error"""
+    return sum(1 for img in imgs
+               if isinstance(img.get('results'), dict) and 'error' in img['results'])
+
+
+def run_timed(work, items, concurrency):
+    """
+    calls work(item) for every item on concurrency threads. Returns the
+    latency of each call, the results and the wall time
+    """
+    def timed(item):
+        start = time.time()
+        result = work(item)
+        return time.time() - start, result
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        timings = list(executor.map(timed, items))
+    wall = time.time() - start
+    return [t for t, _ in timings], [r for _, r in timings], wall
+
+
+def add_images(driver, urls):
+    """adds images without running inference, returns their IDs"""
+    status, imgs = driver.request('POST', '/img/api/v1.0/images',
+                                  {'new_imgs': [{'url': url} for url in urls]})
+    if status != 201:
+        raise RuntimeError('could not add images: %d %r' % (status, imgs))
+    return [img['id'] for img in imgs]
+
+
+def bench_infer(driver, urls, concurrency, batch_size):
+    """one PUT infer/<id> request per image"""
+    ids = add_images(driver, urls)
+
+    def work(img_id):
+        status, body = driver.request('PUT', '/img/api/v1.0/infer/%d' % img_id,
+                                      {'id': img_id})
+        return [body['img']] if status == 200 else None
+    return run_timed(work, ids, concurrency)
+
+
+def bench_inferundone(driver, urls, concurrency, batch_size):
+    """
+    adds batch_size images, then runs inferundone on them, one round at a
+    time, as inferundone covers every undone image
+    """
+    latencies, results = [], []
+    wall = 0.0
+    for start in range(0, len(urls), batch_size):
+        add_images(driver, urls[start:start + batch_size])
+        round_start = time.time()
+        status, body = driver.request('PUT', '/img/api/v1.0/inferundone')
+        latency = time.time() - round_start
+        wall += latency
+        latencies.append(latency)
+        results.append(body['images'] if status == 200 else None)
+    return latencies, results, wall
+
+
+def bench_imagesinfer(driver, urls, concurrency, batch_size):
+    """POST imagesinfer requests with batch_size new images each"""
+    batches = [urls[i:i + batch_size] for i in range(0, len(urls), batch_size)]
+
+    def work(batch):
+        status, body = driver.request('POST', '/img/api/v1.0/imagesinfer',
+                                      {'new_imgs': [{'url': url} for url in batch]})
+        return body if status == 201 else None
+    return run_timed(work, batches, concurrency)
+
+
+BENCHMARKS = {
+    'infer': bench_infer,
+    'inferundone': bench_inferundone,
+    'imagesinfer': bench_imagesinfer
+}
+
+
+def run_scenario(name, driver, urls, concurrency, batch_size, resident_memory,
+                 clear_cache):
+    """runs one benchmark, returns its results as a dictionary"""
+    clear_cache()
+    sampler = RSSSampler(resident_memory)
+    latencies, results, wall = BENCHMARKS[name](driver, urls, concurrency, batch_size)
+    memory = sampler.stop()
+    failed = sum(1 for result in results if result is None)
+    imgs = [img for result in results if result for img in result]
+    summary = latency_summary(latencies)
+    summary.update({
+        'driver': driver.name,
+        'concurrency': 1 if name == 'inferundone' else concurrency,
+        'images': len(urls),
+        'failed_requests': failed,
+        'image_errors': count_errors(imgs),
+        'wall_s': round(wall, 3),
+        'images_per_s': round(len(imgs) / wall, 3) if wall else 0.0
+    })
+    summary.update(memory)
+    return summary
+
+
+def git_commit():
+    """returns the current git commit of the source tree, or None"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+            stderr = subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    """
+    returns a text table of the change in each latency and throughput figure
+    between two result files
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    lines = ['%-24s %-14s %12s %12s %9s' % ('scenario', 'metric', 'old', 'new', 'change')]
+    for key in sorted(set(old['scenarios']) & set(new['scenarios'])):
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'images_per_s', 'rss_growth_mb'):
+            before = old['scenarios'][key].get(metric)
+            after = new['scenarios'][key].get(metric)
+            if before is None or after is None:
+                continue
+            change = '%+.1f%%' % ((after - before) / before * 100) if before else 'n/a'
+            lines.append('%-24s %-14s %12.3f %12.3f %9s' % (key, metric, before, after, change))
+    return '\n'.join(lines)
+
+
+def parse_benchmark_args(argv = None):
+    parser = argparse.ArgumentParser(description = 'benchmark the recognition service')
+    parser.add_argument('--images', type = int, default = 100,
+                        help = 'Images per scenario.')
+    parser.add_argument('--concurrency', type = int, default = 8,
+                        help = 'Requests in flight at once.')
+    parser.add_argument('--batch', type = int, default = 16,
+                        help = 'Images per inferundone round and per imagesinfer request.')
+    parser.add_argument('--scenarios', type = str, default = ','.join(SCENARIOS),
+                        help = 'Comma separated scenarios to run.')
+    parser.add_argument('--drivers', type = str, default = 'in-process,sockets',
+                        help = 'Comma separated drivers: in-process and/or sockets.')
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = 'Seed of the synthetic corpus.')
+    parser.add_argument('--bench_output', type = str, default = 'benchmark_results.json',
+                        help = 'JSON file the results are written to.')
+    parser.add_argument('--compare', nargs = 2, metavar = ('OLD', 'NEW'),
+                        help = 'Compare two result files instead of running.')
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def main(argv = None):
+    args = parse_benchmark_args(argv)
+    if args.compare:
+        print(compare(*args.compare))
+        return
+
+    try:
+        from recognition_server import recognition_server, tf_operations, image_store
+    except:
+        import recognition_server
+        import tf_operations
+        import image_store
+    tf_operations.parse_args(['--image_store', 'memory'] + list(
+        sys.argv[1:] if argv is None else argv))
+    FLAGS = tf_operations.FLAGS
+    tf_operations.download_and_extract_model_if_needed()
+    recognition_server.start()
+    # time requests against a loaded model, not the warm-up
+    if not tf_operations.wait_until_ready():
+        sys.exit('model failed to load: %s' % tf_operations.readiness()['error'])
+    # start with no images, so inferundone only sees the benchmark's own
+    recognition_server.images = image_store.ImageStore()
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    drivers = [name for name in args.drivers.split(',') if name]
+    corpus = CorpusServer(args.images * len(scenarios) * len(drivers), args.seed)
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'images': args.images,
+            'concurrency': args.concurrency,
+            'batch': args.batch,
+            'seed': args.seed,
+            'corpus_mb': round(corpus.total_bytes / 1e6, 2),
+            'cpu_count': os.cpu_count(),
+            'max_batch_size': FLAGS.max_batch_size,
+            'batch_timeout_ms': FLAGS.batch_timeout_ms,
+            'model_variant': FLAGS.model_variant
+        },
+        'scenarios': {}
+    }
+    start = 0
+    try:
+        for driver_name in drivers:
+            if driver_name == 'sockets':
+                driver = SocketDriver(recognition_server.app)
+            else:
+                driver = InProcessDriver(recognition_server.app)
+            try:
+                for name in scenarios:
+                    urls = corpus.urls(start, args.images)
+                    start += args.images
+                    key = '%s/%s' % (name, driver.name)
+                    results['scenarios'][key] = run_scenario(
+                        name, driver, urls, args.concurrency, args.batch,
+                        tf_operations.resident_memory,
+                        tf_operations.get_result_cache().clear)
+                    summary = results['scenarios'][key]
+                    print('%-24s p50 %8.1f ms  p99 %8.1f ms  %8.1f images/s' % (
+                        key, summary.get('p50_ms', 0), summary.get('p99_ms', 0),
+                        summary['images_per_s']))
+            finally:
+                driver.close()
+    finally:
+        corpus.close()
+
+    with open(args.bench_output, 'w') as f:
+        json.dump(results, f, indent = 2, sort_keys = True)
+        f.write('\n')
+    print('results written to %s' % args.bench_output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: classify a large corpus offline, from a manifest file
+
+Streams a manifest of image URLs or local paths through the staged download,
+decode and batched inference pipeline, without the HTTP API, and writes each
+result as soon as its image is done:
+
+    python -m recognition_server.bulk --image_file manifest.jsonl \\
+        --bulk_output results.jsonl
+
+The manifest is read a line at a time, and the pipeline's bounded queues
+keep only a few batches of images in memory, so memory does not grow with
+the size of the manifest. A manifest can be JSONL, with one object per line
+holding a 'url' or 'path' (or 'image' or 'file') and an optional 'id', CSV
+with a header naming those columns, or plain text with one URL or path per
+line. Local paths are relative to the manifest. Results are written as JSONL,
+or as Parquet part files if pyarrow is installed.
+
+Progress is checkpointed to '<output>.checkpoint' every --checkpoint_every
+results. After a crash, running the same command again truncates the output
+to the last checkpoint and carries on from there; --restart starts over.
+Decoding uses a thread per core, unless --decode_workers is given, and
+embeddings are not kept unless --embedding_index is given.
+
+--image_file can also be a single image, whose top predictions are printed.
+"""
+
+import io
+import os
+import csv
+import sys
+import json
+import argparse
+import itertools
+try:
+    from recognition_server import tf_operations
+    from recognition_server import fetcher
+except:
+    import tf_operations
+    import fetcher
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# manifest fields which hold an image URL or local path, in order of preference
+SOURCE_KEYS = ('url', 'path', 'image', 'file')
+CHECKPOINT_SUFFIX = '.checkpoint'
+
+
+def guess_format(path):
+    """guesses the format of a manifest from its extension"""
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension in ('jsonl', 'ndjson', 'json'):
+        return 'jsonl'
+    if extension in ('csv', 'tsv'):
+        return 'csv'
+    return 'text'
+
+
+def _source_of(fields):
+    for key in SOURCE_KEYS:
+        if fields.get(key):
+            return str(fields[key])
+    return None
+
+
+def read_manifest(path, manifest_format = None):
+    """
+    yields (line, id, source) for each image in a manifest, reading one line
+    at a time. line counts images from 0, id defaults to the line, and source
+    is a URL, a local path or None if the entry names no image
+    """
+    manifest_format = manifest_format or guess_format(path)
+    with io.open(path, 'r', encoding = 'utf-8', newline = '') as f:
+        if manifest_format == 'csv':
+            dialect = 'excel-tab' if path.lower().endswith('.tsv') else 'excel'
+            entries = (row for row in csv.DictReader(f, dialect = dialect))
+        elif manifest_format == 'jsonl':
+            entries = (_parse_json_line(text) for text in f if text.strip())
+        else:
+            entries = ({'url': text.strip()} for text in f if text.strip())
+        for line, fields in enumerate(entries):
+            item_id = fields.get('id')
+            yield line, line if item_id in (None, '') else item_id, _source_of(fields)
+
+
+def _parse_json_line(text):
+    try:
+        fields = json.loads(text)
+    except ValueError:
+        return {}
+    if isinstance(fields, str):
+        return {'url': fields}
+    return fields if isinstance(fields, dict) else {}
+
+
+def fetch_source(source, base_dir = ''):
+    """
+    the first pipeline stage: downloads a URL, or reads a local file. Returns
+    the same as tf_operations.fetch_image
+    """
+    if not source:
+        return tf_operations.error_update({"error": "no image URL or path"}), False
+    if source.startswith(('http://', 'https://')):
+        return tf_operations.fetch_image(source)
+    path = os.path.join(base_dir, os.path.expanduser(source))
+    try:
+        if os.path.getsize(path) > tf_operations.FLAGS.max_image_bytes:
+            return tf_operations.error_update({"error": "image too large"}), False
+        with open(path, 'rb') as f:
+            image_data = f.read()
+    except (IOError, OSError):
+        return tf_operations.error_update({"error": "file cannot be opened"}), False
+    return tf_operations.check_image_bytes(image_data)
+
+
+def result_record(line, item_id, source, update):
+    """the output record for one image"""
+    update = tf_operations.split_update(update)[0]
+    return {
+        'line': line,
+        'id': item_id,
+        'source': source,
+        'results': tf_operations.format_results(update['results']),
+        'size': update['size'],
+        'resize': update['resize']
+    }
+
+
+class Progress(object):
+    """
+    which manifest lines are done. Results finish out of order, so this is
+    the first line not yet done, and the done lines after it, which are few
+    as the pipeline only holds a few batches
+    """
+
+    def __init__(self, next_line = 0, done = ()):
+        self.next_line = next_line
+        self.done = set(done)
+
+    def is_done(self, line):
+        return line < self.next_line or line in self.done
+
+    def mark_done(self, line):
+        self.done.add(line)
+        while self.next_line in self.done:
+            self.done.remove(self.next_line)
+            self.next_line += 1
+
+
+class JSONLWriter(object):
+    """writes records to a JSONL file, which can be truncated to a checkpoint"""
+
+    format = 'jsonl'
+
+    def __init__(self, path, state = None):
+        self.path = path
+        resume = state is not None and os.path.exists(path)
+        self._file = open(path, 'r+b' if resume else 'wb')
+        if resume:
+            # drop anything written after the checkpoint
+            self._file.seek(state['offset'])
+            self._file.truncate()
+
+    def write(self, record):
+        self._file.write(json.dumps(record).encode('utf-8') + b'\n')
+
+    def checkpoint(self):
+        """makes what has been written durable, returns the state to resume from"""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {'offset': self._file.tell()}
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter(object):
+    """
+    writes records to a directory of Parquet files, one per checkpoint.
+    results and size are stored as JSON text
+    """
+
+    format = 'parquet'
+
+    def __init__(self, path, state = None):
+        if pyarrow is None:
+            sys.exit('Parquet output needs pyarrow, e.g. pip install pyarrow')
+        self.path = path
+        self.parts = state['parts'] if state else 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # drop any part written after the checkpoint
+        for name in os.listdir(path):
+            if name.startswith('part-') and int(name[5:10]) >= self.parts:
+                os.remove(os.path.join(path, name))
+        self._rows = []
+
+    def write(self, record):
+        record = dict(record, id = str(record['id']), results = json.dumps(record['results']),
+                      size = json.dumps(record['size']))
+        self._rows.append(record)
+
+    def checkpoint(self):
+        if self._rows:
+            table = pyarrow.Table.from_pylist(self._rows)
+            name = os.path.join(self.path, 'part-%05d.parquet' % self.parts)
+            pyarrow.parquet.write_table(table, name + '.tmp')
+            os.replace(name + '.tmp', name)
+            self.parts += 1
+            self._rows = []
+        return {'parts': self.parts}
+
+    def close(self):
+        pass
+
+
+WRITERS = {'jsonl': JSONLWriter, 'parquet': ParquetWriter}
+
+
+def load_checkpoint(path, manifest):
+    """returns the saved checkpoint for manifest, or None"""
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if checkpoint.get('manifest') != os.path.abspath(manifest):
+        sys.exit('%s is for another manifest, %s. Use --restart to start over'
+                 % (path, checkpoint.get('manifest')))
+    return checkpoint
+
+
+def save_checkpoint(path, manifest, output_format, progress, writer_state):
+    checkpoint = {
+        'manifest': os.path.abspath(manifest),
+        'format': output_format,
+        'next_line': progress.next_line,
+        'done': sorted(progress.done),
+        'writer': writer_state
+    }
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def classify_manifest(manifest, output, output_format = 'jsonl', manifest_format = None,
+                      checkpoint_every = 1000, restart = False, pipeline = None):
+    """
+    runs every image in manifest through the pipeline and writes the results
+    to output, resuming from its checkpoint unless restart is True. pipeline
+    defaults to tf_operations.get_pipeline with fetch_source as its first
+    stage. Returns counts of the images done, skipped and failed
+    """
+    checkpoint_path = output + CHECKPOINT_SUFFIX
+    checkpoint = None if restart else load_checkpoint(checkpoint_path, manifest)
+    if checkpoint is not None and checkpoint.get('format') != output_format:
+        sys.exit('%s was written as %s. Use --restart to start over'
+                 % (output, checkpoint.get('format')))
+    if checkpoint is None:
+        progress = Progress()
+        writer = WRITERS[output_format](output)
+    else:
+        progress = Progress(checkpoint['next_line'], checkpoint['done'])
+        writer = WRITERS[output_format](output, checkpoint['writer'])
+    if pipeline is None:
+        base_dir = os.path.dirname(os.path.abspath(manifest))
+        pipeline = tf_operations.get_pipeline(lambda source: fetch_source(source, base_dir))
+
+    # pipeline index -> (line, id, source), for the images in the pipeline
+    in_flight = {}
+    fed = itertools.count()
+    counts = {'done': 0, 'skipped': 0, 'failed': 0}
+
+    def todo():
+        for line, item_id, source in read_manifest(manifest, manifest_format):
+            if progress.is_done(line):
+                counts['skipped'] += 1
+                continue
+            in_flight[next(fed)] = (line, item_id, source)
+            yield source
+
+    try:
+        since_checkpoint = 0
+        for index, update in pipeline.run(todo()):
+            line, item_id, source = in_flight.pop(index)
+            record = result_record(line, item_id, source, update)
+            writer.write(record)
+            progress.mark_done(line)
+            counts['done'] += 1
+            if isinstance(record['results'], dict) and 'error' in record['results']:
+                counts['failed'] += 1
+            since_checkpoint += 1
+            if since_checkpoint >= checkpoint_every:
+                save_checkpoint(checkpoint_path, manifest, output_format, progress,
+                                writer.checkpoint())
+                since_checkpoint = 0
+        save_checkpoint(checkpoint_path, manifest, output_format, progress,
+                        writer.checkpoint())
+    finally:
+        writer.close()
+    return counts
+
+
+def classify_file(path):
+    """returns the top predictions for a single image file"""
+    [fetched_or_update, ok] = fetch_source(path)
+    if ok:
+        [fetched_or_update, ok] = tf_operations.decode_image(fetched_or_update)
+    if ok:
+        fetched_or_update = tf_operations.infer_batch([fetched_or_update])[0]
+    return tf_operations.format_results(tf_operations.split_update(fetched_or_update)[0]['results'])
+
+
+def is_image_file(path):
+    """whether path is an image, rather than a manifest"""
+    with open(path, 'rb') as f:
+        return fetcher.sniff_format(f.read(16)) is not None
+
+
+def parse_bulk_args(argv = None):
+    parser = argparse.ArgumentParser(description = 'classify the images in a manifest')
+    parser.add_argument('--bulk_output', type = str, default = '',
+                        help = 'Results file, or directory for Parquet. Defaults '
+                        'to the manifest name with .results.jsonl .')
+    parser.add_argument('--bulk_format', type = str, default = '',
+                        choices = ['', 'jsonl', 'parquet'],
+                        help = 'Output format, by default from the output extension.')
+    parser.add_argument('--manifest_format', type = str, default = '',
+                        choices = ['', 'jsonl', 'csv', 'text'],
+                        help = 'Manifest format, by default from its extension.')
+    parser.add_argument('--checkpoint_every', type = int, default = 1000,
+                        help = 'Results between checkpoints.')
+    parser.add_argument('--restart', action = 'store_true',
+                        help = 'Ignore any checkpoint and start from the beginning.')
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def _given(argv, flag):
+    return any(arg == flag or arg.startswith(flag + '=') for arg in argv)
+
+
+def main(argv = None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    args = parse_bulk_args(argv)
+    tf_operations.parse_args(argv)
+    FLAGS = tf_operations.FLAGS
+    if not FLAGS.image_file:
+        sys.exit('--image_file is required: a manifest, or an image to classify')
+    # offline, all the cores can decode
+    if not _given(argv, '--decode_workers'):
+        FLAGS.decode_workers = os.cpu_count() or FLAGS.decode_workers
+    tf_operations.download_and_extract_model_if_needed()
+    tf_operations.start_warm_up(background = False)
+    if not tf_operations.wait_until_ready():
+        sys.exit('model failed to load: %s' % tf_operations.readiness()['error'])
+
+    if is_image_file(FLAGS.image_file):
+        print(json.dumps(classify_file(FLAGS.image_file), indent = 2))
+        return
+
+    output = args.bulk_output or FLAGS.image_file.rsplit('.', 1)[0] + '.results.jsonl'
+    output_format = args.bulk_format or ('parquet' if output.endswith('.parquet') else 'jsonl')
+    counts = classify_manifest(FLAGS.image_file, output, output_format,
+                               args.manifest_format or None, args.checkpoint_every,
+                               args.restart)
+    print('%(done)d images classified, %(failed)d failed, %(skipped)d already done' % counts)
+    print('results written to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
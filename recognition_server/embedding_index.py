@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: store image embeddings and find similar images
+
+The engine can return the 2048-d pool_3 layer of each image it classifies,
+the same forward pass as its predictions. EmbeddingIndex keeps these vectors,
+L2-normalised so that a dot product is the cosine similarity, in one compact
+float16 or float32 array. On disk the array is a memory-mapped file, which
+grows by doubling, and a small SQLite database maps rows to content hashes
+and image IDs to content hashes. Identical images share one vector, so an
+image whose results came from the cache can be linked to its vector without
+running inference again.
+
+Searches are brute force at first: the query is multiplied with the whole
+array, a chunk at a time, and argpartition picks the best rows. Once the
+index is large, an IVF (inverted file) index is built with k-means, and only
+the rows in the clusters nearest the query are compared.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+import numpy as np
+
+
+# rows compared at a time by a brute force search, bounds temporary memory
+SEARCH_CHUNK = 65536
+# rows the first memory-mapped file has room for
+INITIAL_CAPACITY = 1024
+
+
+def normalise(vectors):
+    """returns float32 copies of vectors scaled to unit length"""
+    vectors = np.asarray(vectors, dtype = np.float32)
+    norms = np.linalg.norm(vectors, axis = -1, keepdims = True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def best_k(scores, k):
+    """returns the indices of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype = np.int64)
+    if k < len(scores):
+        top = np.argpartition(scores, len(scores) - k)[-k:]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind = 'stable')]
+
+
+def kmeans(vectors, num_clusters, iterations = 10, seed = 0):
+    """
+    clusters unit vectors by cosine similarity (spherical k-means). Returns
+    the normalised centroids, shape (num_clusters, dim)
+    """
+    rng = np.random.RandomState(seed)
+    num_clusters = min(num_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace = False)]
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis = 1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = ~sums.any(axis = 1)
+        # restart empty clusters from random vectors
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = normalise(sums)
+    return centroids
+
+
+class IVFIndex(object):
+    """
+    inverted file index over the rows of an EmbeddingIndex: each row belongs
+    to the cluster with the nearest centroid, and a search only looks at the
+    rows of the num_probes clusters nearest the query
+    """
+
+    # most vectors k-means is trained on
+    max_training_rows = 20000
+
+    def __init__(self, vectors, num_clusters, num_probes):
+        self.num_probes = max(1, int(num_probes))
+        sample = vectors
+        if len(vectors) > self.max_training_rows:
+            rows = np.random.RandomState(0).choice(
+                len(vectors), self.max_training_rows, replace = False)
+            sample = vectors[np.sort(rows)]
+        self.centroids = kmeans(normalise(sample), num_clusters)
+        self.lists = [[] for _ in range(len(self.centroids))]
+        self.num_rows = 0
+        self.add(vectors, 0)
+
+    def add(self, vectors, first_row):
+        """assigns new rows, starting at first_row, to their nearest cluster"""
+        for start in range(0, len(vectors), SEARCH_CHUNK):
+            chunk = np.asarray(vectors[start:start + SEARCH_CHUNK], dtype = np.float32)
+            assignment = np.argmax(chunk @ self.centroids.T, axis = 1)
+            for offset, cluster in enumerate(assignment):
+                self.lists[cluster].append(first_row + start + offset)
+        self.num_rows = first_row + len(vectors)
+
+    def candidates(self, query):
+        """returns the rows in the clusters nearest the query, sorted"""
+        nearest = best_k(self.centroids @ query, self.num_probes)
+        rows = [row for cluster in nearest for row in self.lists[cluster]]
+        return np.sort(np.array(rows, dtype = np.int64))
+
+
+class EmbeddingIndex(object):
+    """
+    thread-safe store of unit-length image embeddings, keyed by image content
+    hash, with image IDs linked to content hashes and nearest neighbour search.
+    With no path everything is kept in memory. Several processes may open the
+    same path: rows are handed out inside a SQLite write transaction, the
+    vector file is mapped shared, and each process picks up rows and links
+    written by the others before it reads
+    """
+
+    def __init__(self, path = None, dim = 2048, dtype = 'float16', model_key = '',
+                 ivf_min_size = 50000, ivf_clusters = 0, ivf_probes = 8):
+        self.path = path or None
+        self.dim = int(dim)
+        self.dtype = np.dtype(dtype)
+        self.model_key = model_key
+        self.ivf_min_size = int(ivf_min_size)
+        self.ivf_clusters = int(ivf_clusters)
+        self.ivf_probes = int(ivf_probes)
+        self._lock = threading.RLock()
+        self._ivf = None
+        self._vectors = None
+        # content hash -> row, and row -> content hash
+        self._rows = {}
+        self._hashes = []
+        # image id -> content hash, and content hash -> set of image ids
+        self._links = {}
+        self._linked = {}
+        # last link change seen, and SQLite's counter of other connections' commits
+        self._link_seq = 0
+        self._data_version = None
+
+        if self.path:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            self._conn = sqlite3.connect(os.path.join(self.path, 'index.db'),
+                                         check_same_thread = False, timeout = 30)
+        else:
+            self._conn = sqlite3.connect(':memory:', check_same_thread = False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta ('
+                               'name TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS vectors ('
+                               'row INTEGER PRIMARY KEY, hash TEXT UNIQUE NOT NULL)')
+            # an empty hash marks a removed link. seq orders the changes, so 
+            # other processes only need to read what changed since they last looked
+            columns = [row[1] for row in
+                       self._conn.execute('PRAGMA table_info(links)').fetchall()]
+            if columns and 'seq' not in columns:
+                self._conn.execute('DROP TABLE links')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS links ('
+                               'img_id INTEGER PRIMARY KEY, hash TEXT NOT NULL, '
+                               'seq INTEGER NOT NULL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS links_seq ON links (seq)')
+            self._check_meta()
+        self._refresh()
+
+    def _check_meta(self):
+        """clears the index if it was made by another model or layout"""
+        rows = self._conn.execute('SELECT name, value FROM meta').fetchall()
+        meta = dict((name, json.loads(value)) for name, value in rows)
+        expected = {'dim': self.dim, 'dtype': self.dtype.name,
+                    'model_key': self.model_key}
+        if any(meta.get(name, value) != value for name, value in expected.items()):
+            # vectors from another model can't be compared with new ones
+            self._conn.execute('DELETE FROM vectors')
+            self._conn.execute('DELETE FROM links')
+            if self.path and os.path.exists(self._vectors_path()):
+                os.remove(self._vectors_path())
+        self._conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                               [(name, json.dumps(value))
+                                for name, value in expected.items()])
+
+    def _vectors_path(self):
+        return os.path.join(self.path, 'vectors.bin')
+
+    def _refresh(self):
+        """
+        reads rows and links added since the last refresh, by this or other 
+        processes. Only queries the tables if another connection committed
+        """
+        with self._lock:
+            version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            if version == self._data_version:
+                return
+            self._data_version = version
+            first_row = len(self._hashes)
+            rows = self._conn.execute('SELECT row, hash FROM vectors WHERE row >= ? '
+                                      'ORDER BY row', (first_row,)).fetchall()
+            for row, content_hash in rows:
+                self._rows[content_hash] = row
+                self._hashes.append(content_hash)
+            self._map(len(self._hashes))
+            if rows and self._ivf is not None:
+                self._ivf.add(self._vectors[first_row:len(self._hashes)], first_row)
+            changes = self._conn.execute('SELECT img_id, hash, seq FROM links '
+                                         'WHERE seq > ? ORDER BY seq',
+                                         (self._link_seq,)).fetchall()
+            for img_id, content_hash, seq in changes:
+                self._set_link(img_id, content_hash)
+                self._link_seq = seq
+
+    def _map(self, count):
+        """makes sure the vector array has room for count rows, doubling it"""
+        old = self._vectors
+        if old is not None and len(old) >= count:
+            return
+        capacity = max(count, INITIAL_CAPACITY)
+        if old is not None:
+            capacity = max(capacity, 2 * len(old))
+        if not self.path:
+            vectors = np.zeros((capacity, self.dim), dtype = self.dtype)
+            if old is not None:
+                vectors[:len(old)] = old
+            self._vectors = vectors
+            return
+        row_bytes = self.dim * self.dtype.itemsize
+        path = self._vectors_path()
+        with open(path, 'ab') as f:
+            # another process may already have made the file bigger
+            size = max(os.fstat(f.fileno()).st_size, capacity * row_bytes)
+            f.truncate(size)
+        if old is not None:
+            old.flush()
+        self._vectors = np.memmap(path, dtype = self.dtype, mode = 'r+',
+                                  shape = (size // row_bytes, self.dim))
+
+    def _set_link(self, img_id, content_hash):
+        old_hash = self._links.pop(img_id, None)
+        if old_hash is not None:
+            ids = self._linked[old_hash]
+            ids.discard(img_id)
+            if not ids:
+                del self._linked[old_hash]
+        if content_hash:
+            self._links[img_id] = content_hash
+            self._linked.setdefault(content_hash, set()).add(img_id)
+
+    def add(self, content_hash, vector):
+        """stores the embedding of the image with content_hash, if it is new"""
+        self.add_many([(content_hash, vector)])
+
+    def add_many(self, pairs):
+        """stores embeddings from (content_hash, vector) pairs, in one write"""
+        with self._lock:
+            self._refresh()
+            pairs = [(content_hash, vector) for content_hash, vector in pairs
+                     if content_hash not in self._rows]
+            if not pairs:
+                return
+            with self._conn:
+                # takes the write lock, so no other process hands out these rows
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._refresh()
+                first_row = len(self._hashes)
+                new = []
+                seen = set()
+                for content_hash, vector in pairs:
+                    if content_hash not in self._rows and content_hash not in seen:
+                        seen.add(content_hash)
+                        new.append((content_hash, vector))
+                if not new:
+                    return
+                self._map(first_row + len(new))
+                # vectors are written before the rows are committed, so a 
+                # reader never sees a row without its vector
+                vectors = normalise([vector for _, vector in new])
+                self._vectors[first_row:first_row + len(new)] = vectors
+                for offset, (content_hash, _) in enumerate(new):
+                    self._rows[content_hash] = first_row + offset
+                    self._hashes.append(content_hash)
+                self._conn.executemany(
+                    'INSERT INTO vectors VALUES (?, ?)',
+                    [(first_row + offset, content_hash)
+                     for offset, (content_hash, _) in enumerate(new)])
+            if self._ivf is not None:
+                self._ivf.add(vectors, first_row)
+
+    def __contains__(self, content_hash):
+        self._refresh()
+        return content_hash in self._rows
+
+    def __len__(self):
+        self._refresh()
+        return len(self._hashes)
+
+    def get(self, content_hash):
+        """returns the stored unit vector of a content hash, or None"""
+        with self._lock:
+            self._refresh()
+            row = self._rows.get(content_hash)
+            if row is None:
+                return None
+            return np.array(self._vectors[row], dtype = np.float32)
+
+    def link(self, img_id, content_hash):
+        """records that an image has the given content"""
+        self.link_many([(img_id, content_hash)])
+
+    def link_many(self, pairs):
+        """records (img_id, content_hash) pairs, in one write"""
+        self._write_links(pairs)
+
+    def unlink(self, img_id):
+        """forgets the content of a deleted image. Its vector is kept"""
+        self._write_links([(img_id, '')])
+
+    def _write_links(self, pairs):
+        if not pairs:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                seq = self._conn.execute(
+                    'SELECT COALESCE(MAX(seq), 0) FROM links').fetchone()[0]
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO links VALUES (?, ?, ?)',
+                    [(img_id, content_hash, seq + i + 1)
+                     for i, (img_id, content_hash) in enumerate(pairs)])
+            # picks up these links, and any written by other processes
+            self._data_version = None
+            self._refresh()
+
+    def image_hash(self, img_id):
+        """returns the content hash linked to an image, or None"""
+        self._refresh()
+        return self._links.get(img_id)
+
+    def _search_rows(self, query, k):
+        """returns (rows, scores) of the k rows most similar to a unit vector"""
+        count = len(self._hashes)
+        if self.ivf_min_size > 0 and count >= self.ivf_min_size:
+            if self._ivf is None or count > 2 * self._ivf.num_rows:
+                # (re)train once the index has doubled since the clusters were made
+                clusters = self.ivf_clusters or int(np.sqrt(count))
+                self._ivf = IVFIndex(self._vectors[:count], clusters, self.ivf_probes)
+            rows = self._ivf.candidates(query)
+            scores = np.asarray(self._vectors[rows], dtype = np.float32) @ query
+            top = best_k(scores, k)
+            return rows[top], scores[top]
+
+        rows = np.zeros(0, dtype = np.int64)
+        scores = np.zeros(0, dtype = np.float32)
+        for start in range(0, count, SEARCH_CHUNK):
+            chunk = np.asarray(self._vectors[start:min(count, start + SEARCH_CHUNK)],
+                               dtype = np.float32)
+            chunk_scores = chunk @ query
+            top = best_k(chunk_scores, k)
+            # keep the best k seen so far
+            rows = np.concatenate([rows, top + start])
+            scores = np.concatenate([scores, chunk_scores[top]])
+            best = best_k(scores, k)
+            rows, scores = rows[best], scores[best]
+        return rows, scores
+
+    def search(self, vector, k = 10, exclude_id = None):
+        """
+        finds the k images most similar to a vector. Returns a list of
+        (img_id, score) pairs, best first, where score is the cosine
+        similarity. Images with the same content have the same score
+        """
+        query = normalise(vector)
+        with self._lock:
+            self._refresh()
+            want = k
+            while True:
+                rows, scores = self._search_rows(query, want)
+                results = []
+                for row, score in zip(rows.tolist(), scores.tolist()):
+                    for img_id in sorted(self._linked.get(self._hashes[row], ())):
+                        if img_id != exclude_id:
+                            results.append((img_id, score))
+                # rows without linked images don't count, so look further
+                if len(results) >= k or len(rows) < want:
+                    return results[:k]
+                want *= 2
+
+    def similar(self, img_id, k = 10):
+        """
+        finds the k images most similar to an image. Returns a list of
+        (img_id, score) pairs, or None if the image has no embedding
+        """
+        with self._lock:
+            content_hash = self.image_hash(img_id)
+            vector = None if content_hash is None else self.get(content_hash)
+            if vector is None:
+                return None
+            return self.search(vector, k, exclude_id = img_id)
+
+    def flush(self):
+        """writes the memory-mapped vectors to disk"""
+        with self._lock:
+            if isinstance(self._vectors, np.memmap):
+                self._vectors.flush()
+
+    def close(self):
+        """flushes the vectors and closes the database"""
+        with self._lock:
+            self.flush()
+            self._conn.close()
+
+    def stats(self):
+        """returns index sizes as a dictionary"""
+        with self._lock:
+            self._refresh()
+            return {
+                'vectors': len(self._hashes),
+                'images': len(self._links),
+                'capacity': len(self._vectors),
+                'dtype': self.dtype.name,
+                'ivf_clusters': 0 if self._ivf is None else len(self._ivf.centroids)
+            }
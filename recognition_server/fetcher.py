@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: download images into memory, with size and time limits
+
+Images are streamed straight into memory rather than to a temporary file, and
+checked from their first bytes: the magic number must be that of a JPEG, PNG
+or GIF file, and PIL must be able to read the image header. The image is not
+decoded here. The downloaded bytes are returned as one bytes object, which is
+handed on to the model as is, without further copies or reads. Downloads go
+through a shared HTTPPool, so connections to the same host are reused.
+"""
+
+import io
+import time
+import threading
+from PIL import Image
+try:
+    from recognition_server import http_pool
+    from recognition_server import metrics
+except:
+    import http_pool
+    import metrics
+
+
+# magic numbers at the start of accepted image files
+MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif')
+]
+
+# bytes read from the response at a time
+CHUNK_SIZE = 64 * 1024
+
+# pool used when fetch_image is not given one
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+class FetchError(Exception):
+    """raised when an image cannot be fetched. error_dict is the API error"""
+
+    def __init__(self, message):
+        Exception.__init__(self, message)
+        self.error_dict = {"error": message}
+
+
+class FetchedImage(object):
+    """the bytes and response headers of a downloaded image"""
+
+    def __init__(self, data, headers, image_format = None, not_modified = False):
+        self.data = data
+        self.headers = headers
+        self.format = image_format
+        # True if a conditional request found the image unchanged
+        self.not_modified = not_modified
+
+
+def sniff_format(data):
+    """returns 'jpg', 'png' or 'gif' from the magic number of data, or None"""
+    for magic, image_format in MAGIC_NUMBERS:
+        if data[:len(magic)] == magic:
+            return image_format
+    return None
+
+
+def check_image_data(data):
+    """
+    checks that data looks like an accepted image, from its magic number and
+    header only. Returns the image format. Raises FetchError if not
+    """
+    image_format = sniff_format(data)
+    if image_format is None:
+        raise FetchError("file cannot be opened")
+    try:
+        # only reads the header, the image is decoded later
+        Image.open(io.BytesIO(data))
+    except (IOError, OSError, SyntaxError, ValueError):
+        raise FetchError("file cannot be opened")
+    return image_format
+
+
+def read_limited(response, max_bytes):
+    """
+    reads a response body into memory, a chunk at a time, stopping as soon as
+    it is bigger than max_bytes or does not start with an image magic number.
+    Chunks are read with read1, so the response's deadline is checked after
+    whatever has arrived rather than once per full chunk
+    """
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        raise FetchError("image too large")
+    chunks = []
+    size = 0
+    while True:
+        chunk = response.read1(CHUNK_SIZE)
+        if not chunk:
+            break
+        if not chunks and sniff_format(chunk) is None and len(chunk) >= 8:
+            # not an image, so don't download the rest
+            raise FetchError("file cannot be opened")
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_bytes:
+            raise FetchError("image too large")
+    return b''.join(chunks)
+
+
+def get_default_pool():
+    """returns the HTTPPool used when fetch_image is not given one"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = http_pool.HTTPPool()
+        return _default_pool
+
+
+def fetch_image(url, max_bytes = 20 * 1024 * 1024, request_headers = None,
+                pool = None):
+    """
+    downloads the image at url into memory and checks it. request_headers,
+    such as If-None-Match, are sent with the request. The pool's timeout and
+    retry settings apply, the timeout to the whole download and not just to
+    each socket operation. Returns a FetchedImage, with not_modified set if the 
+    server answered 304. Raises FetchError
+    """
+    if pool is None:
+        pool = get_default_pool()
+    start = time.perf_counter()
+    try:
+        with pool.get(url, request_headers) as response:
+            if response.status == 304:
+                return FetchedImage(None, dict(response.headers.items()),
+                                    not_modified = True)
+            if response.status >= 400:
+                raise FetchError("invalid URL")
+            data = read_limited(response, max_bytes)
+            headers = dict(response.headers.items())
+    except FetchError:
+        raise
+    except Exception:
+        # bad address, refused connection, timeout etc.
+        raise FetchError("invalid URL")
+    finally:
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - start, stage = 'fetch')
+    with metrics.STAGE_SECONDS.time(stage = 'validate'):
+        image_format = check_image_data(data)
+    return FetchedImage(data, headers, image_format)
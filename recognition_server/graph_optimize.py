@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: offline optimisation and quantisation of the Inception graph
+
+The 2015 classify_image_graph_def.pb is imported as it was saved, with the
+JPEG decoding ops, Identity and CheckNumerics nodes, and batch norms kept as
+separate ops. optimize_graph() rewrites it once with TensorFlow's graph
+transforms and saves the result next to the original in the model directory,
+where --model_variant picks it up at startup:
+
+    optimized   unused nodes stripped, constants and batch norms folded
+    fp16        as optimized, with large weights stored as float16
+    quantized   as optimized, with eight-bit weights and eight-bit ops
+
+Quantised variants trade some agreement with the original model for a
+smaller file and, depending on the CPU, lower latency. The trade is measured
+by an accuracy report on a local set of images:
+
+    python -m recognition_server.graph_optimize --model_variant quantized \\
+        --report_images /path/to/images --report_file report.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+try:
+    from recognition_server import postprocess
+    from recognition_server import lazy_module
+except:
+    import postprocess
+    import lazy_module
+
+
+# imported on first use, so ensure_variant('original') doesn't need TensorFlow
+tf = lazy_module.LazyModule('tensorflow')
+
+
+GRAPH_FILE = 'classify_image_graph_def.pb'
+# the engine feeds images at Mul and reads pool_3, softmax weights and biases
+INPUTS = ['Mul']
+OUTPUTS = ['pool_3', 'softmax']
+
+# graph transforms applied by every variant
+OPTIMIZE_TRANSFORMS = [
+    'strip_unused_nodes(type=float)',
+    'remove_nodes(op=Identity, op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+    'sort_by_execution_order'
+]
+
+VARIANTS = {
+    'original': None,
+    'optimized': OPTIMIZE_TRANSFORMS,
+    'fp16': OPTIMIZE_TRANSFORMS,
+    'quantized': OPTIMIZE_TRANSFORMS[:-1] + [
+        'quantize_weights',
+        'quantize_nodes',
+        'strip_unused_nodes(type=float)',
+        'sort_by_execution_order'
+    ]
+}
+
+# weights with fewer values than this stay float32 in the fp16 variant
+HALF_MIN_ELEMENTS = 1024
+
+
+def variant_path(model_dir, variant = 'original'):
+    """returns the path of a model variant's GraphDef file"""
+    if variant not in VARIANTS:
+        raise ValueError('unknown model variant %r, use one of %s'
+                         % (variant, ', '.join(sorted(VARIANTS))))
+    if variant == 'original':
+        return os.path.join(model_dir, GRAPH_FILE)
+    return os.path.join(model_dir, 'classify_image_graph_def.%s.pb' % variant)
+
+
+def load_graph_def(path):
+    """reads a GraphDef file"""
+    graph_def = tf.GraphDef()
+    with tf.gfile.FastGFile(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+def weights_to_half(graph_def, min_elements = HALF_MIN_ELEMENTS):
+    """
+    stores large float32 constants as float16, each followed by a Cast back to
+    float32 under the original name, so the rest of the graph is unchanged.
+    Halves the size of the weights, not the arithmetic
+    """
+    from tensorflow.python.framework import tensor_util
+    half_graph = tf.GraphDef()
+    half_graph.versions.CopyFrom(graph_def.versions)
+    half_graph.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if (node.op == 'Const' and
+                node.attr['dtype'].type == tf.float32.as_datatype_enum):
+            value = tensor_util.MakeNdarray(node.attr['value'].tensor)
+            if value.size >= min_elements:
+                half = half_graph.node.add()
+                half.op = 'Const'
+                half.name = node.name + '/half'
+                half.device = node.device
+                half.attr['dtype'].type = tf.float16.as_datatype_enum
+                half.attr['value'].tensor.CopyFrom(
+                    tf.make_tensor_proto(value.astype(np.float16)))
+                cast = half_graph.node.add()
+                cast.op = 'Cast'
+                cast.name = node.name
+                cast.device = node.device
+                cast.input.append(half.name)
+                cast.attr['SrcT'].type = tf.float16.as_datatype_enum
+                cast.attr['DstT'].type = tf.float32.as_datatype_enum
+                continue
+        half_graph.node.add().CopyFrom(node)
+    return half_graph
+
+
+def optimize_graph(source_path, dest_path, variant):
+    """
+    applies a variant's transforms to the GraphDef at source_path and writes
+    the result to dest_path. Returns the number of nodes before and after
+    """
+    from tensorflow.tools.graph_transforms import TransformGraph
+    graph_def = load_graph_def(source_path)
+    optimized = TransformGraph(graph_def, INPUTS, OUTPUTS, VARIANTS[variant])
+    if variant == 'fp16':
+        optimized = weights_to_half(optimized)
+    # write to a temporary file first, so a reader never sees half a file
+    tmp_path = '%s.%d.tmp' % (dest_path, os.getpid())
+    with tf.gfile.FastGFile(tmp_path, 'wb') as f:
+        f.write(optimized.SerializeToString())
+    os.replace(tmp_path, dest_path)
+    tf.logging.info('wrote %s variant %s: %d nodes -> %d nodes, %.1f MB',
+                    variant, dest_path, len(graph_def.node), len(optimized.node),
+                    os.path.getsize(dest_path) / 1e6)
+    return len(graph_def.node), len(optimized.node)
+
+
+def variant_current(model_dir, variant):
+    """whether a model variant exists and is newer than the original graph"""
+    source_path = variant_path(model_dir, 'original')
+    path = variant_path(model_dir, variant)
+    if path == source_path:
+        return True
+    return (os.path.exists(path) and
+            os.path.getmtime(path) >= os.path.getmtime(source_path))
+
+
+def ensure_variant(model_dir, variant):
+    """
+    returns the path of a model variant, creating it from the original graph
+    if it is missing or older than the original
+    """
+    path = variant_path(model_dir, variant)
+    if not variant_current(model_dir, variant):
+        optimize_graph(variant_path(model_dir, 'original'), path, variant)
+    return path
+
+
+def ensure_variant_in_subprocess(model_dir, variant):
+    """
+    ensure_variant, run by this module in a child process when the variant
+    needs building, so TensorFlow is not imported here. For a server which
+    forks its workers afterwards. Returns the path of the variant
+    """
+    if not variant_current(model_dir, variant):
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               '--model_dir', model_dir, '--model_variant', variant])
+    return variant_path(model_dir, variant)
+
+
+def list_images(image_dir):
+    """returns the sorted paths of the JPEG, PNG and GIF files in image_dir"""
+    names = sorted(os.listdir(image_dir))
+    return [os.path.join(image_dir, name) for name in names
+            if name.lower().rsplit('.', 1)[-1] in ('jpg', 'jpeg', 'png', 'gif')]
+
+
+def time_predictions(engine, batches):
+    """
+    runs batches of preprocessed images through an engine, once to warm up
+    and once timed. Returns the stacked predictions and seconds per image
+    """
+    engine.predict_batch(batches[0], False)
+    start = time.time()
+    predictions = [engine.predict_batch(batch, False) for batch in batches]
+    num_images = sum(len(batch) for batch in batches)
+    return np.concatenate(predictions), (time.time() - start) / num_images
+
+
+def accuracy_report(image_paths, reference, candidate, batch_size = 16, k = 5):
+    """
+    compares the predictions of two engines, e.g. the original and a
+    quantised model, on a list of local image files. Returns a dictionary
+    with the top-1 and top-k agreement of the candidate with the reference,
+    and the CPU latency per image of each
+    """
+    tensors = []
+    for path in image_paths:
+        with open(path, 'rb') as f:
+            tensors.append(reference.preprocess(f.read()))
+    if not tensors:
+        raise ValueError('no images to compare')
+    batches = [tensors[i:i + batch_size] for i in range(0, len(tensors), batch_size)]
+    reference_predictions, reference_latency = time_predictions(reference, batches)
+    candidate_predictions, candidate_latency = time_predictions(candidate, batches)
+
+    report = postprocess.top_k_agreement(reference_predictions, candidate_predictions, k)
+    report.update({
+        'num_images': len(tensors),
+        'reference_ms_per_image': round(reference_latency * 1000, 3),
+        'candidate_ms_per_image': round(candidate_latency * 1000, 3),
+        'speedup': round(reference_latency / max(candidate_latency, 1e-9), 3)
+    })
+    return report
+
+
+def main(argv = None):
+    """
+    builds a model variant and, given --report_images, writes an accuracy
+    report comparing it with the original model
+    """
+    try:
+        from recognition_server import tf_operations
+    except:
+        import tf_operations
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--report_images', type = str, default = '',
+                        help = 'Directory of images to compare the variant on.')
+    parser.add_argument('--report_file', type = str, default = '',
+                        help = 'File to write the JSON report to, default stdout.')
+    args, _ = parser.parse_known_args(argv)
+    tf_operations.parse_args()
+    FLAGS = tf_operations.FLAGS
+    tf.logging.set_verbosity(tf.logging.INFO)
+
+    # other models' directories have their own graph, and no tarball
+    if not os.path.exists(variant_path(FLAGS.model_dir, 'original')):
+        tf_operations.download_and_extract_model_if_needed()
+    path = ensure_variant(FLAGS.model_dir, FLAGS.model_variant)
+    if not args.report_images:
+        return
+
+    reference = tf_operations.InferenceEngine(
+        graph_path = variant_path(FLAGS.model_dir, 'original'),
+        intra_op_threads = FLAGS.intra_op_threads,
+        inter_op_threads = FLAGS.inter_op_threads)
+    candidate = tf_operations.InferenceEngine(
+        graph_path = path,
+        intra_op_threads = FLAGS.intra_op_threads,
+        inter_op_threads = FLAGS.inter_op_threads)
+    report = accuracy_report(list_images(args.report_images), reference, candidate,
+                             FLAGS.max_batch_size, FLAGS.num_top_predictions)
+    report['variant'] = FLAGS.model_variant
+    report['original_mb'] = round(os.path.getsize(reference.graph_path) / 1e6, 2)
+    report['variant_mb'] = round(os.path.getsize(path) / 1e6, 2)
+    text = json.dumps(report, indent = 2, sort_keys = True)
+    if args.report_file:
+        with open(args.report_file, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
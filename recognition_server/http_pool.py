@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: shared, connection-pooled HTTP client for image downloads
+
+Most images come from a few hosts, so opening a new TCP (and TLS) connection
+for every image wastes a large part of each download. HTTPPool keeps idle
+keep-alive connections per host and reuses them, limits how many requests run
+at once against each host, retries failed requests with exponential backoff,
+and keeps timing counters for DNS lookup, connecting and transfer.
+"""
+
+import time
+import socket
+import ssl
+import threading
+import http.client
+import urllib.parse
+
+
+# responses worth retrying, the server may be overloaded for a moment
+RETRY_STATUSES = (429, 502, 503, 504)
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+# bodies of redirects and retried responses up to this size are read, so the
+# connection can be reused; bigger ones are dropped with the connection
+DISCARD_BYTES = 64 * 1024
+
+
+class _TimedConnection(http.client.HTTPConnection):
+    """HTTP connection which times DNS lookup and connecting separately"""
+
+    def __init__(self, host, port, pool, timeout):
+        http.client.HTTPConnection.__init__(self, host, port, timeout = timeout)
+        self.pool = pool
+
+    def _open_socket(self):
+        start = time.time()
+        addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        resolved = time.time()
+        error = None
+        for family, socktype, proto, _, address in addresses:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(address)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                break
+            except OSError as e:
+                sock.close()
+                sock, error = None, e
+        if sock is None:
+            raise error or OSError('no addresses for %s' % self.host)
+        self.pool._add_time('dns', resolved - start)
+        return sock, resolved
+
+    def connect(self):
+        self.sock, resolved = self._open_socket()
+        self.pool._add_time('connect', time.time() - resolved)
+
+
+class _TimedHTTPSConnection(_TimedConnection):
+    """HTTPS connection, the TLS handshake is counted as connect time"""
+
+    default_port = http.client.HTTPS_PORT
+
+    def __init__(self, host, port, pool, timeout, context):
+        _TimedConnection.__init__(self, host, port, pool, timeout)
+        self.context = context
+
+    def connect(self):
+        sock, resolved = self._open_socket()
+        self.sock = self.context.wrap_socket(sock, server_hostname = self.host)
+        self.pool._add_time('connect', time.time() - resolved)
+
+
+class PooledResponse(object):
+    """
+    an HTTP response from an HTTPPool. The connection goes back to the pool
+    when the response is closed, if the body was read to the end. deadline is
+    the time.monotonic() time by which the body must have arrived: reads past
+    it raise socket.timeout, so a server sending the body a few bytes at a
+    time can't keep a download going for longer than the pool's timeout
+    """
+
+    def __init__(self, pool, key, conn, response, url, start, deadline = None):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._start = start
+        self._closed = False
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+        self.deadline = deadline
+
+    def _limit_wait(self):
+        """limits the next socket read to the time left before the deadline"""
+        if self.deadline is None:
+            return
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise socket.timeout('no complete response from %s after %s seconds'
+                                 % (self.url, self._pool.timeout))
+        if self._conn.sock is not None:
+            self._conn.sock.settimeout(remaining)
+
+    def read(self, amt = None):
+        self._limit_wait()
+        return self._response.read(amt)
+
+    def read1(self, amt = -1):
+        """
+        returns whatever data has arrived, up to amt bytes, without waiting for
+        more. Reading with read1 keeps to the deadline, as each call waits on
+        the socket at most once
+        """
+        self._limit_wait()
+        return self._response.read1(amt)
+
+    def discard(self):
+        """
+        closes a response whose body isn't wanted. A body of up to 
+        DISCARD_BYTES, by its Content-Length, is read so the connection can 
+        be reused; otherwise the connection is closed rather than read
+        """
+        length = self.headers.get('Content-Length')
+        if length is not None and length.isdigit() and int(length) <= DISCARD_BYTES:
+            self.read()
+        self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._pool._add_time('transfer', time.time() - self._start)
+        if self._conn.sock is not None:
+            # _limit_wait may have shortened it
+            self._conn.sock.settimeout(self._pool.timeout)
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._pool._release(self._key, self._conn, reusable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HTTPPool(object):
+    """
+    thread-safe pool of keep-alive HTTP and HTTPS connections, with a limit
+    on concurrent requests per host, retries and timing counters
+    """
+
+    def __init__(self, max_per_host = 8, timeout = 10.0, retries = 2,
+                 backoff = 0.1, ssl_context = None):
+        self.max_per_host = max(1, int(max_per_host))
+        self.timeout = timeout
+        self.retries = max(0, int(retries))
+        self.backoff = backoff
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self._lock = threading.Lock()
+        # (scheme, host, port) -> list of idle connections
+        self._idle = {}
+        # (scheme, host, port) -> semaphore limiting requests in flight
+        self._slots = {}
+        self.counters = dict.fromkeys(
+            ['requests', 'retries', 'connections_opened', 'connections_reused',
+             'dns_time', 'connect_time', 'transfer_time'], 0)
+
+    def _add_time(self, name, seconds):
+        with self._lock:
+            self.counters[name + '_time'] += seconds
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _slot(self, key):
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = threading.BoundedSemaphore(self.max_per_host)
+            return slot
+
+    def _acquire(self, key):
+        """takes an idle connection for key, or opens a new one"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self.counters['connections_reused'] += 1
+                return idle.pop(), True
+            self.counters['connections_opened'] += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            return _TimedHTTPSConnection(host, port, self, self.timeout,
+                                         self.ssl_context), False
+        return _TimedConnection(host, port, self, self.timeout), False
+
+    def _release(self, key, conn, reusable):
+        """returns a connection to the pool, or closes it"""
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_per_host:
+                    idle.append(conn)
+                    conn = None
+        if conn is not None:
+            conn.close()
+        self._slot(key).release()
+
+    def get(self, url, headers = None):
+        """
+        sends a GET request and returns a PooledResponse, once the headers
+        have arrived. Redirects are followed. Connection errors and some 5xx
+        responses are retried with exponential backoff. The response must be
+        closed, or used as a context manager
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._get_once(url, headers)
+            location = response.headers.get('Location')
+            if response.status not in REDIRECT_STATUSES or not location:
+                return response
+            response.discard()
+            url = urllib.parse.urljoin(url, location)
+        raise http.client.HTTPException('too many redirects for %s' % url)
+
+    def _get_once(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('unsupported URL %s' % url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        self._count('requests')
+
+        attempt = 0
+        while True:
+            slot = self._slot(key)
+            slot.acquire()
+            conn, reused = self._acquire(key)
+            start = time.time()
+            # the timeout also applies to each attempt as a whole, from
+            # connecting to the end of the body, as in AsyncHTTPPool
+            deadline = time.monotonic() + self.timeout if self.timeout else None
+            try:
+                conn.request('GET', path, headers = headers or {})
+                if deadline is not None:
+                    # the headers must also arrive in what is left of it
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout('no response from %s after %s seconds'
+                                             % (url, self.timeout))
+                    conn.sock.settimeout(remaining)
+                response = conn.getresponse()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                slot.release()
+                # a reused connection may have been closed by the server
+                # while idle, so try again at once on a fresh one
+                if reused:
+                    continue
+                if attempt >= self.retries:
+                    raise
+            else:
+                pooled = PooledResponse(self, key, conn, response, url, start,
+                                        deadline)
+                if response.status not in RETRY_STATUSES or attempt >= self.retries:
+                    return pooled
+                pooled.discard()
+            attempt += 1
+            self._count('retries')
+            time.sleep(self.backoff * (2 ** (attempt - 1)))
+
+    def close(self):
+        """closes all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def stats(self):
+        """returns request, connection and timing counters as a dictionary"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['idle_connections'] = sum(len(c) for c in self._idle.values())
+        return stats
@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: indexed, thread-safe storage for the server's image records
+
+Image records are kept in a dictionary keyed by image ID, so finding or
+deleting an image does not scan the whole list. IDs come from a counter which
+only goes up, so they are never reused, even after the newest image is
+deleted. A second index holds the IDs of images which have not had inference
+run on them yet, so fetching the undone images only costs as much as the
+number of undone images.
+
+Two storage backends share the same interface: ImageStore keeps records in
+memory, and SQLiteImageStore keeps them in a local SQLite database, so the
+task list and its results survive a restart and history size does not grow 
+memory. open_store() picks a backend from a command line setting.
+
+Records are ImageRecord objects, with a fixed set of fields in __slots__
+rather than a dictionary each, and inference results are kept as
+postprocess.CompactResults arrays. Both still read like dictionaries.
+"""
+
+import threading
+import bisect
+import sqlite3
+import json
+import os
+from collections.abc import Mapping
+try:
+    from recognition_server import postprocess
+except:
+    import postprocess
+
+
+class ImageRecord(Mapping):
+    """
+    one image: 'id', 'title', 'url', 'results', 'resize' and 'size'. Reads
+    like a read-only dictionary, e.g. record['url'], dict(record) or 
+    json encoding through to_dict(), and fields can be set with
+    record['results'] = ... or update()
+    """
+
+    __slots__ = ('id', 'title', 'url', 'results', 'resize', 'size')
+
+    def __init__(self, id, title = "", url = "", results = "", resize = False,
+                 size = ""):
+        self.id = id
+        self.title = title
+        self.url = url
+        self.results = results
+        self.resize = resize
+        self.size = size
+
+    @classmethod
+    def from_dict(cls, image):
+        return cls(**image)
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def update(self, fields):
+        for name, value in fields.items():
+            self[name] = value
+
+    def to_dict(self):
+        return {'id': self.id, 'title': self.title, 'url': self.url,
+                'results': self.results, 'resize': self.resize, 'size': self.size}
+
+    def __repr__(self):
+        return 'ImageRecord(%r)' % self.to_dict()
+
+
+def dump_results(results):
+    """results as JSON text for the database, '' for pending images"""
+    if results == '':
+        return ''
+    return json.dumps(results, default = postprocess.json_default)
+
+
+def load_results(text):
+    """reads results stored by dump_results, including older dictionaries"""
+    if not text:
+        return ''
+    return json.loads(text, object_hook = postprocess.json_object_hook)
+
+
+class ImageStore(object):
+    """
+    stores image records, as ImageRecord objects with 'id', 'title', 'url',
+    'results', 'resize' and 'size' fields. An image with empty results is
+    pending, i.e. inference has not been run on it
+    """
+
+    def __init__(self, images = None):
+        self._images = {}
+        # sorted IDs of all images and of pending images, so a page of them
+        # is found by bisection without copying the rest
+        self._ids = []
+        self._pending = []
+        self._next_id = 1
+        self._lock = threading.RLock()
+        for img in images or []:
+            self._insert(ImageRecord.from_dict(img))
+
+    @staticmethod
+    def _index_add(ids, img_id):
+        """adds an ID to a sorted list of IDs, new IDs go on the end"""
+        if not ids or img_id > ids[-1]:
+            ids.append(img_id)
+            return
+        i = bisect.bisect_left(ids, img_id)
+        if i == len(ids) or ids[i] != img_id:
+            ids.insert(i, img_id)
+
+    @staticmethod
+    def _index_remove(ids, img_id):
+        i = bisect.bisect_left(ids, img_id)
+        if i < len(ids) and ids[i] == img_id:
+            del ids[i]
+
+    def _insert(self, image):
+        """adds a complete record, keeping its ID"""
+        with self._lock:
+            self._images[image['id']] = image
+            self._index_add(self._ids, image['id'])
+            if image['results'] == '':
+                self._index_add(self._pending, image['id'])
+            self._next_id = max(self._next_id, image['id'] + 1)
+        return image
+
+    def add(self, url, title = "", results = "", size = "", resize = False):
+        """adds a new image with the next unused ID. Returns its record"""
+        with self._lock:
+            image = ImageRecord(self._next_id, title, url, results, resize, size)
+            return self._insert(image)
+
+    def add_many(self, rows):
+        """
+        adds new images, given as dictionaries of add()'s arguments, with the
+        next unused IDs. Returns their records, in the same order
+        """
+        with self._lock:
+            return [self.add(**row) for row in rows]
+
+    def get(self, img_id):
+        """returns the record of an image, or None if there is no such image"""
+        return self._images.get(img_id)
+
+    def delete(self, img_id):
+        """deletes an image. Returns False if there was no such image"""
+        with self._lock:
+            if self._images.pop(img_id, None) is None:
+                return False
+            self._index_remove(self._ids, img_id)
+            self._index_remove(self._pending, img_id)
+            return True
+
+    def update(self, img_id, fields):
+        """
+        updates the 'results', 'size' and/or 'resize' fields of an image, and 
+        the index of pending images. Returns the updated record, or None if 
+        there is no such image (it may have been deleted while inference was
+        running)
+        """
+        with self._lock:
+            image = self._images.get(img_id)
+            if image is None:
+                return None
+            image.update(fields)
+            if image['results'] == '':
+                self._index_add(self._pending, img_id)
+            else:
+                self._index_remove(self._pending, img_id)
+            return image
+
+    def update_many(self, pairs):
+        """updates many images, given (img_id, fields) pairs"""
+        with self._lock:
+            for img_id, fields in pairs:
+                self.update(img_id, fields)
+
+    def set_results(self, img_id, results):
+        """stores inference results for an image, see update()"""
+        return self.update(img_id, {'results': results})
+
+    def set_results_many(self, pairs):
+        """stores inference results for many images, given (img_id, results) pairs"""
+        self.update_many([(img_id, {'results': results}) for img_id, results in pairs])
+
+    def undone(self):
+        """returns a list of the images which inference has not been run on"""
+        with self._lock:
+            return [self._images[img_id] for img_id in self._pending]
+
+    def undone_count(self):
+        """returns how many images inference has not been run on"""
+        return len(self._pending)
+
+    def all(self):
+        """returns a list of all images, in order of ID"""
+        with self._lock:
+            return list(self._images.values())
+
+    def iter_images(self, after_id = 0, page_size = 500, state = None):
+        """
+        yields images in order of ID, starting after after_id. Only one page 
+        of page_size images is copied at a time, found by bisecting the 
+        sorted IDs. state can be 'done' or 'undone' to only yield images 
+        which have, or have not, had inference
+        """
+        ids = self._pending if state == 'undone' else self._ids
+        while True:
+            with self._lock:
+                start = bisect.bisect_right(ids, after_id)
+                page = [self._images[img_id] for img_id in ids[start:start + page_size]]
+            for image in page:
+                if state != 'done' or image['results'] != '':
+                    yield image
+            if len(page) < page_size:
+                return
+            after_id = page[-1]['id']
+
+    def close(self):
+        """releases any resources held by the store"""
+        pass
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, img_id):
+        return img_id in self._images
+
+
+class SQLiteImageStore(object):
+    """
+    stores image records in a SQLite database, with the same interface as 
+    ImageStore. Results are stored as JSON text, and an index on the inference
+    state keeps fetching undone images fast. Records are only read from disk
+    when asked for, one page at a time when listing
+    """
+
+    def __init__(self, path, images = None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread = False)
+        with self._lock, self._conn:
+            created = not self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'images'"
+            ).fetchall()
+            # write-ahead logging lets a commit be one sequential write
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            # AUTOINCREMENT stops ids of deleted images being reused
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS images ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'title TEXT NOT NULL, '
+                'url TEXT NOT NULL, '
+                'results TEXT NOT NULL, '
+                'resize INTEGER NOT NULL, '
+                'size TEXT NOT NULL, '
+                'done INTEGER NOT NULL)')
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS images_done ON images (done, id)')
+        # only seed the initial images into a new database, not one which is
+        # empty because its images were deleted, or their ids would be reused
+        if images and created:
+            with self._lock, self._conn:
+                self._conn.executemany(
+                    'INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [self._to_row(img) for img in images])
+
+    _columns = 'id, title, url, results, resize, size'
+
+    @staticmethod
+    def _to_row(image):
+        results = image['results']
+        return (image['id'], image['title'], image['url'],
+                dump_results(results),
+                int(bool(image['resize'])), image['size'],
+                int(results != ''))
+
+    @staticmethod
+    def _from_row(row):
+        img_id, title, url, results, resize, size = row
+        return ImageRecord(img_id, title, url, load_results(results), bool(resize), size)
+
+    def _query(self, sql, args = ()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def add(self, url, title = "", results = "", size = "", resize = False):
+        """adds a new image with the next unused ID. Returns its record"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                'INSERT INTO images (title, url, results, resize, size, done) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (title, url, dump_results(results),
+                 int(bool(resize)), size, int(results != '')))
+            img_id = cursor.lastrowid
+        return ImageRecord(img_id, title, url, results, resize, size)
+
+    def add_many(self, rows):
+        """
+        adds new images, given as dictionaries of add()'s arguments, with the
+        next unused IDs, in a single transaction. Returns their records, in 
+        the same order
+        """
+        images = [ImageRecord(None, row.get('title', ""), row['url'],
+                              row.get('results', ""), row.get('resize', False),
+                              row.get('size', "")) for row in rows]
+        if not images:
+            return images
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO images (title, url, results, resize, size, done) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [self._to_row(image)[1:] for image in images])
+            # the transaction holds the write lock, so the ids handed out
+            # are the last len(images) of the sequence
+            last_id = self._conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'images'").fetchone()[0]
+        for img_id, image in enumerate(images, last_id - len(images) + 1):
+            image.id = img_id
+        return images
+
+    def get(self, img_id):
+        """returns the record of an image, or None if there is no such image"""
+        rows = self._query('SELECT %s FROM images WHERE id = ?' % self._columns,
+                           (img_id,))
+        if not rows:
+            return None
+        return self._from_row(rows[0])
+
+    def delete(self, img_id):
+        """deletes an image. Returns False if there was no such image"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute('DELETE FROM images WHERE id = ?', (img_id,))
+        return cursor.rowcount > 0
+
+    def update(self, img_id, fields):
+        """
+        updates the 'results', 'size' and/or 'resize' fields of an image. 
+        Returns the updated record, or None if there is no such image
+        """
+        self.update_many([(img_id, fields)])
+        return self.get(img_id)
+
+    def update_many(self, pairs):
+        """
+        updates many images, given (img_id, fields) pairs, in a single 
+        transaction
+        """
+        # group the rows by which fields they set, one statement per group
+        groups = {}
+        for img_id, fields in pairs:
+            columns = []
+            values = []
+            for name in sorted(fields):
+                value = fields[name]
+                if name == 'results':
+                    columns += ['results = ?', 'done = ?']
+                    values += [dump_results(value), int(value != '')]
+                elif name == 'resize':
+                    columns.append('resize = ?')
+                    values.append(int(bool(value)))
+                elif name == 'size':
+                    columns.append('size = ?')
+                    values.append(value)
+                else:
+                    raise KeyError('cannot update field %r' % name)
+            if columns:
+                groups.setdefault(', '.join(columns), []).append(values + [img_id])
+        if not groups:
+            return
+        with self._lock, self._conn:
+            for columns, rows in groups.items():
+                self._conn.executemany(
+                    'UPDATE images SET %s WHERE id = ?' % columns, rows)
+
+    def set_results(self, img_id, results):
+        """stores inference results for an image, see update()"""
+        return self.update(img_id, {'results': results})
+
+    def set_results_many(self, pairs):
+        """stores inference results for many images, given (img_id, results) pairs"""
+        self.update_many([(img_id, {'results': results}) for img_id, results in pairs])
+
+    def undone(self):
+        """returns a list of the images which inference has not been run on"""
+        rows = self._query('SELECT %s FROM images WHERE done = 0 ORDER BY id'
+                           % self._columns)
+        return [self._from_row(row) for row in rows]
+
+    def undone_count(self):
+        """returns how many images inference has not been run on"""
+        return self._query('SELECT COUNT(*) FROM images WHERE done = 0')[0][0]
+
+    def all(self):
+        """returns a list of all images, in order of ID"""
+        return list(self.iter_images())
+
+    def iter_images(self, after_id = 0, page_size = 500, state = None):
+        """
+        yields images in order of ID, starting after after_id. Only one page 
+        of page_size images is read from the database at a time. state can be 
+        'done' or 'undone' to only yield images which have, or have not, had 
+        inference
+        """
+        if state is None:
+            where = ''
+        else:
+            where = 'done = %d AND ' % int(state == 'done')
+        while True:
+            rows = self._query(
+                'SELECT %s FROM images WHERE %sid > ? ORDER BY id LIMIT ?'
+                % (self._columns, where), (after_id, page_size))
+            for row in rows:
+                yield self._from_row(row)
+            if len(rows) < page_size:
+                return
+            after_id = rows[-1][0]
+
+    def __len__(self):
+        return self._query('SELECT COUNT(*) FROM images')[0][0]
+
+    def __contains__(self, img_id):
+        return bool(self._query('SELECT 1 FROM images WHERE id = ?', (img_id,)))
+
+    def close(self):
+        """closes the database connection"""
+        with self._lock:
+            self._conn.close()
+
+
+def open_store(spec, images = None):
+    """
+    opens an image store from a command line setting: 'memory' for an 
+    in-memory store, or 'sqlite:<path>' for a SQLite database file. images 
+    are the initial records for a new, empty store
+    """
+    if spec == 'memory':
+        return ImageStore(images)
+    if spec.startswith('sqlite:'):
+        return SQLiteImageStore(spec[len('sqlite:'):], images)
+    raise ValueError('unknown image store %r, use memory or sqlite:<path>' % spec)
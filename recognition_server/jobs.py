@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: background jobs for bulk inference
+
+A JobManager runs bulk inference requests on a pool of background threads, so
+an HTTP request can return a job ID straight away. Each Job records its
+progress and the results finished so far, which clients can poll, or stream
+as each image completes.
+"""
+
+import threading
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+class Job(object):
+    """
+    progress and results of one bulk inference request. Results are appended
+    by the worker thread, and can be read while the job is still running
+    """
+
+    def __init__(self, total, id_prefix = ''):
+        self.id = id_prefix + uuid.uuid4().hex
+        self.status = 'queued'
+        self.total = total
+        self.results = []
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed')
+
+    def add_result(self, result):
+        """records one finished result and wakes up any streaming readers"""
+        with self._cond:
+            self.results.append(result)
+            self._cond.notify_all()
+
+    def _set_status(self, status, error = None):
+        with self._cond:
+            self.status = status
+            self.error = error
+            if self.done:
+                self.finished = time.time()
+            self._cond.notify_all()
+
+    def iter_results(self, timeout = None):
+        """
+        yields results in the order they finished, waiting for new ones until
+        the job is done. Stops early if no result arrives within timeout seconds
+        """
+        index = 0
+        while True:
+            with self._cond:
+                while index == len(self.results) and not self.done:
+                    if not self._cond.wait(timeout):
+                        return
+                new_results = self.results[index:]
+                done = self.done
+            for result in new_results:
+                yield result
+            index += len(new_results)
+            if done and index == len(self.results):
+                return
+
+    def to_dict(self):
+        """returns the job's progress as a dictionary, without the results"""
+        with self._cond:
+            job = {
+                'id': self.id,
+                'status': self.status,
+                'total': self.total,
+                'completed': len(self.results),
+                'created': self.created,
+                'finished': self.finished
+            }
+            if self.error:
+                job['error'] = self.error
+        return job
+
+
+class JobManager(object):
+    """
+    runs jobs on a pool of background threads, and keeps the most recent ones
+    so their results can still be fetched after they finish
+    """
+
+    def __init__(self, max_workers = 2, max_jobs = 100, id_prefix = ''):
+        self.max_jobs = max_jobs
+        # marks the jobs of this process, when several serve the same port
+        self.id_prefix = id_prefix
+        self._executor = ThreadPoolExecutor(max_workers = max_workers)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, work, total):
+        """
+        starts a job. work is a function taking the Job, which should call
+        job.add_result for each finished item. total is the number of items.
+        Returns the Job
+        """
+        job = Job(total, self.id_prefix)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._evict()
+        self._executor.submit(self._run, job, work)
+        return job
+
+    def get(self, job_id):
+        """returns the Job with the given ID, or None"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _evict(self):
+        """forgets the oldest finished jobs when more than max_jobs are kept"""
+        excess = len(self._jobs) - self.max_jobs
+        for job_id in list(self._jobs):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].done:
+                del self._jobs[job_id]
+                excess -= 1
+
+    def _run(self, job, work):
+        job._set_status('running')
+        try:
+            work(job)
+        except Exception as e:
+            logger.exception('job %s failed', job.id)
+            job._set_status('failed', str(e))
+        else:
+            job._set_status('done')
+
+    def shutdown(self):
+        """waits for running jobs, then stops the worker threads"""
+        self._executor.shutdown(wait = True)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: import a module the first time one of its attributes is used
+
+Importing TensorFlow takes seconds and hundreds of megabytes. Modules which
+only need it to run the model hold a LazyModule instead, so importing them,
+parsing arguments and answering requests which don't touch the model stay
+cheap, and the cost is paid once, by whatever first uses the model.
+"""
+
+import importlib
+import threading
+
+
+class LazyModule(object):
+    """
+    stands in for the module called name, importing it on first attribute
+    access. Safe to use from several threads
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            with self.__dict__['_lock']:
+                module = self.__dict__['_module']
+                if module is None:
+                    module = importlib.import_module(self.__dict__['_name'])
+                    self.__dict__['_module'] = module
+        return module
+
+    @property
+    def loaded(self):
+        """whether the module has been imported yet"""
+        return self.__dict__['_module'] is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self.loaded else 'not loaded'
+        return '<lazy module %r, %s>' % (self.__dict__['_name'], state)
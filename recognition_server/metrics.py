@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: low-overhead counters and histograms, in Prometheus text format
+
+Each stage of an inference request (download, header check, decode, waiting
+for a batch, the forward pass, picking the top classes, formatting) is timed
+into a histogram, and requests, errors and batch sizes are counted. Recording
+a value costs a clock read, a bisect over the bucket bounds and an addition
+under a lock, so the hooks can stay on in production. render() writes every
+metric in the Prometheus text exposition format, for the /metrics endpoint.
+Values which other objects already keep, such as cache hit counters, are read
+when rendering, through GaugeFunc.
+"""
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+# latency bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# batch size bucket upper bounds
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+_metrics = []
+_metrics_lock = threading.Lock()
+
+
+def _register(metric):
+    with _metrics_lock:
+        _metrics.append(metric)
+    return metric
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra = ()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+class Counter(object):
+    """a count which only goes up, optionally split by label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _register(self)
+
+    def inc(self, amount = 1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, key), value)
+                for key, value in items]
+
+
+class Histogram(object):
+    """
+    counts observations into buckets, with their sum, optionally split by
+    label values
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames = (), buckets = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        _register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """times the with block, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        counts = self._values.get(key)
+        return 0 if counts is None else sum(counts[:-1])
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self._values.items())
+        samples = []
+        for key, counts in items:
+            total = 0
+            bounds = self.buckets + (float('inf'),)
+            for bound, count in zip(bounds, counts):
+                total += count
+                samples.append((self.name + '_bucket', _format_labels(
+                    self.labelnames, key, [('le', _format_value(bound))]), total))
+            labels = _format_labels(self.labelnames, key)
+            samples.append((self.name + '_sum', labels, counts[-1]))
+            samples.append((self.name + '_count', labels, total))
+        return samples
+
+
+class GaugeFunc(object):
+    """
+    a value read when the metrics are rendered. fn returns a number, or a
+    dictionary from label value tuples to numbers. kind can be 'gauge' or
+    'counter', for values which only go up
+    """
+
+    def __init__(self, name, help, fn, labelnames = (), kind = 'gauge'):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+        _register(self)
+
+    def samples(self):
+        try:
+            value = self.fn()
+            if value is None:
+                return []
+            if not isinstance(value, dict):
+                value = {(): value}
+            return [(self.name, _format_labels(self.labelnames, key), float(val))
+                    for key, val in sorted(value.items())]
+        except Exception:
+            # a metric which can't be read is left out, rather than failing /metrics
+            return []
+
+
+def render():
+    """returns every registered metric in the Prometheus text format"""
+    with _metrics_lock:
+        metrics = list(_metrics)
+    lines = []
+    for metric in metrics:
+        samples = metric.samples()
+        if not samples:
+            continue
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, labels, value in samples:
+            lines.append('%s%s %s' % (name, labels, _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+# metrics recorded by the server's modules
+STAGE_SECONDS = Histogram(
+    'recognition_stage_seconds',
+    'Time spent in each stage of inference: fetch, validate, decode, queue, '
+    'inference, postprocess, format, model_load, labels_load.',
+    ['stage'])
+REQUESTS = Counter(
+    'recognition_http_requests_total', 'HTTP requests, by endpoint, method and status.',
+    ['endpoint', 'method', 'status'])
+REQUEST_SECONDS = Histogram(
+    'recognition_http_request_seconds',
+    'Time to handle an HTTP request, until the response starts.',
+    ['endpoint', 'method'])
+ERRORS = Counter(
+    'recognition_image_errors_total', 'Images which could not be classified, by error.',
+    ['error'])
+BATCH_SIZE = Histogram(
+    'recognition_batch_size', 'Number of images in each forward pass.',
+    buckets = SIZE_BUCKETS)
+SHED = Counter(
+    'recognition_shed_total',
+    'Requests turned away and queued images dropped by admission control, by reason.',
+    ['reason'])
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: keep several models loaded at once, swap in new versions and
+evict idle ones
+
+Each model has a name, given with ?model= on the inference endpoints, and
+a ModelSpec: the directory of its graph and label files, and the graph
+variant. A loaded model has its own engine, batching scheduler and label
+table, see Model. Models are loaded on first use.
+
+A new version of a model is loaded and warmed up next to the old one, then
+swapped in under the lock. Requests hold a lease on the version they
+started with, so the old version is only closed once its last request is
+done, and none are dropped.
+
+With a memory budget, the least recently used idle models are closed when
+the loaded models go over it. The default model is never evicted.
+"""
+
+import os
+import time
+import threading
+import contextlib
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class UnknownModel(KeyError):
+    """raised for a model name which isn't registered"""
+
+    def __init__(self, name):
+        KeyError.__init__(self, name)
+        self.name = name
+        self.error_dict = {'error': 'unknown model %s' % name}
+
+
+class ModelSpec(object):
+    """where a model's files are: its name, model directory and graph variant"""
+
+    __slots__ = ('name', 'model_dir', 'variant')
+
+    def __init__(self, name, model_dir, variant = 'original'):
+        self.name = name
+        self.model_dir = model_dir
+        self.variant = variant or 'original'
+
+    @classmethod
+    def parse(cls, text):
+        """parses name=model_dir or name=model_dir:variant"""
+        name, sep, rest = text.partition('=')
+        if not sep or not name.strip() or not rest.strip():
+            raise ValueError('expected name=model_dir[:variant], got %r' % text)
+        model_dir, _, variant = rest.strip().rpartition(':')
+        if not model_dir:
+            model_dir, variant = variant, 'original'
+        return cls(name.strip(), model_dir, variant)
+
+    def __eq__(self, other):
+        return (isinstance(other, ModelSpec) and
+                (self.name, self.model_dir, self.variant) ==
+                (other.name, other.model_dir, other.variant))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'ModelSpec(%r, %r, %r)' % (self.name, self.model_dir, self.variant)
+
+    def to_dict(self):
+        return {'name': self.name, 'model_dir': self.model_dir,
+                'variant': self.variant}
+
+
+class Model(object):
+    """
+    one version of a model: an engine, the BatchScheduler in front of it and
+    key, which identifies its results in the result cache. The engine is only
+    loaded by warm_up(), which then calls on_load(model), e.g. to set the key
+    again once the model's files have been downloaded or built, and labels,
+    the label table of this version. leases counts the requests using this
+    version
+    """
+
+    def __init__(self, spec, engine, scheduler, key = '', version = 1,
+                 on_load = None):
+        self.spec = spec
+        self.engine = engine
+        self.scheduler = scheduler
+        self.key = key
+        self.version = version
+        self.on_load = on_load
+        self.labels = None
+        self.state = 'not loaded'
+        self.error = None
+        self.last_used = time.monotonic()
+        self.leases = 0
+        self.retired = False
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.spec.name
+
+    @property
+    def memory(self):
+        """
+        estimated bytes held by the loaded model: the growth of the resident
+        set while it loaded, or else the size of its graph file
+        """
+        if self.state != 'ready':
+            return 0
+        grown = self.engine.rss_after_load - self.engine.rss_before_load
+        if grown > 0:
+            return grown
+        try:
+            return os.path.getsize(self.engine.graph_path)
+        except (TypeError, OSError):
+            return 0
+
+    def warm_up(self):
+        """
+        loads the engine and runs one forward pass, once. Returns whether this
+        call loaded it
+        """
+        with self._lock:
+            if self.state == 'ready':
+                return False
+            if self.state == 'closed':
+                raise RuntimeError('model %s version %d is closed'
+                                   % (self.name, self.version))
+            self.state = 'loading'
+            try:
+                self.engine.warm_up()
+                if self.on_load is not None:
+                    self.on_load(self)
+            except Exception as e:
+                self.state = 'failed'
+                self.error = str(e)
+                raise
+            self.state = 'ready'
+            self.error = None
+            return True
+
+    def close(self):
+        """runs the queued images, then closes the engine"""
+        self.scheduler.stop()
+        self.engine.close()
+        with self._lock:
+            self.state = 'closed'
+
+    def stats(self):
+        return dict(self.spec.to_dict(), version = self.version, state = self.state,
+                    error = self.error, memory = self.memory, leases = self.leases,
+                    idle_seconds = round(time.monotonic() - self.last_used, 3))
+
+
+class ModelRegistry(object):
+    """
+    the models which can be served, by name, and their loaded versions.
+    make_model(spec, version) returns an unloaded Model. memory_budget is in
+    bytes, 0 for no limit. default is the name used when none is given
+    """
+
+    def __init__(self, make_model, memory_budget = 0, default = 'default'):
+        self.make_model = make_model
+        self.memory_budget = max(0, int(memory_budget))
+        self.default = default
+        self._lock = threading.Lock()
+        # name -> ModelSpec, of every model which can be loaded
+        self._specs = {}
+        # name -> Model, the current version of loaded or loading models
+        self._models = {}
+        # name -> Model, new versions warming up in the background
+        self._pending = {}
+        # name -> last version number handed out
+        self._versions = {}
+        self.counters = dict.fromkeys(['loads', 'swaps', 'evictions'], 0)
+
+    def register(self, spec):
+        """adds a model which can be loaded, by its spec.name"""
+        with self._lock:
+            self._specs[spec.name] = spec
+
+    def names(self):
+        with self._lock:
+            return sorted(self._specs)
+
+    def models(self):
+        """returns the current versions of the loaded or loading models, by name"""
+        with self._lock:
+            return dict(self._models)
+
+    def spec(self, name = None):
+        """returns the ModelSpec of a model, or raises UnknownModel"""
+        name = name or self.default
+        with self._lock:
+            try:
+                return self._specs[name]
+            except KeyError:
+                raise UnknownModel(name)
+
+    def _new_model(self, spec):
+        """makes the next version of a model. Called with the lock held"""
+        version = self._versions.get(spec.name, 0) + 1
+        self._versions[spec.name] = version
+        return self.make_model(spec, version)
+
+    def get(self, name = None, load = True):
+        """
+        returns the current version of a model, loading it unless load is
+        False. Raises UnknownModel for a name which isn't registered
+        """
+        name = name or self.default
+        while True:
+            with self._lock:
+                model = self._models.get(name)
+                if model is None:
+                    if name not in self._specs:
+                        raise UnknownModel(name)
+                    model = self._models[name] = self._new_model(self._specs[name])
+                model.last_used = time.monotonic()
+            if not load or model.state == 'ready':
+                return model
+            try:
+                loaded = model.warm_up()
+            except RuntimeError:
+                # evicted before it was loaded, make a new version
+                if model.retired:
+                    continue
+                raise
+            if loaded:
+                with self._lock:
+                    self.counters['loads'] += 1
+                self._enforce_budget(model)
+            return model
+
+    def lease(self, name = None):
+        """
+        returns the current version of a model, loaded, and keeps it open
+        until release() is called with it
+        """
+        while True:
+            model = self.get(name)
+            with self._lock:
+                # swapped or evicted since get(), try the new version
+                if not model.retired:
+                    model.leases += 1
+                    return model
+
+    def release(self, model):
+        with self._lock:
+            model.leases -= 1
+            model.last_used = time.monotonic()
+            close = model.retired and model.leases == 0
+        if close:
+            model.close()
+
+    @contextlib.contextmanager
+    def acquire(self, name = None):
+        """lease() and release() as a with block"""
+        model = self.lease(name)
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def _retire(self, model):
+        """closes an old version once nothing is using it"""
+        with self._lock:
+            model.retired = True
+            close = model.leases == 0
+        if close:
+            model.close()
+
+    def swap(self, spec, background = True):
+        """
+        loads spec as a new version of the model spec.name, which may be a new
+        model, and swaps it in once it has been warmed up. Requests already
+        using the old version finish on it. Returns the new Model, which is
+        loaded in a background thread unless background is False. If loading
+        fails, the old version stays
+        """
+        with self._lock:
+            model = self._new_model(spec)
+            # a newer swap wins, an older one still loading is dropped
+            self._pending[spec.name] = model
+        if background:
+            thread = threading.Thread(target = self._swap_in, args = (model,),
+                                      name = 'model-swap-%s' % spec.name)
+            thread.daemon = True
+            thread.start()
+        else:
+            self._swap_in(model)
+        return model
+
+    def _swap_in(self, model):
+        try:
+            model.warm_up()
+        except Exception as e:
+            logger.error('loading model %s version %d failed: %s',
+                         model.name, model.version, e)
+            with self._lock:
+                if self._pending.get(model.name) is model:
+                    del self._pending[model.name]
+            return
+        with self._lock:
+            if self._pending.get(model.name) is not model:
+                stale = True
+            else:
+                stale = False
+                del self._pending[model.name]
+                old = self._models.get(model.name)
+                self._models[model.name] = model
+                self._specs[model.name] = model.spec
+                self.counters['swaps'] += 1
+                self.counters['loads'] += 1
+                model.last_used = time.monotonic()
+        if stale:
+            model.close()
+            return
+        logger.info('model %s version %d swapped in', model.name, model.version)
+        if old is not None:
+            self._retire(old)
+        self._enforce_budget(model)
+
+    def evict(self, name):
+        """closes the loaded version of a model, returns whether there was one"""
+        with self._lock:
+            model = self._models.pop(name, None)
+        if model is None:
+            return False
+        self._retire(model)
+        return True
+
+    def _enforce_budget(self, keep = None):
+        """
+        evicts the least recently used idle models, other than keep and the
+        default, while the loaded models are over the memory budget
+        """
+        if not self.memory_budget:
+            return
+        victims = []
+        with self._lock:
+            loaded = [model for model in self._models.values() if model.state == 'ready']
+            total = sum(model.memory for model in loaded)
+            for model in sorted(loaded, key = lambda model: model.last_used):
+                if total <= self.memory_budget:
+                    break
+                if model is keep or model.name == self.default or model.leases:
+                    continue
+                del self._models[model.name]
+                total -= model.memory
+                victims.append(model)
+            self.counters['evictions'] += len(victims)
+        for model in victims:
+            logger.info('model %s evicted, over the memory budget', model.name)
+            self._retire(model)
+
+    def stats(self):
+        """returns the registered models, with their loaded versions, as a dictionary"""
+        with self._lock:
+            specs = dict(self._specs)
+            models = dict(self._models)
+            pending = dict(self._pending)
+            stats = dict(self.counters)
+        models_stats = {}
+        for name, spec in specs.items():
+            if name in models:
+                entry = models[name].stats()
+            else:
+                entry = dict(spec.to_dict(), state = 'not loaded', memory = 0)
+            if name in pending:
+                entry['loading_version'] = pending[name].version
+            models_stats[name] = entry
+        stats.update(models = models_stats, default = self.default,
+                     memory_budget = self.memory_budget,
+                     memory = sum(entry['memory'] for entry in models_stats.values()))
+        return stats
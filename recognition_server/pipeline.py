@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: staged download, decode and inference pipeline for many images
+
+Images go through three stages which run at the same time: a pool of fetch
+threads downloads them, a pool of decode threads turns them into model input,
+and a single inference thread runs the decoded images in batches. The stages
+are connected by bounded queues, so a long list of URLs never has more than a
+few queue lengths of images in memory, and the total time is close to that of
+the slowest stage rather than the sum of all of them.
+"""
+
+import threading
+import queue
+import logging
+
+
+# marks the end of the work on a queue
+_DONE = object()
+
+logger = logging.getLogger(__name__)
+
+
+class InferencePipeline(object):
+    """
+    runs items through fetch, decode and inference stages. The stage functions
+    are given to the constructor:
+        fetch(item) returns (data, True), or (result, False)
+        decode(data) returns (tensor, True), or (result, False)
+        infer_batch(list of tensors) returns a list of results, one per tensor
+    fetch and decode return False with a result, such as an error dictionary
+    or a cached result, to finish an item without the later stages. If a stage
+    raises an exception, the item's result is error_result(message), which by
+    default is an error dictionary
+    """
+
+    def __init__(self, fetch, decode, infer_batch, fetch_workers = 8,
+                 decode_workers = 2, batch_size = 16, queue_size = 32,
+                 error_result = None):
+        self.fetch = fetch
+        self.decode = decode
+        self.infer_batch = infer_batch
+        self.error_result = error_result or (lambda message: {"error": message})
+        self.fetch_workers = max(1, int(fetch_workers))
+        self.decode_workers = max(1, int(decode_workers))
+        self.batch_size = max(1, int(batch_size))
+        self.queue_size = max(1, int(queue_size))
+
+    def run(self, items):
+        """
+        runs every item through the pipeline. This is a generator, yielding
+        (index, result) pairs in the order in which images finish, where index
+        is the position of the item in items
+        """
+        run = _PipelineRun(self, items)
+        try:
+            for pair in run.results():
+                yield pair
+        finally:
+            run.stop()
+
+    def run_all(self, items):
+        """runs every item through the pipeline and returns results in order"""
+        items = list(items)
+        results = [None] * len(items)
+        for index, result in self.run(items):
+            results[index] = result
+        return results
+
+
+class _PipelineRun(object):
+    """the queues and threads for a single InferencePipeline.run call"""
+
+    def __init__(self, pipeline, items):
+        self.pipeline = pipeline
+        size = pipeline.queue_size
+        self.todo = queue.Queue(size)
+        self.fetched = queue.Queue(size)
+        self.decoded = queue.Queue(size)
+        self.done = queue.Queue(size)
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._fetchers_left = pipeline.fetch_workers
+        self._decoders_left = pipeline.decode_workers
+        self.num_items = None
+
+        threads = [threading.Thread(target = self._feed, args = (items,))]
+        threads += [threading.Thread(target = self._fetch_stage)
+                    for _ in range(pipeline.fetch_workers)]
+        threads += [threading.Thread(target = self._decode_stage)
+                    for _ in range(pipeline.decode_workers)]
+        threads.append(threading.Thread(target = self._infer_stage))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+    def _put(self, q, item):
+        """puts item on a bounded queue, giving up if the run is stopped"""
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        """gets an item from a queue, or _DONE if the run is stopped"""
+        while not self.stopped.is_set():
+            try:
+                return q.get(timeout = 0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _feed(self, items):
+        count = 0
+        for index, item in enumerate(items):
+            if not self._put(self.todo, (index, item)):
+                return
+            count += 1
+        self.num_items = count
+        for _ in range(self.pipeline.fetch_workers):
+            self._put(self.todo, _DONE)
+        self._put(self.done, _DONE)
+
+    def _fetch_stage(self):
+        while True:
+            job = self._get(self.todo)
+            if job is _DONE:
+                break
+            index, item = job
+            try:
+                data, ok = self.pipeline.fetch(item)
+            except Exception:
+                logger.exception('fetch failed for %r', item)
+                data, ok = self.pipeline.error_result("image cannot be fetched"), False
+            if ok:
+                self._put(self.fetched, (index, data))
+            else:
+                self._put(self.done, (index, data))
+        with self._lock:
+            self._fetchers_left -= 1
+            last = self._fetchers_left == 0
+        if last:
+            for _ in range(self.pipeline.decode_workers):
+                self._put(self.fetched, _DONE)
+
+    def _decode_stage(self):
+        while True:
+            job = self._get(self.fetched)
+            if job is _DONE:
+                break
+            index, data = job
+            try:
+                tensor, ok = self.pipeline.decode(data)
+            except Exception:
+                logger.exception('decode failed')
+                tensor, ok = self.pipeline.error_result("file cannot be decoded"), False
+            if ok:
+                self._put(self.decoded, (index, tensor))
+            else:
+                self._put(self.done, (index, tensor))
+        with self._lock:
+            self._decoders_left -= 1
+            last = self._decoders_left == 0
+        if last:
+            self._put(self.decoded, _DONE)
+
+    def _infer_stage(self):
+        finished = False
+        while not finished:
+            job = self._get(self.decoded)
+            if job is _DONE:
+                break
+            batch = [job]
+            # take whatever else is already decoded, up to the batch size
+            while len(batch) < self.pipeline.batch_size:
+                try:
+                    job = self.decoded.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _DONE:
+                    finished = True
+                    break
+                batch.append(job)
+            try:
+                results = self.pipeline.infer_batch([tensor for _, tensor in batch])
+            except Exception:
+                logger.exception('inference failed')
+                results = [self.pipeline.error_result("inference failed") for _ in batch]
+            for (index, _), result in zip(batch, results):
+                self._put(self.done, (index, result))
+
+    def results(self):
+        """yields (index, result) pairs until every item has a result"""
+        count = 0
+        fed = False
+        while not fed or count < self.num_items:
+            job = self.done.get()
+            if job is _DONE:
+                fed = True
+                continue
+            count += 1
+            yield job
+
+    def stop(self):
+        """releases any threads still blocked on a full queue"""
+        self.stopped.set()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: vectorised top-k post-processing of batched prediction scores
+
+Picking the top predictions used to sort every class score of each image and
+then loop over them in Python to apply the threshold and look up labels. Here
+a whole batch of softmax rows is handled with a few NumPy operations:
+argpartition finds the k best classes of every row without a full sort, only
+those k columns are sorted, and the threshold and the label lookup are applied
+to the (batch, k) arrays at once. The cost grows with k and the batch size,
+not with the number of classes.
+
+The results of one image are kept as CompactResults: its class ids and
+scores as small fixed-width arrays, rather than a dictionary of formatted
+strings. Class names and formatted scores are only produced when results are
+serialised for the API, by CompactResults.to_dict().
+"""
+
+import numpy as np
+
+
+class TopKResults(object):
+    """
+    the top predictions of a batch of images. ids (int32) and scores
+    (float32) have shape (batch, k), best first, and labels, if given, holds
+    the class name of each id. counts is how many predictions of each row are
+    above the threshold; the rest of the row is padding. embeddings, if
+    given, holds the feature vector of each image, shape (batch, dim)
+    """
+
+    def __init__(self, ids, scores, counts, labels = None, embeddings = None):
+        self.ids = ids
+        self.scores = scores
+        self.counts = counts
+        self.labels = labels
+        self.embeddings = embeddings
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        """returns the TopKResults of one image, as a batch of one"""
+        count = int(self.counts[index])
+        return TopKResults(
+            self.ids[index:index + 1, :count],
+            self.scores[index:index + 1, :count],
+            self.counts[index:index + 1],
+            None if self.labels is None else self.labels[index:index + 1, :count],
+            None if self.embeddings is None else self.embeddings[index:index + 1])
+
+    def to_dicts(self):
+        """
+        returns one API results dictionary per image, mapping the rank to the
+        class name and score, e.g. {0: {"results_name": ..., "results_score":
+        "0.8762"}}
+        """
+        labels = self.labels
+        if labels is None:
+            labels = self.ids.astype(np.str_)
+        scores = np.char.mod('%.4f', self.scores)
+        all_results = []
+        for row in range(len(self.ids)):
+            count = int(self.counts[row])
+            all_results.append(dict(
+                (i, {"results_score": score, "results_name": name})
+                for i, (name, score) in enumerate(zip(labels[row, :count].tolist(),
+                                                      scores[row, :count].tolist()))))
+        return all_results
+
+
+class CompactResults(object):
+    """
+    the top predictions of one image, best first: class ids (int16) and 
+    scores (float32). Stored as {"top_ids": [...], "top_scores": [...]} in 
+    JSON, see json_default and json_object_hook. model is the name of the
+    model the ids belong to, None for the default model. labels, if given, is
+    the label table of the model version which made the results; it is not
+    stored, so results read back are labelled by the model's name
+    """
+
+    __slots__ = ('ids', 'scores', 'model', 'labels')
+
+    def __init__(self, ids, scores, model = None, labels = None):
+        self.ids = np.asarray(ids, dtype = np.int16)
+        self.scores = np.asarray(scores, dtype = np.float32)
+        self.model = model
+        self.labels = labels
+
+    @classmethod
+    def from_top(cls, top, row = 0, model = None, labels = None):
+        """copies one row of a TopKResults, without the padding"""
+        count = int(top.counts[row])
+        # copies, so the batch's arrays aren't kept alive by the slices
+        return cls(top.ids[row, :count].astype(np.int16),
+                   top.scores[row, :count].astype(np.float32), model, labels)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __eq__(self, other):
+        return (isinstance(other, CompactResults) and
+                self.model == other.model and
+                np.array_equal(self.ids, other.ids) and
+                np.array_equal(self.scores, other.scores))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        if self.model is None:
+            return 'CompactResults(%r, %r)' % (self.ids.tolist(), self.scores.tolist())
+        return 'CompactResults(%r, %r, %r)' % (self.ids.tolist(), self.scores.tolist(),
+                                               self.model)
+
+    def to_dict(self, labels = None):
+        """
+        returns the API results dictionary, mapping the rank to the class name
+        and score, e.g. {0: {"results_name": ..., "results_score": "0.8762"}}.
+        labels is an array of class names, indexed by class id; without it the
+        class ids are used as names
+        """
+        if labels is None:
+            names = [str(i) for i in self.ids.tolist()]
+        else:
+            names = gather_labels(labels, self.ids).tolist()
+        return dict((i, {"results_score": '%.4f' % score, "results_name": name})
+                    for i, (name, score) in enumerate(zip(names, self.scores.tolist())))
+
+    def to_json(self):
+        obj = {"top_ids": self.ids.tolist(), "top_scores": self.scores.tolist()}
+        if self.model is not None:
+            obj["model"] = self.model
+        return obj
+
+
+def json_default(obj):
+    """default function for json.dump, stores CompactResults compactly"""
+    if isinstance(obj, CompactResults):
+        return obj.to_json()
+    raise TypeError('%r is not JSON serializable' % type(obj).__name__)
+
+
+def json_object_hook(obj):
+    """object_hook for json.load, reads back what json_default stored"""
+    if (len(obj) == 2 + ('model' in obj) and 'top_ids' in obj and
+            'top_scores' in obj):
+        return CompactResults(obj['top_ids'], obj['top_scores'], obj.get('model'))
+    return obj
+
+
+def gather_labels(labels, ids):
+    """
+    looks up the class name of every id in an array of ids. Ids without a
+    label get an empty string
+    """
+    labels = np.asarray(labels)
+    if len(labels) == 0:
+        return np.full(ids.shape, '', dtype = np.str_)
+    known = (ids >= 0) & (ids < len(labels))
+    names = labels[np.where(known, ids, 0)]
+    return np.where(known, names, '')
+
+
+def top_k_agreement(reference, candidate, k = 5):
+    """
+    compares two (batch, classes) score arrays for the same images, e.g. from
+    the original and a quantised model. Returns a dictionary with the fraction
+    of images whose top class is the same (top1_agreement), whose candidate 
+    top class is in the reference top k (topk_agreement), the mean fraction 
+    of the top k classes both share (topk_overlap), and the mean and largest
+    absolute score difference
+    """
+    reference = np.asarray(reference, dtype = np.float32)
+    candidate = np.asarray(candidate, dtype = np.float32)
+    k = max(1, k)
+    # no threshold, every image has k classes
+    reference_top = top_k(reference, k, -np.inf).ids
+    candidate_top = top_k(candidate, k, -np.inf).ids
+    # (batch, k, k) comparison of every pair of classes in the two top k lists
+    shared = (reference_top[:, :, np.newaxis] == candidate_top[:, np.newaxis, :])
+    difference = np.abs(reference - candidate)
+    return {
+        'k': int(reference_top.shape[1]),
+        'top1_agreement': float(np.mean(reference_top[:, 0] == candidate_top[:, 0])),
+        'topk_agreement': float(np.mean(shared[:, :, 0].any(axis = 1))),
+        'topk_overlap': float(np.mean(shared.any(axis = 2).sum(axis = 1) 
+                                      / reference_top.shape[1])),
+        'mean_abs_difference': float(difference.mean()),
+        'max_abs_difference': float(difference.max())
+    }
+
+
+def top_k(predictions, k, threshold = 0.0, labels = None):
+    """
+    finds the k best predictions of each row of a (batch, classes) score
+    array, keeping those with a score above threshold. labels is an array of
+    class names, indexed by class id. Returns a TopKResults
+    """
+    predictions = np.asarray(predictions)
+    if predictions.ndim == 1:
+        predictions = predictions[np.newaxis]
+    batch, num_classes = predictions.shape
+    k = max(0, min(int(k), num_classes))
+    if k == 0:
+        ids = np.zeros((batch, 0), dtype = np.int32)
+    elif k < num_classes:
+        # unordered k best columns of each row, without sorting the rest
+        ids = np.argpartition(predictions, num_classes - k, axis = 1)[:, -k:]
+    else:
+        ids = np.broadcast_to(np.arange(num_classes), (batch, num_classes))
+    scores = np.take_along_axis(predictions, ids, axis = 1)
+    # sort just the k columns, best first
+    order = np.argsort(-scores, axis = 1, kind = 'stable')
+    ids = np.take_along_axis(ids, order, axis = 1).astype(np.int32)
+    scores = np.take_along_axis(scores, order, axis = 1).astype(np.float32)
+
+    # rows are sorted, so the scores above the threshold come first
+    above = scores > threshold
+    counts = above.sum(axis = 1)
+    ids[~above] = -1
+    scores[~above] = 0.0
+    if labels is not None:
+        labels = gather_labels(labels, ids)
+    return TopKResults(ids, scores, counts, labels)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: decode and downscale images to the model's input size
+
+The Inception graph takes a JPEG and decodes and resizes it to 299x299 inside
+the graph, so a multi-megapixel photo is fully decoded just to be shrunk. Here
+JPEGs are decoded with PIL's draft mode instead, which lets libjpeg decode
+straight to a 1/2, 1/4 or 1/8 scale image that is still at least as large as
+the model input, before a final resize. The result is normalised the same way
+as in the graph, so it can be fed to the network directly.
+"""
+
+import io
+import numpy as np
+from PIL import Image
+
+
+# input size expected by the Inception v3 graph
+INPUT_SIZE = 299
+# the graph subtracts this from pixel values, then divides by it
+INPUT_MEAN = 128.0
+# changes whenever preprocessing gives different pixels, so cached results 
+# from older preprocessing are not reused
+VERSION = 'pil-draft-1'
+
+# errors PIL raises for files it cannot decode
+DECODE_ERRORS = (IOError, OSError, SyntaxError, ValueError,
+                 Image.DecompressionBombError)
+
+
+class PreprocessedImage(object):
+    """
+    a decoded image, ready for the model. tensor is a float32 array of shape
+    (1, size, size, 3). size is the original 'WxH' string, and resized is True
+    if the image was scaled to fit the model
+    """
+
+    def __init__(self, tensor, size, resized):
+        self.tensor = tensor
+        self.size = size
+        self.resized = resized
+
+
+def preprocess_image(image_data, input_size = INPUT_SIZE):
+    """
+    decodes encoded JPEG, PNG or GIF data, downscaling early where the format
+    allows, and resizes and normalises it. Returns a PreprocessedImage. Raises
+    one of DECODE_ERRORS if the image cannot be decoded
+    """
+    img = Image.open(io.BytesIO(image_data))
+    width, height = img.size
+    if img.format == 'JPEG':
+        # picks the smallest DCT scale still at least input_size on each side
+        img.draft('RGB', (input_size, input_size))
+    img = img.convert('RGB')
+    if img.size != (input_size, input_size):
+        img = img.resize((input_size, input_size), Image.BILINEAR)
+
+    tensor = np.asarray(img, dtype = np.float32)
+    tensor -= INPUT_MEAN
+    tensor /= INPUT_MEAN
+    return PreprocessedImage(tensor[np.newaxis], '%dx%d' % (width, height),
+                             (width, height) != (input_size, input_size))
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: a sampling profiler which can be switched on in a running server
+
+A background thread wakes every few milliseconds, reads the current stack of
+every other thread with sys._current_frames(), and counts each distinct stack.
+Nothing is hooked into the code being profiled, so the cost is the sampling
+thread's own time, and none at all while the profiler is off. Stacks are
+reported in the "folded" format, one line per stack with its frames joined
+by semicolons and then its sample count, which flamegraph.pl and speedscope
+read directly.
+"""
+
+import os
+import sys
+import time
+import threading
+
+
+# distinct stacks kept, further new stacks are counted as dropped
+MAX_STACKS = 20000
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name,
+                         code.co_firstlineno)
+
+
+def fold_stack(frame, thread_name = None):
+    """returns a frame's stack, outermost first, as a folded stack string"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    if thread_name:
+        names.append(thread_name)
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(object):
+    """
+    samples the stacks of all threads every interval_ms milliseconds between
+    start() and stop(). Samples build up across runs until reset()
+    """
+
+    def __init__(self, interval_ms = 10.0):
+        self.interval = max(0.001, interval_ms / 1000.0)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.stacks = {}
+        self.num_samples = 0
+        self.dropped = 0
+        self.started = None
+        self.seconds = 0.0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval_ms = None):
+        """starts sampling, optionally at a new interval"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            if interval_ms is not None:
+                self.interval = max(0.001, interval_ms / 1000.0)
+            self._stop_event.clear()
+            self.started = time.time()
+            self._thread = threading.Thread(target = self._run, name = 'profiler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """stops sampling, keeping the samples taken"""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._thread = None
+            self.seconds += time.time() - self.started
+        self._stop_event.set()
+        thread.join()
+
+    def reset(self):
+        """drops the samples taken so far"""
+        with self._lock:
+            self.stacks = {}
+            self.num_samples = 0
+            self.dropped = 0
+            self.seconds = 0.0
+            if self._thread is not None:
+                self.started = time.time()
+
+    def sample(self):
+        """counts the current stack of every thread but the profiler's own"""
+        own = threading.get_ident()
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = fold_stack(frame, names.get(ident, 'thread-%d' % ident))
+                if stack in self.stacks:
+                    self.stacks[stack] += 1
+                elif len(self.stacks) < MAX_STACKS:
+                    self.stacks[stack] = 1
+                else:
+                    self.dropped += 1
+            self.num_samples += 1
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def folded(self):
+        """returns the sampled stacks in the folded format, most frequent first"""
+        with self._lock:
+            items = sorted(self.stacks.items(), key = lambda item: -item[1])
+        return ''.join('%s %d\n' % item for item in items)
+
+    def stats(self):
+        with self._lock:
+            seconds = self.seconds
+            if self._thread is not None:
+                seconds += time.time() - self.started
+            return {
+                'running': self._thread is not None,
+                'interval_ms': round(self.interval * 1000, 3),
+                'samples': self.num_samples,
+                'stacks': len(self.stacks),
+                'dropped': self.dropped,
+                'seconds': round(seconds, 3)
+            }
+
+
+_profiler = SamplingProfiler()
+
+
+def get_profiler():
+    """returns the process-wide SamplingProfiler"""
+    return _profiler
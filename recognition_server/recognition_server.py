@@ -27,22 +27,101 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import io
+import os
 import sys
 import json
-from flask import Flask, jsonify, abort, make_response, request
+import time
+import itertools
+from flask import Flask, Request, Response, jsonify, abort, make_response, request, url_for, g
+from flask.json.provider import DefaultJSONProvider
 from flask_httpauth import HTTPBasicAuth
 try:
     from recognition_server import tf_operations
+    from recognition_server import jobs
+    from recognition_server import image_store
+    from recognition_server import postprocess
+    from recognition_server import workers
+    from recognition_server import metrics
+    from recognition_server import profiler
+    from recognition_server import admission
+    from recognition_server import batching
+    from recognition_server import model_registry
+    from recognition_server import graph_optimize
 except:
     import tf_operations
+    import jobs
+    import image_store
+    import postprocess
+    import workers
+    import metrics
+    import profiler
+    import admission
+    import batching
+    import model_registry
+    import graph_optimize
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class InMemoryRequest(Request):
+    """
+    keeps uploaded files in memory. Werkzeug otherwise spools uploads over
+    500KB to temporary files, which are then read back into memory anyway
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename = None,
+                         content_length = None):
+        return io.BytesIO()
+
+
+class RecordJSONProvider(DefaultJSONProvider):
+    """
+    encodes image records, and maps the class ids of compact results to 
+    class names and formatted scores, so responses keep their format. Uses 
+    orjson, if installed, unless --json_encoder is json
+    """
+
+    def default(self, o):
+        if isinstance(o, image_store.ImageRecord):
+            return o.to_dict()
+        if isinstance(o, postprocess.CompactResults):
+            return tf_operations.format_results(o)
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and tf_operations.FLAGS.json_encoder != 'json':
+            return orjson.dumps(obj, default = self.default, option = 
+                                orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        return DefaultJSONProvider.dumps(self, obj, **kwargs)
 
 
 # set up HTTP app
 auth = HTTPBasicAuth()
 app = Flask(__name__)
-
-# initialise image list with some random images, not strictly necessary
-images = [
+app.request_class = InMemoryRequest
+app.json = RecordJSONProvider(app)
+
+# runs bulk inference in the background for asynchronous requests
+job_manager = jobs.JobManager()
+
+# limits the images being classified at once, replaced with the command line
+# limits in start()
+admission_control = admission.AdmissionController()
+metrics.GaugeFunc(
+    'recognition_admitted_images', 'Images admitted for inference and not yet done.',
+    lambda: {(name.split('_')[0],): value for name, value in admission_control.stats().items()
+             if name.endswith('_in_progress')},
+    ['priority'])
+
+# number of image updates written to the image store together by background jobs
+STORE_BATCH_SIZE = 32
+
+# initialise image store with some random images, not strictly necessary. The
+# in-memory store is replaced by the --image_store backend in main()
+INITIAL_IMAGES = [
     {
         'id': 1,
         'title': u'Nikes',
@@ -60,6 +139,7 @@ images = [
         'size': ""
     }
 ]
+images = image_store.ImageStore(INITIAL_IMAGES)
 
 # set up some HTTP error handlers
 @auth.error_handler
@@ -82,6 +162,181 @@ def missing_URL(error):
     return make_response(jsonify({'error': 'missing URL field'}), 410)
 
 
+@app.errorhandler(413)
+def too_large(error):
+    return make_response(jsonify({'error': 'request too large'}), 413)
+
+
+@app.errorhandler(504)
+def deadline_exceeded(error):
+    return make_response(jsonify(tf_operations.DEADLINE_EXCEEDED), 504)
+
+
+@app.errorhandler(admission.Rejected)
+def rejected(error):
+    return make_response(jsonify(error.error_dict), error.status, error.headers())
+
+
+@app.errorhandler(model_registry.UnknownModel)
+def unknown_model(error):
+    return make_response(jsonify(error.error_dict), 404)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def count_request(response):
+    """
+    records the request in the HTTP metrics, by route rather than path, so
+    image and job IDs don't each get their own series
+    """
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.REQUESTS.inc(endpoint = endpoint, method = request.method,
+                         status = str(response.status_code))
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                        endpoint = endpoint, method = request.method)
+    return response
+
+
+def wants_async():
+    """checks whether the request asked to run as a background job"""
+    return request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+
+def request_model():
+    """
+    returns the model chosen with ?model=, or None for the default model. A
+    model which isn't served gets 404
+    """
+    model = request.args.get('model') or None
+    if model is not None:
+        tf_operations.get_registry().spec(model)
+    return model
+
+
+def admit(count):
+    """
+    admits a request to classify count images, see admission.py. Returns the
+    admission.Ticket, to release when done, and the request's deadline
+    """
+    ticket = admission_control.admit(count)
+    deadline = admission.deadline_for(request.headers, tf_operations.FLAGS.request_timeout)
+    return ticket, deadline
+
+
+def take_undone():
+    """
+    returns the oldest undone images, at most --max_images_per_request of
+    them, and how many undone images are left for later requests
+    """
+    limit = admission_control.max_images_per_request
+    undone_imgs = list(itertools.islice(
+        images.iter_images(state = 'undone', page_size = limit), limit))
+    return undone_imgs, max(0, images.undone_count() - len(undone_imgs))
+
+
+def save_updates(pairs):
+    """
+    stores (img_id, update) pairs from inference in the image store, and links
+    each image to its embedding. Returns the updates, without content hashes.
+    Images which missed their deadline are left as they were
+    """
+    records = []
+    links = []
+    for img_id, update in pairs:
+        update, content_hash = tf_operations.split_update(update)
+        if tf_operations.missed_deadline(update):
+            continue
+        records.append((img_id, update))
+        links.append((img_id, content_hash))
+    images.update_many(records)
+    tf_operations.link_images(links)
+    return [update for _, update in records]
+
+
+def add_inferred(imgs, updates):
+    """
+    adds new images, given as JSON, to the image store with their updates from
+    inference. Returns the new image records
+    """
+    rows = []
+    content_hashes = []
+    for img, update in zip(imgs, updates):
+        update, content_hash = tf_operations.split_update(update)
+        if tf_operations.missed_deadline(update):
+            # added without results, for inferundone
+            update = {'results': '', 'size': "", 'resize': False}
+        if img.get('title') == None:
+            new_title = ""
+        else:
+            new_title = img.get('title')
+        rows.append({'url': img['url'], 'title': new_title, 'results': update['results'],
+                     'size': update['size'], 'resize': update['resize']})
+        content_hashes.append(content_hash)
+    
+    # the image store gives each new image a unique id, in one write
+    new_images = images.add_many(rows)
+    tf_operations.link_images([(image['id'], content_hash) for image, content_hash
+                               in zip(new_images, content_hashes)])
+    return new_images
+
+
+def start_infer_job(imgs, ticket, model = None):
+    """
+    starts a background job running inference on a list of image records, at
+    bulk priority, with model, by name. Each result is added to the job as 
+    soon as its image is done, and results are written to the image store in
+    batches. The admission.Ticket for the images is released when the job ends
+    """
+    def work(job):
+        with ticket:
+            urls = [img['url'] for img in imgs]
+            pending = []
+            for index, update in tf_operations.get_pipeline(model = model).run(urls):
+                pending.append((imgs[index]['id'], update))
+                job.add_result(dict(imgs[index], **tf_operations.split_update(update)[0]))
+                if len(pending) >= STORE_BATCH_SIZE:
+                    save_updates(pending)
+                    pending = []
+            save_updates(pending)
+    return job_manager.submit(work, len(imgs))
+
+
+def forward_job_request(job_id):
+    """
+    passes a job request on to the worker process which started the job, when
+    several workers serve the API. Returns the streamed response, or None if 
+    no other worker has the job
+    """
+    response = workers.forward(job_id, request.full_path,
+                               {'Accept': request.headers.get('Accept', '*/*')})
+    if response is None:
+        return None
+    
+    def body():
+        with response:
+            while True:
+                chunk = response.read1(64 * 1024)
+                if not chunk:
+                    return
+                yield chunk
+    return Response(body(), status = response.status,
+                    content_type = response.headers.get('Content-Type'))
+
+
+def job_response(job, **fields):
+    """returns a 202 response pointing at the job's progress address"""
+    body = {'job': job.to_dict()}
+    body.update(fields)
+    location = url_for('get_job', job_id = job.id)
+    return jsonify(body), 202, {'Location': location}
+
+
 # first API function, can be used for testing
 @app.route('/')
 @app.route('/index')
@@ -92,14 +347,66 @@ def index():
 
 # test string
 # curl -i http://127.0.0.1:5000/img/api/v1.0/images
+# curl -i "http://127.0.0.1:5000/img/api/v1.0/images?limit=100&after_id=0&fields=id,url&state=undone"
+# curl -i "http://127.0.0.1:5000/img/api/v1.0/images?format=ndjson"
 @app.route('/img/api/v1.0/images', methods=['GET'])
 #@auth.login_required
 def get_imgs():
     """
     returns in JSON format all the images currently stored by the server. 
-    Includes all fields, such as ID, and URL
+    Includes all fields, such as ID, and URL. The response is streamed a page
+    at a time, so the whole list is never held in memory. Optional arguments:
+    limit, the most images to return, with the ID to continue from returned
+    as next_after_id; after_id, to start after that image ID; fields, a comma
+    separated list of fields to include; state, done or undone to filter on 
+    whether inference has been run; format=ndjson, to stream one image per line
     """
-    return jsonify({'images': images})
+    try:
+        after_id = int(request.args.get('after_id', 0))
+        limit = request.args.get('limit')
+        limit = None if limit is None else max(0, int(limit))
+    except ValueError:
+        abort(400)
+    state = request.args.get('state')
+    if state not in (None, 'done', 'undone'):
+        abort(400)
+    fields = request.args.get('fields')
+    fields = None if fields is None else set(fields.split(','))
+    
+    def project(img):
+        if fields is None:
+            return img
+        return dict((key, val) for key, val in img.items() if key in fields)
+    
+    page_size = 500 if limit is None else min(limit + 1, 500)
+    imgs = images.iter_images(after_id, page_size, state)
+    
+    if request.args.get('format') == 'ndjson':
+        def lines():
+            for count, img in enumerate(imgs):
+                if limit is not None and count == limit:
+                    break
+                yield app.json.dumps(project(img)) + '\n'
+        return Response(lines(), mimetype = 'application/x-ndjson')
+    
+    def generate():
+        yield '{"images": ['
+        separator = ''
+        last_id = after_id
+        more = False
+        for count, img in enumerate(imgs):
+            if limit is not None and count == limit:
+                more = True
+                break
+            yield separator + app.json.dumps(project(img))
+            separator = ', '
+            last_id = img['id']
+        if limit is None:
+            yield ']}\n'
+        else:
+            # cursor for the next page, or null when there are no more images
+            yield '], "next_after_id": %s}\n' % json.dumps(last_id if more else None)
+    return Response(generate(), mimetype = 'application/json')
 
 
 # test String
@@ -111,10 +418,10 @@ def get_img(img_id):
     returns in JSON format a specific image currently stored by the server.
     Requires the image ID to be included in the HTTP address
     """
-    img = [img for img in images if img['id'] == img_id]
-    if len(img) == 0:
+    img = images.get(img_id)
+    if img is None:
         abort(404)
-    return jsonify({'img': img[0]})
+    return jsonify({'img': img})
 
 
 # test String
@@ -133,7 +440,7 @@ def add_imgs():
     missing_url = False
     json_str = request.json
     img_data = json_str['new_imgs']
-    new_images = []
+    rows = []
     
     for img in img_data:
         # URL is required, other fields not
@@ -150,20 +457,10 @@ def add_imgs():
         else:
             new_results = img.get('results')
             
-        image = {
-            # simple way to ensure a unique id
-            'id' : images[-1]['id'] + 1,
-            'title': new_title,
-            # url is required, otherwise return error
-            'url': img['url'],
-            'results': new_results,
-            'resize': False,
-            'size': ""
-        }
-        # add new image records to image list
-        images.append(image)
-        new_images.append(image)
+        rows.append({'url': img['url'], 'title': new_title, 'results': new_results})
         
+    # add new image records to image store, which gives each a unique id
+    new_images = images.add_many(rows)
     if missing_url:
         return_val = jsonify(new_images), 410
     else:
@@ -174,45 +471,74 @@ def add_imgs():
 
 # test string
 # curl -X PUT -i -H "Content-Type: application/json" -d '{ \"id\": \"1\"}' http://127.0.0.1:5000/img/api/v1.0/infer/1
+# curl -X PUT -i -H "Content-Type: application/json" -d '{ \"id\": \"1\"}' "http://127.0.0.1:5000/img/api/v1.0/infer/1?model=fp16"
 @app.route('/img/api/v1.0/infer/<int:img_id>', methods = ['PUT'])
 #@auth.login_required
 def infer(img_id):
     """
     runs TensorFlow inference (recognition) on an image which is already in the images 
     list. The image ID must be included in the HTTP address and encoded with JSON.
-    Results are returned in JSON
+    Results are returned in JSON. ?model= picks a model other than the default
     """
-    img = [img for img in images if img['id'] == img_id]
-    if len(img) == 0:
+    img = images.get(img_id)
+    if img is None:
         abort(404)
     if not request.json:
         abort(400)
         
-    url = img[0]['url']
+    url = img['url']
+    model = request_model()
+    ticket, deadline = admit(1)
     # call TensorFlow
-    img[0]['results'] = tf_operations.run_inference_on_image(url)
-    return jsonify({'img': img[0]}), 200
+    with ticket:
+        update = tf_operations.infer_image(url, deadline, model)
+    update, content_hash = tf_operations.split_update(update)
+    if tf_operations.missed_deadline(update):
+        abort(504)
+    img = images.update(img_id, update) or dict(img, **update)
+    tf_operations.link_images([(img_id, content_hash)])
+    return jsonify({'img': img}), 200
 
 
 # test string
 # curl -X PUT -i http://127.0.0.1:5000/img/api/v1.0/inferundone
-# calls TensorFlow, so can be slow if many images are undone
+# calls TensorFlow, so can be slow if many images are undone. Add ?async=true
+# to get a job ID straight away, and poll or stream the results
 @app.route('/img/api/v1.0/inferundone', methods = ['PUT'])
 #@auth.login_required
 def infer_undone():
     """
-    runs TensorFlow inference (recognition) on all images which are in the images 
-    list but for which inference has not already been run. Results are returned in JSON
+    runs TensorFlow inference (recognition) on the images which are in the images 
+    list but for which inference has not already been run, the oldest 
+    --max_images_per_request of them. Results are returned in JSON, with how
+    many undone images are 'remaining' for the next call, or with ?async=true
+    a job is returned, which runs in the background. ?model= picks a model
+    other than the default
     """
-    undone_imgs = [img for img in images if img['results'] == '']
+    undone_imgs, remaining = take_undone()
     if len(undone_imgs) == 0:
         abort(404)
+    model = request_model()
     
-    for img in undone_imgs:
-        # call TensorFlow
-        img['results'] = tf_operations.run_inference_on_image(img['url'])
+    if wants_async():
+        ticket = admission_control.admit(len(undone_imgs), batching.PRIORITY_BULK)
+        return job_response(start_infer_job(undone_imgs, ticket, model),
+                            remaining = remaining)
+    
+    # call TensorFlow, downloading and decoding images in parallel
+    ticket, deadline = admit(len(undone_imgs))
+    with ticket:
+        updates = tf_operations.infer_images([img['url'] for img in undone_imgs],
+                                             ticket.priority, deadline, model)
+    # the images done in time are kept, but the caller has given up
+    missed = any(tf_operations.missed_deadline(update) for update in updates)
+    save_updates([(img['id'], update) for img, update in zip(undone_imgs, updates)])
+    if missed:
+        abort(504)
+    updates = [tf_operations.split_update(update)[0] for update in updates]
+    done_imgs = [dict(img, **update) for img, update in zip(undone_imgs, updates)]
         
-    return jsonify({'images': undone_imgs}), 200
+    return jsonify({'images': done_imgs, 'remaining': remaining}), 200
 
 
 # test String
@@ -224,41 +550,35 @@ def add_imgs_infer():
     """
     adds new images to the image list and runs TensorFlow inference (recognition) 
     on them. New images must be provided with a URL, and given in JSON format. 
-    Results are returned in JSON format.
+    Results are returned in JSON format, or with ?async=true the new images are
+    returned straight away with a job, which runs inference in the background.
+    ?model= picks a model other than the default
     """
     if not request.json:
         abort(400)
         
-    missing_url = False
+    model = request_model()
     json_str = request.json
     img_data = json_str['new_imgs']
-    new_images = []
     
-    for img in img_data:
-        # URL is required, other fields not
-        if img.get('url') == None:
-            missing_url = True
-            continue
-        
-        if img.get('title') == None:
-            new_title = ""
-        else:
-            new_title = img.get('title')
-        # call TensorFlow
-        new_results = tf_operations.run_inference_on_image(img['url'])
-        
-        image = {
-            # simple way to ensure a unique id
-            'id' : images[-1]['id'] + 1,
-            'title': new_title,
-            # url is required, otherwise return error
-            'url': img['url'],
-            'results': new_results,
-            'resize': False,
-            'size': ""
-        }
-        images.append(image)
-        new_images.append(image)
+    # URL is required, other fields not
+    valid_imgs = [img for img in img_data if img.get('url') != None]
+    missing_url = len(valid_imgs) < len(img_data)
+    
+    if wants_async():
+        ticket = admission_control.admit(len(valid_imgs), batching.PRIORITY_BULK)
+        new_images = images.add_many([{'url': img['url'], 'title': img.get('title') or ""}
+                                      for img in valid_imgs])
+        return job_response(start_infer_job(new_images, ticket, model), images = new_images)
+    
+    # call TensorFlow, downloading and decoding images in parallel
+    ticket, deadline = admit(len(valid_imgs))
+    with ticket:
+        updates = tf_operations.infer_images([img['url'] for img in valid_imgs],
+                                             ticket.priority, deadline, model)
+    new_images = add_inferred(valid_imgs, updates)
+    if any(tf_operations.missed_deadline(update) for update in updates):
+        abort(504)
         
     if missing_url:
         return_val = jsonify(new_images), 410
@@ -268,6 +588,61 @@ def add_imgs_infer():
     return return_val
 
 
+def read_uploads():
+    """
+    returns the images uploaded with a request, as a list of (id, image data)
+    tuples. A multipart/form-data request may hold many images, each keyed
+    by its field name, or by its file name when several share a field name.
+    Any other request body is one image, keyed by the ?id= argument
+    """
+    if request.mimetype == 'multipart/form-data':
+        parts = list(request.files.items(multi = True))
+        names = [name for name, _ in parts]
+        uploads = []
+        for name, storage in parts:
+            if names.count(name) > 1 and storage.filename:
+                name = storage.filename
+            stream = storage.stream
+            if isinstance(stream, io.BytesIO):
+                uploads.append((name, stream.getvalue()))
+            else:
+                uploads.append((name, storage.read()))
+        return uploads
+    data = request.get_data(cache = False)
+    if not data:
+        return []
+    return [(request.args.get('id', 'image'), data)]
+
+
+# test String
+# curl -i -H "Content-Type: image/jpeg" --data-binary @nike.jpg "http://127.0.0.1:5000/img/api/v1.0/classify?id=nike"
+# curl -i -F nike=@nike.jpg -F altra=@altra.jpg http://127.0.0.1:5000/img/api/v1.0/classify
+@app.route('/img/api/v1.0/classify', methods = ['POST'])
+#@auth.login_required
+def classify_uploads():
+    """
+    runs TensorFlow inference (recognition) on images uploaded with the 
+    request, raw or as multipart/form-data, without downloading anything or 
+    adding them to the image list. Results are returned in JSON format, keyed 
+    by the ids given with the images. ?model= picks a model other than the 
+    default
+    """
+    model = request_model()
+    uploads = read_uploads()
+    if not uploads:
+        return make_response(jsonify({'error': 'no image data'}), 400)
+    ticket, deadline = admit(len(uploads))
+    with ticket:
+        updates = tf_operations.infer_image_data([data for _, data in uploads],
+                                                 ticket.priority, deadline, model)
+    if any(tf_operations.missed_deadline(update) for update in updates):
+        abort(504)
+    results = {}
+    for (upload_id, _), update in zip(uploads, updates):
+        results[upload_id] = tf_operations.split_update(update)[0]
+    return jsonify({'results': results})
+
+
 # test String
 # curl -i -H "Content-Type: application/json" -X DELETE http://127.0.0.1:5000/img/api/v1.0/images/3
 @app.route('/img/api/v1.0/images/<int:img_id>', methods=['DELETE'])
@@ -277,20 +652,317 @@ def delete_img(img_id):
     deletes an image from the server image list. The image ID must be given in the HTTP
     address
     """
-    img = [img for img in images if img['id'] == img_id]
-    if len(img) == 0:
+    if not images.delete(img_id):
         abort(404)
-    images.remove(img[0])
+    tf_operations.unlink_image(img_id)
     return jsonify({'result': True})
 
 
+# test string
+# curl -i http://127.0.0.1:5000/img/api/v1.0/similar/1
+# curl -i "http://127.0.0.1:5000/img/api/v1.0/similar/1?k=20"
+@app.route('/img/api/v1.0/similar/<int:img_id>', methods = ['GET'])
+#@auth.login_required
+def get_similar(img_id):
+    """
+    returns in JSON format the images most similar to an image, by the cosine 
+    similarity of their embeddings, best first. Inference must have been run 
+    on the image. Optional argument k, the number of images to return 
+    (default 10). Images with the same content have a score of 1.0. Returns
+    501 if embeddings are turned off, see --embedding_index
+    """
+    if img_id not in images:
+        abort(404)
+    try:
+        k = min(1000, max(1, int(request.args.get('k', 10))))
+    except ValueError:
+        abort(400)
+    index = tf_operations.get_embedding_index()
+    if index is None:
+        return make_response(jsonify(
+            {'error': 'embeddings are turned off, see --embedding_index'}), 501)
+    similar = index.similar(img_id, k)
+    if similar is None:
+        return make_response(jsonify({'error': 'no embedding for image'}), 404)
+    
+    results = []
+    for other_id, score in similar:
+        img = images.get(other_id)
+        if img is not None:
+            results.append({'id': other_id, 'url': img['url'], 
+                            'title': img['title'], 'score': round(score, 4)})
+    return jsonify({'id': img_id, 'similar': results})
+
+
+# test string
+# curl -i http://127.0.0.1:5000/img/api/v1.0/jobs/<job id>
+@app.route('/img/api/v1.0/jobs/<job_id>', methods = ['GET'])
+#@auth.login_required
+def get_job(job_id):
+    """
+    returns in JSON format the progress of a background inference job, given 
+    the job ID returned when it was started
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        forwarded = forward_job_request(job_id)
+        if forwarded is None:
+            abort(404)
+        return forwarded
+    return jsonify({'job': job.to_dict()})
+
+
+# test string
+# curl -i -N http://127.0.0.1:5000/img/api/v1.0/jobs/<job id>/results
+# curl -i -N -H "Accept: text/event-stream" http://127.0.0.1:5000/img/api/v1.0/jobs/<job id>/results
+@app.route('/img/api/v1.0/jobs/<job_id>/results', methods = ['GET'])
+#@auth.login_required
+def get_job_results(job_id):
+    """
+    streams the results of a background inference job as each image finishes.
+    Results are sent as newline-delimited JSON, or as server-sent events if the
+    client accepts text/event-stream or asks for ?format=sse
+    """
+    job = job_manager.get(job_id)
+    if job is None:
+        forwarded = forward_job_request(job_id)
+        if forwarded is None:
+            abort(404)
+        return forwarded
+    
+    if (request.args.get('format') == 'sse' or 
+            request.accept_mimetypes.best == 'text/event-stream'):
+        def events():
+            for i, img in enumerate(job.iter_results()):
+                yield 'id: %d\nevent: result\ndata: %s\n\n' % (i, app.json.dumps(img))
+            yield 'event: done\ndata: %s\n\n' % json.dumps(job.to_dict())
+        return Response(events(), mimetype = 'text/event-stream')
+    
+    def lines():
+        for img in job.iter_results():
+            yield app.json.dumps(img) + '\n'
+    return Response(lines(), mimetype = 'application/x-ndjson')
+
+
+# test string
+# curl -i http://127.0.0.1:5000/img/api/v1.0/stats
+@app.route('/img/api/v1.0/stats', methods = ['GET'])
+#@auth.login_required
+def get_stats():
+    """
+    returns in JSON format statistics from the inference engine, such as number 
+    of requests, per-request latency and resident memory before and after the 
+    model was loaded, batch occupancy from the batching scheduler, hits and
+    misses of the result cache, connection and timing counters of the 
+    image download pool, the size of the embedding index, admission control
+    counters, the models and their versions, and which worker process answered.
+    engine and batching are those of the default model
+    """
+    index = tf_operations.get_embedding_index()
+    worker = workers.current_worker()
+    return jsonify({'engine': tf_operations.get_engine().stats(),
+                    'batching': tf_operations.get_scheduler().stats(),
+                    'models': tf_operations.get_registry().stats(),
+                    'result_cache': tf_operations.get_result_cache().stats(),
+                    'http_pool': tf_operations.get_http_pool().stats(),
+                    'embeddings': None if index is None else index.stats(),
+                    'admission': admission_control.stats(),
+                    'worker': None if worker is None else worker.to_dict()})
+
+
+# test string
+# curl -i http://127.0.0.1:5000/img/api/v1.0/models
+@app.route('/img/api/v1.0/models', methods = ['GET'])
+#@auth.login_required
+def get_models():
+    """
+    returns in JSON format the models which can be chosen with ?model=, with
+    the state, version and estimated memory of those loaded, and the memory
+    budget
+    """
+    return jsonify({'models': tf_operations.get_registry().stats()})
+
+
+# test string
+# curl -X PUT -i -H "Content-Type: application/json" -d '{"model_dir": "/tmp/imagenet-v2", "variant": "fp16"}' http://127.0.0.1:5000/img/api/v1.0/models/default
+# curl -X DELETE -i http://127.0.0.1:5000/img/api/v1.0/models/fp16
+@app.route('/img/api/v1.0/models/<name>', methods = ['PUT', 'DELETE'])
+#@auth.login_required
+def change_model(name):
+    """
+    loads a new version of a model with PUT, from the JSON fields model_dir and
+    variant, by default those of the current version, e.g. to pick up new 
+    files. A new name adds a model. The new version is loaded and warmed up in
+    the background, then swapped in; requests already running finish on the
+    old one. Returns 202 with the version being loaded. DELETE closes the 
+    loaded version of a model until it is next used. With --workers, only the
+    worker which answers is changed
+    """
+    registry = tf_operations.get_registry()
+    if request.method == 'DELETE':
+        registry.spec(name)
+        return jsonify({'result': registry.evict(name)})
+    settings = request.get_json(silent = True) or {}
+    try:
+        model = tf_operations.swap_model(name, settings.get('model_dir'),
+                                         settings.get('variant'))
+    except ValueError as e:
+        return make_response(jsonify({'error': str(e)}), 400)
+    return jsonify({'model': dict(model.spec.to_dict(), version = model.version)}), 202
+
+
+# test string
+# curl -i http://127.0.0.1:5000/img/api/v1.0/ready
+@app.route('/img/api/v1.0/ready', methods = ['GET'])
+def get_ready():
+    """
+    returns 200 once the model is loaded and warmed up, otherwise 503, with
+    the state of the warm-up in JSON format. For load balancer health checks
+    """
+    status = tf_operations.readiness()
+    return make_response(jsonify(status), 200 if status['ready'] else 503)
+
+
+# test string
+# curl -i http://127.0.0.1:5000/metrics
+@app.route('/metrics', methods = ['GET'])
+def get_metrics():
+    """
+    returns request counts, per-stage latency histograms, error counts, cache 
+    hits, queue depth and batch sizes in the Prometheus text format. With 
+    --workers, each scrape is answered by one worker, for that worker
+    """
+    return Response(metrics.render(), 
+                    mimetype = 'text/plain; version=0.0.4; charset=utf-8')
+
+
+# test string
+# curl -i http://127.0.0.1:5000/img/api/v1.0/profiler
+# curl -X PUT -i -H "Content-Type: application/json" -d '{"running": true, "interval_ms": 5, "reset": true}' http://127.0.0.1:5000/img/api/v1.0/profiler
+@app.route('/img/api/v1.0/profiler', methods = ['GET', 'PUT'])
+#@auth.login_required
+def profiler_state():
+    """
+    starts or stops the sampling profiler with PUT, and returns its state.
+    Optional JSON fields: running, interval_ms and reset, to drop the samples
+    taken so far
+    """
+    sampler = profiler.get_profiler()
+    if request.method == 'PUT':
+        settings = request.get_json(silent = True) or {}
+        if settings.get('reset'):
+            sampler.reset()
+        if 'running' in settings:
+            if settings['running']:
+                interval_ms = settings.get('interval_ms')
+                sampler.start(None if interval_ms is None else float(interval_ms))
+            else:
+                sampler.stop()
+    return jsonify({'profiler': sampler.stats()})
+
+
+# test string
+# curl -i http://127.0.0.1:5000/img/api/v1.0/profiler/stacks > stacks.folded
+@app.route('/img/api/v1.0/profiler/stacks', methods = ['GET'])
+#@auth.login_required
+def profiler_stacks():
+    """
+    returns the stacks sampled by the profiler in the folded format, for 
+    flamegraph.pl or speedscope
+    """
+    return Response(profiler.get_profiler().folded(), mimetype = 'text/plain')
+
+
+def set_upload_limit():
+    """
+    makes werkzeug answer 413 for request bodies over --max_upload_bytes,
+    from their Content-Length, before they are read into memory
+    """
+    app.config['MAX_CONTENT_LENGTH'] = tf_operations.FLAGS.max_upload_bytes or None
+
+
+def start(worker = None):
+    """
+    opens the image store, loads the model and starts the background threads 
+    of one serving process. worker is the workers.WorkerInfo of a worker 
+    process, or None
+    """
+    FLAGS = tf_operations.FLAGS
+    set_upload_limit()
+    # keeps images and results across restarts, by default in SQLite
+    global images
+    images = image_store.open_store(FLAGS.image_store, INITIAL_IMAGES)
+    # checks --models before anything is loaded
+    tf_operations.get_registry()
+    # load the model once, so requests only pay for a forward pass. In the 
+    # background, the server answers while TensorFlow is imported, and 
+    # inference requests wait for the model, see /img/api/v1.0/ready
+    tf_operations.start_warm_up(FLAGS.warm_up == 'background')
+    if FLAGS.profile_interval_ms > 0:
+        profiler.get_profiler().start(FLAGS.profile_interval_ms)
+    global admission_control
+    admission_control = admission.AdmissionController(
+        FLAGS.max_queued_images, FLAGS.bulk_share, FLAGS.max_images_per_request)
+    global job_manager
+    job_manager = jobs.JobManager(FLAGS.job_workers, 
+                                  id_prefix = '' if worker is None else worker.job_prefix)
+
+
+def run_worker(worker, sock):
+    """runs in each worker process, serves the API on the shared socket"""
+    FLAGS = tf_operations.FLAGS
+    # size TensorFlow's thread pools to this worker's cores
+    FLAGS.intra_op_threads, FLAGS.inter_op_threads = workers.thread_counts(
+        len(worker.cores), FLAGS.intra_op_threads, FLAGS.inter_op_threads)
+    os.environ['OMP_NUM_THREADS'] = str(FLAGS.intra_op_threads)
+    start(worker)
+    if FLAGS.frontend == 'asgi':
+        asgi = import_asgi()
+        asgi.serve(sock, worker)
+    else:
+        workers.serve(app, sock, worker)
+
+
+def import_asgi():
+    """imports the asyncio front end, which imports this module"""
+    try:
+        from recognition_server import asgi
+    except:
+        import asgi
+    return asgi
+
+
 def main(_):
     tf_operations.parse_args()
+    FLAGS = tf_operations.FLAGS
     # checks if model data is downloaded. If not, does that
     tf_operations.download_and_extract_model_if_needed()
-    app.run(host = '0.0.0.0')
+    if FLAGS.workers <= 1:
+        # builds the --model_variant graph once, if it is not already cached
+        tf_operations.model_graph_path()
+        start()
+        if FLAGS.frontend == 'asgi':
+            import_asgi().serve()
+        else:
+            app.run(host = FLAGS.host, port = FLAGS.port)
+        return
+    
+    if FLAGS.image_store == 'memory':
+        sys.exit('--workers needs a shared image store, e.g. --image_store sqlite:<path>')
+    # builds the variant graphs once, in a subprocess, rather than in every
+    # worker at once or with TensorFlow imported here before forking
+    registry = tf_operations.get_registry()
+    for name in registry.names():
+        spec = registry.spec(name)
+        graph_optimize.ensure_variant_in_subprocess(spec.model_dir, spec.variant)
+    # compile the label table once, so every worker maps the same file. The
+    # label files are read without TensorFlow, which must not be imported 
+    # before the workers are forked
+    tf_operations.get_node_lookup()
+    workers.WorkerSupervisor(FLAGS.workers, run_worker, FLAGS.host, 
+                             FLAGS.port).run()
 
 
 if __name__ == '__main__':
-    tf_operations.tf.app.run(main = main, argv = [sys.argv[0]])
+    main(sys.argv)
     
\ No newline at end of file
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: content-addressed cache of inference results
+
+The cache has two levels. The first maps an image URL to the hash of the
+image content last downloaded from it, with the ETag and Last-Modified
+headers needed to check whether it has changed. The second maps a content
+hash to the inference results for those bytes, so re-hosted copies of the
+same image share one result. Both levels are LRU dictionaries in memory, and
+results can also be kept on disk. Results belong to a model key, which
+covers the model files and the settings which change results; when the key
+changes the results are dropped.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+try:
+    from recognition_server import postprocess
+except:
+    import postprocess
+
+
+def content_hash(image_data):
+    """returns the hex SHA-256 digest of encoded image data"""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+class ResultCache(object):
+    """
+    LRU cache of URL to content hash, and of content hash to inference
+    results, with an optional on-disk tier for results and hit/miss counters
+    """
+
+    def __init__(self, max_entries = 10000, cache_dir = None, model_key = ''):
+        self.max_entries = max(1, int(max_entries))
+        self.cache_dir = cache_dir or None
+        self.model_key = model_key
+        self._urls = OrderedDict()
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ['url_hits', 'url_misses', 'result_hits', 'result_misses',
+             'disk_hits', 'evictions'], 0)
+
+    def _count(self, name):
+        self.counters[name] += 1
+
+    @staticmethod
+    def _put_lru(table, key, value, max_entries):
+        """adds to an LRU dictionary, returns the number of entries evicted"""
+        table[key] = value
+        table.move_to_end(key)
+        evicted = 0
+        while len(table) > max_entries:
+            table.popitem(last = False)
+            evicted += 1
+        return evicted
+
+    def set_model_key(self, model_key):
+        """
+        switches to a new model key. Cached results for the old key are
+        dropped, since a different model or settings give different results.
+        The URL level is kept, as it only depends on image content
+        """
+        with self._lock:
+            if model_key == self.model_key:
+                return
+            self.model_key = model_key
+            self._results.clear()
+
+    def get_url(self, url):
+        """
+        returns (content_hash, etag, last_modified) for the last download of
+        url, or None
+        """
+        with self._lock:
+            entry = self._urls.get(url)
+            if entry is None:
+                self._count('url_misses')
+                return None
+            self._urls.move_to_end(url)
+            self._count('url_hits')
+            return entry
+
+    def put_url(self, url, content_hash, etag = None, last_modified = None):
+        """records the content hash and cache validators of a download"""
+        with self._lock:
+            self.counters['evictions'] += self._put_lru(
+                self._urls, url, (content_hash, etag, last_modified),
+                self.max_entries)
+
+    def forget_url(self, url):
+        """drops the URL entry, e.g. when the remote image has changed"""
+        with self._lock:
+            self._urls.pop(url, None)
+
+    def _disk_path(self, content_hash):
+        return os.path.join(self.cache_dir, self.model_key, content_hash[:2],
+                            content_hash + '.json')
+
+    def get_results(self, content_hash):
+        """returns the cached results for a content hash, or None"""
+        with self._lock:
+            results = self._results.get(content_hash)
+            if results is not None:
+                self._results.move_to_end(content_hash)
+                self._count('result_hits')
+                return results
+            model_key = self.model_key
+        if self.cache_dir:
+            try:
+                with open(self._disk_path(content_hash)) as f:
+                    results = json.load(f, object_hook = postprocess.json_object_hook)
+            except (IOError, OSError, ValueError):
+                results = None
+            if results is not None:
+                with self._lock:
+                    if model_key == self.model_key:
+                        self._count('disk_hits')
+                        self._count('result_hits')
+                        self.counters['evictions'] += self._put_lru(
+                            self._results, content_hash, results, self.max_entries)
+                        return results
+        with self._lock:
+            self._count('result_misses')
+        return None
+
+    def put_results(self, content_hash, results):
+        """caches the results for a content hash, in memory and on disk"""
+        with self._lock:
+            self.counters['evictions'] += self._put_lru(
+                self._results, content_hash, results, self.max_entries)
+        if self.cache_dir:
+            path = self._disk_path(content_hash)
+            try:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                # write to a temporary file first, so a reader never sees half a file
+                tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+                with open(tmp_path, 'w') as f:
+                    json.dump(results, f, default = postprocess.json_default)
+                os.replace(tmp_path, path)
+            except (IOError, OSError):
+                pass
+
+    def clear(self):
+        """drops everything held in memory"""
+        with self._lock:
+            self._urls.clear()
+            self._results.clear()
+
+    def stats(self):
+        """returns the hit/miss counters and sizes as a dictionary"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['urls'] = len(self._urls)
+            stats['results'] = len(self._results)
+        return stats
@@ -8,43 +8,164 @@ import numpy as np
 import sys
 import os.path
 import argparse
-import tensorflow as tf
 import tarfile
 import re
-import urllib
+import io
+import json
+import time
+import hashlib
+import logging
+import asyncio
+import functools
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+try:
+    from recognition_server import batching
+    from recognition_server import pipeline
+    from recognition_server import result_cache
+    from recognition_server import fetcher
+    from recognition_server import http_pool
+    from recognition_server import preprocess
+    from recognition_server import postprocess
+    from recognition_server import embedding_index
+    from recognition_server import graph_optimize
+    from recognition_server import metrics
+    from recognition_server import lazy_module
+    from recognition_server import async_fetch
+    from recognition_server import model_registry
+except:
+    import batching
+    import pipeline
+    import result_cache
+    import fetcher
+    import http_pool
+    import preprocess
+    import postprocess
+    import embedding_index
+    import graph_optimize
+    import metrics
+    import lazy_module
+    import async_fetch
+    import model_registry
 
 
+# TensorFlow is imported when the model is first loaded, not with this module
+tf = lazy_module.LazyModule('tensorflow')
+# for messages before TensorFlow is imported, which tf.logging would import
+logger = logging.getLogger(__name__)
 # stores command line args, such as recognition confidence threshold
 FLAGS = None
+# results of an image dropped because its caller's deadline passed
+DEADLINE_EXCEEDED = {"error": "deadline exceeded"}
 # URL for inception model data
 DATA_URL = 'http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz'
+# name of the model from --model_dir and --model_variant, used when a request
+# doesn't choose one
+DEFAULT_MODEL = 'default'
+# the shared registry of models, each with its inference engine and 
+# micro-batching scheduler, created on first use or at server startup
+_registry = None
+_registry_lock = threading.Lock()
+_engine_lock = threading.Lock()
+# the shared cache of inference results, by URL and by image content
+_result_cache = None
+# the shared pool of keep-alive connections for image downloads
+_http_pool = None
+# the shared index of image embeddings, for similarity search
+_embedding_index = None
+# the asyncio download pool of the ASGI front end, with its event loop, and
+# the threads which decode images for it
+_async_pool = None
+_cpu_executor = None
+# compiled label table, written next to the model files on first startup
+LABELS_CACHE_FILE = 'node_labels.npy'
+# the shared label table, parsed or memory-mapped once per process, and
+# those of models in other directories, by directory
+_node_lookup = None
+_node_lookups = {}
+_node_lookup_lock = threading.Lock()
+# sizes and checksums of the extracted model files, written after extracting
+MODEL_MANIFEST_FILE = 'model_manifest.json'
+# the background thread loading the model, and how loading went
+_warm_up_thread = None
+_warm_up_done = threading.Event()
+_warm_up_status = {'state': 'not started', 'error': None, 'seconds': None}
 
 
 class NodeLookup(object):
-  """Converts integer node ID's to human readable labels."""
+  """Converts integer node ID's to human readable labels.
 
-  def __init__(self, label_lookup_path = None, uid_lookup_path = None):
+  The labels are held as an array indexed by node ID. The array is compiled
+  from the text label files once and saved as a .npy sidecar file, which
+  later startups memory-map instead of parsing the text files again.
+  """
+
+  def __init__(self, label_lookup_path = None, uid_lookup_path = None,
+               cache_path = None, model_dir = None):
+    if not (label_lookup_path and uid_lookup_path):
+      model_dir = model_dir or FLAGS.model_dir
     if not label_lookup_path:
       label_lookup_path = os.path.join(
-          FLAGS.model_dir, 'imagenet_2012_challenge_label_map_proto.pbtxt')
+          model_dir, 'imagenet_2012_challenge_label_map_proto.pbtxt')
     if not uid_lookup_path:
       uid_lookup_path = os.path.join(
-          FLAGS.model_dir, 'imagenet_synset_to_human_label_map.txt')
-    self.node_lookup = self.load(label_lookup_path, uid_lookup_path)
+          model_dir, 'imagenet_synset_to_human_label_map.txt')
+    if not cache_path:
+      cache_path = os.path.join(
+          os.path.dirname(label_lookup_path), LABELS_CACHE_FILE)
+    self.node_lookup = self.load_cached(
+        label_lookup_path, uid_lookup_path, cache_path)
+
+  def load_cached(self, label_lookup_path, uid_lookup_path, cache_path):
+    """Returns the label array, from the sidecar file if it is up to date.
+    Otherwise parses the text files and writes a new sidecar file.
+    """
+    try:
+      cache_mtime = os.path.getmtime(cache_path)
+      if (cache_mtime >= os.path.getmtime(label_lookup_path) and
+          cache_mtime >= os.path.getmtime(uid_lookup_path)):
+        return np.load(cache_path, mmap_mode = 'r')
+    except (IOError, OSError, ValueError):
+      pass
+
+    labels = self.to_array(self.load(label_lookup_path, uid_lookup_path))
+    try:
+      # write to a temporary file first, so a reader never sees half a file
+      tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+      with open(tmp_path, 'wb') as f:
+        np.save(f, labels)
+      os.replace(tmp_path, cache_path)
+    except (IOError, OSError):
+      logger.warning('Could not write label cache %s', cache_path)
+    return labels
+
+  @staticmethod
+  def to_array(node_id_to_name):
+    """Converts a dict from node ID to label into a fixed-width string array,
+    with empty strings for unused node IDs.
+    """
+    size = max(node_id_to_name) + 1 if node_id_to_name else 0
+    labels = np.full(size, '', dtype = object)
+    for key, val in node_id_to_name.items():
+      labels[key] = val
+    return labels.astype(np.str_)
 
   def load(self, label_lookup_path, uid_lookup_path):
     """Loads a human readable English name for each softmax node.
     Arg is a label_lookup_path: string UID to integer node ID.
     Returns a dict from integer node ID to human-readable string.
+    The files are plain local text, read without TensorFlow, so labels can
+    be compiled before worker processes are forked.
     """
-    if not tf.gfile.Exists(uid_lookup_path):
-      tf.logging.fatal('File does not exist %s', uid_lookup_path)
-    if not tf.gfile.Exists(label_lookup_path):
-      tf.logging.fatal('File does not exist %s', label_lookup_path)
+    for path in (uid_lookup_path, label_lookup_path):
+      if not os.path.exists(path):
+        raise IOError('File does not exist %s' % path)
 
     # Loads mapping from string UID to human-readable string
-    proto_as_ascii_lines = tf.gfile.GFile(uid_lookup_path).readlines()
+    with open(uid_lookup_path) as f:
+      proto_as_ascii_lines = f.readlines()
     uid_to_human = {}
     p = re.compile(r'[n\d]*[ \S,]*')
     for line in proto_as_ascii_lines:
@@ -55,7 +176,8 @@ class NodeLookup(object):
 
     # Loads mapping from string UID to integer node ID.
     node_id_to_uid = {}
-    proto_as_ascii = tf.gfile.GFile(label_lookup_path).readlines()
+    with open(label_lookup_path) as f:
+      proto_as_ascii = f.readlines()
     for line in proto_as_ascii:
       if line.startswith('  target_class:'):
         target_class = int(line.split(': ')[1])
@@ -67,7 +189,8 @@ class NodeLookup(object):
     node_id_to_name = {}
     for key, val in node_id_to_uid.items():
       if val not in uid_to_human:
-        tf.logging.fatal('Failed to locate: %s', val)
+        logger.error('Failed to locate: %s', val)
+        continue
       name = uid_to_human[val]
       node_id_to_name[key] = name
 
@@ -75,101 +198,1058 @@ class NodeLookup(object):
 
   def id_to_string(self, node_id):
     """ looksup node_id"""
-    if node_id not in self.node_lookup:
+    if node_id < 0 or node_id >= len(self.node_lookup):
       return ''
-    return self.node_lookup[node_id]
+    return str(self.node_lookup[node_id])
+
+
+def get_node_lookup(model = None):
+  """returns the process-wide NodeLookup, creating it if necessary. Models 
+  served from other directories than --model_dir, by name or by ModelSpec,
+  get their own
+  """
+  global _node_lookup
+  if isinstance(model, model_registry.ModelSpec):
+    model_dir = model.model_dir
+  else:
+    model_dir = get_registry().spec(model or DEFAULT_MODEL).model_dir
+  with _node_lookup_lock:
+    if model_dir == FLAGS.model_dir:
+      if _node_lookup is None:
+        with metrics.STAGE_SECONDS.time(stage = 'labels_load'):
+          _node_lookup = NodeLookup()
+      return _node_lookup
+    if model_dir not in _node_lookups:
+      with metrics.STAGE_SECONDS.time(stage = 'labels_load'):
+        _node_lookups[model_dir] = NodeLookup(model_dir = model_dir)
+    return _node_lookups[model_dir]
 
 
-def create_graph():
-  """Creates a graph from saved GraphDef file."""
-  with tf.gfile.FastGFile(os.path.join(
-      FLAGS.model_dir, 'classify_image_graph_def.pb'), 'rb') as f:
+def create_graph(input_map = None, graph_path = None):
+  """Creates a graph from saved GraphDef file.
+  input_map optionally remaps tensors of the saved graph to existing tensors.
+  graph_path defaults to the --model_variant graph in --model_dir.
+  """
+  if graph_path is None:
+    graph_path = model_graph_path()
+  with tf.gfile.FastGFile(graph_path, 'rb') as f:
     graph_def = tf.GraphDef()
     graph_def.ParseFromString(f.read())
-    _ = tf.import_graph_def(graph_def, name='')
+    _ = tf.import_graph_def(graph_def, input_map = input_map, name='')
+
+
+def model_graph_path(spec = None):
+  """
+  returns the path of the GraphDef selected by --model_variant, or of a
+  model_registry.ModelSpec, building it if needed
+  """
+  if spec is None:
+    return graph_optimize.ensure_variant(FLAGS.model_dir, FLAGS.model_variant)
+  return graph_optimize.ensure_variant(spec.model_dir, spec.variant)
+
+
+def resident_memory():
+    """
+    returns the resident set size of this process in bytes. Uses /proc where
+    available, otherwise falls back to the peak RSS reported by getrusage
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        import resource
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class InferenceEngine(object):
+    """
+    owns one TensorFlow graph and one session for the lifetime of the process.
+    The Inception GraphDef is parsed and imported once, in load(), so each
+    request only costs a single forward pass. Also keeps simple per-request
+    latency and memory statistics.
+
+    The saved graph decodes a single JPEG and reshapes pool_3 to a batch of 
+    one, so it cannot classify several images at once. The engine therefore
+    skips the graph's own decoding: images are decoded and resized with PIL 
+    by preprocess(), and predict_batch() feeds a stack of them through the 
+    network and a batch-aware copy of the softmax layer. With embeddings=True,
+    the same forward pass also returns each image's pool_3 feature vector.
+    intra_op_threads and inter_op_threads size TensorFlow's thread pools, 0
+    leaves them to TensorFlow. graph_path picks a GraphDef file other than
+    the --model_variant one, as does model, a model_registry.ModelSpec, which
+    also picks the label table
+    """
+
+    # input size expected by the Inception v3 graph
+    image_size = preprocess.INPUT_SIZE
+
+    # length of the pool_3 feature vector
+    embedding_size = 2048
+
+    def __init__(self, embeddings = False, intra_op_threads = 0, inter_op_threads = 0,
+                 graph_path = None, model = None):
+        self.embeddings = embeddings
+        self.graph_path = graph_path
+        self.model = model
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.graph = None
+        self.sess = None
+        self.batch_input = None
+        self.softmax_tensor = None
+        self.embedding_tensor = None
+        self.node_lookup = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.num_batches = 0
+        self.num_images = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self.rss_before_load = 0
+        self.rss_after_load = 0
+
+    def load(self):
+        """imports the graph into a private tf.Graph and opens the session"""
+        with self._lock:
+            if self.sess is not None:
+                return
+            self.rss_before_load = resident_memory()
+            start = time.perf_counter()
+            graph = tf.Graph()
+            with graph.as_default():
+                # 'Mul:0' is the resized and normalised image. Its consumers 
+                # are rewired to a placeholder which takes a whole batch
+                batch_input = tf.placeholder(
+                    tf.float32, [None, self.image_size, self.image_size, 3],
+                    name = 'batch_input')
+                if self.graph_path is None:
+                    self.graph_path = model_graph_path(self.model)
+                create_graph({'Mul:0': batch_input}, self.graph_path)
+                pool = graph.get_tensor_by_name('pool_3:0')
+                weights = graph.get_tensor_by_name('softmax/weights:0')
+                biases = graph.get_tensor_by_name('softmax/biases:0')
+                self.embedding_tensor = tf.reshape(
+                    pool, [-1, self.embedding_size], name = 'batch_embeddings')
+                logits = tf.matmul(self.embedding_tensor, weights) + biases
+                self.softmax_tensor = tf.nn.softmax(logits, name = 'batch_softmax')
+            self.graph = graph
+            self.batch_input = batch_input
+            # by spec, as a new version isn't served under its name until
+            # it has been loaded
+            self.node_lookup = get_node_lookup(self.model)
+            config = tf.ConfigProto(
+                intra_op_parallelism_threads = self.intra_op_threads,
+                inter_op_parallelism_threads = self.inter_op_threads)
+            self.sess = tf.Session(graph = graph, config = config)
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - start,
+                                          stage = 'model_load')
+            self.rss_after_load = resident_memory()
+            tf.logging.info('model loaded, rss %.1f MB -> %.1f MB',
+                            self.rss_before_load / 1e6, self.rss_after_load / 1e6)
+
+    def warm_up(self):
+        """
+        loads the model and runs one forward pass on a blank image, so the 
+        first real request doesn't pay for TensorFlow's lazy initialisation
+        """
+        self.load()
+        buf = io.BytesIO()
+        Image.new('RGB', (self.image_size, self.image_size)).save(buf, format = 'JPEG')
+        self.predict(buf.getvalue())
+
+    def preprocess(self, image_data):
+        """
+        decodes, resizes and normalises encoded image data. Returns a float 
+        array of shape (1, 299, 299, 3)
+        """
+        return preprocess.preprocess_image(image_data, self.image_size).tensor
+
+    def predict_batch(self, image_tensors, embeddings = None):
+        """
+        runs one forward pass on a list of preprocessed images. Returns a 2-D 
+        array of prediction scores, one row per image and one column per class.
+        If embeddings is True (by default, if the engine was made with 
+        embeddings), returns the scores and a 2-D array of pool_3 feature 
+        vectors, one row per image, as a tuple
+        """
+        self.load()
+        if embeddings is None:
+            embeddings = self.embeddings
+        batch = np.concatenate(image_tensors, axis = 0)
+        start = time.time()
+        if embeddings:
+            predictions = self.sess.run(
+                (self.softmax_tensor, self.embedding_tensor),
+                {self.batch_input: batch})
+        else:
+            predictions = self.sess.run(self.softmax_tensor,
+                                        {self.batch_input: batch})
+        latency = time.time() - start
+        with self._stats_lock:
+            self.num_batches += 1
+            self.num_images += len(batch)
+            self.total_latency += latency
+            self.last_latency = latency
+        tf.logging.info('inference on %d images took %.1f ms, rss %.1f MB',
+                        len(batch), latency * 1000, resident_memory() / 1e6)
+        return predictions
+
+    def predict(self, image_data):
+        """
+        runs the softmax tensor on encoded image data. Returns a 1-D array of 
+        prediction scores, one per class
+        """
+        return self.predict_batch([self.preprocess(image_data)], False)[0]
+
+    def stats(self):
+        """returns request count, latency and memory statistics as a dictionary"""
+        with self._stats_lock:
+            num_batches = self.num_batches
+            num_images = self.num_images
+            total_latency = self.total_latency
+            last_latency = self.last_latency
+        if num_batches:
+            mean_latency = total_latency / num_batches
+        else:
+            mean_latency = 0.0
+        return {
+            'loaded': self.sess is not None,
+            'num_batches': num_batches,
+            'num_images': num_images,
+            'mean_latency_ms': round(mean_latency * 1000, 3),
+            'last_latency_ms': round(last_latency * 1000, 3),
+            'rss_before_load': self.rss_before_load,
+            'rss_after_load': self.rss_after_load,
+            'rss_current': resident_memory()
+        }
+
+    def close(self):
+        """closes the session and releases the graph"""
+        with self._lock:
+            if self.sess is not None:
+                self.sess.close()
+            self.sess = None
+            self.graph = None
+
+
+def parse_models(text):
+    """
+    parses --models, comma separated name=model_dir[:variant] entries, into a
+    list of model_registry.ModelSpec
+    """
+    specs = []
+    for entry in text.split(','):
+        if not entry.strip():
+            continue
+        spec = model_registry.ModelSpec.parse(entry)
+        if spec.variant not in graph_optimize.VARIANTS:
+            raise ValueError('unknown model variant %s' % spec.variant)
+        specs.append(spec)
+    return specs
+
+
+def default_model_spec():
+    """returns the ModelSpec of the default model, from --model_dir and --model_variant"""
+    return model_registry.ModelSpec(DEFAULT_MODEL, FLAGS.model_dir, FLAGS.model_variant)
+
+
+def make_model(spec, version = 1):
+    """
+    returns an unloaded model_registry.Model for a ModelSpec: its engine and
+    the BatchScheduler in front of it. Only the default model keeps 
+    embeddings, while it is the model the embedding index was made for
+    """
+    embeddings = (embeddings_enabled() and spec.name == DEFAULT_MODEL and
+                  _model_files_key(spec) == _model_files_key())
+    engine = InferenceEngine(embeddings, FLAGS.intra_op_threads,
+                             FLAGS.inter_op_threads, model = spec)
+    scheduler = batching.BatchScheduler(
+        engine, FLAGS.max_batch_size, FLAGS.batch_timeout_ms,
+        postprocess = postprocess_batch)
+    return model_registry.Model(spec, engine, scheduler, model_key(spec), version,
+                                on_load = _model_loaded)
+
+
+def _model_loaded(model):
+    """
+    sets the key of a model's results again once it is loaded, as loading may
+    have downloaded its files or built its variant, and its label table
+    """
+    model.key = model_key(model.spec)
+    model.labels = model.engine.node_lookup
+
+
+def refresh_model_keys():
+    """
+    sets the keys of the loaded models again, after the settings which change
+    inference results may have changed. Keys are otherwise only computed when
+    a model version is made or loaded, see make_model
+    """
+    if _registry is not None:
+        for model in _registry.models().values():
+            model.key = model_key(model.spec)
+
+
+def get_registry():
+    """
+    returns the process-wide ModelRegistry, creating it if necessary, with
+    the default model and those of --models
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            registry = model_registry.ModelRegistry(
+                make_model, FLAGS.model_memory_budget_mb * 1e6, DEFAULT_MODEL)
+            registry.register(default_model_spec())
+            for spec in parse_models(FLAGS.models):
+                registry.register(spec)
+            _registry = registry
+        return _registry
+
+
+def swap_model(name, model_dir = None, variant = None, background = True):
+    """
+    loads a new version of a model, by name, and swaps it in once it is warmed
+    up, see ModelRegistry.swap. model_dir and variant default to those of the
+    current version. Returns the new model_registry.Model, or raises 
+    ValueError for a new model without a model_dir, or an unknown variant
+    """
+    registry = get_registry()
+    try:
+        current = registry.spec(name)
+    except model_registry.UnknownModel:
+        current = None
+    model_dir = model_dir or (current and current.model_dir)
+    variant = variant or (current and current.variant) or 'original'
+    if not model_dir:
+        raise ValueError('model_dir required for a new model')
+    if variant not in graph_optimize.VARIANTS:
+        raise ValueError('unknown model variant %s' % variant)
+    return registry.swap(model_registry.ModelSpec(name, model_dir, variant), background)
+
+
+def get_engine(model = None):
+    """
+    returns the InferenceEngine of the current version of a model, by name,
+    the default model by default. It is not loaded here
+    """
+    return get_registry().get(model, load = False).engine
+
+
+def get_scheduler(model = None):
+    """
+    returns the BatchScheduler in front of the engine of a model, as 
+    get_engine, starting it if necessary
+    """
+    scheduler = get_registry().get(model, load = False).scheduler
+    scheduler.start()
+    return scheduler
+
+
+def _warm_up():
+    start = time.perf_counter()
+    try:
+        get_registry().get()
+        get_scheduler()
+        get_embedding_index()
+    except Exception as e:
+        tf.logging.error('model warm-up failed: %s', e)
+        _warm_up_status.update(state = 'failed', error = str(e))
+    else:
+        _warm_up_status.update(state = 'ready')
+    _warm_up_status['seconds'] = round(time.perf_counter() - start, 3)
+    _warm_up_done.set()
+
+
+def start_warm_up(background = True):
+    """
+    imports TensorFlow, loads the model and runs one forward pass, in a 
+    background thread unless background is False. Only the first call 
+    does anything, see readiness()
+    """
+    global _warm_up_thread
+    with _engine_lock:
+        if _warm_up_thread is not None:
+            return
+        _warm_up_status['state'] = 'loading'
+        _warm_up_thread = threading.Thread(target = _warm_up, name = 'warm-up')
+        _warm_up_thread.daemon = True
+        _warm_up_thread.start()
+    if not background:
+        _warm_up_thread.join()
+
+
+def wait_until_ready(timeout = None):
+    """waits for the warm-up to finish, returns whether the model is ready"""
+    _warm_up_done.wait(timeout)
+    return _warm_up_status['state'] == 'ready'
+
+
+def readiness():
+    """
+    returns the state of the model warm-up as a dictionary: 'not started', 
+    'loading', 'ready' or 'failed', with the error and the seconds it took
+    """
+    return dict(_warm_up_status, ready = _warm_up_status['state'] == 'ready')
 
 
-def check_valid_url(imgURL):
+def _model_files_key(spec = None):
+    """
+    returns a string identifying the model files and the preprocessing, of
+    --model_dir and --model_variant or of a ModelSpec
+    """
+    spec = spec or default_model_spec()
+    try:
+        statinfo = os.stat(os.path.join(spec.model_dir, graph_optimize.GRAPH_FILE))
+        size, mtime = statinfo.st_size, statinfo.st_mtime
+    except OSError:
+        # model not downloaded yet
+        size, mtime = 0, 0
+    return '%s:%d:%d:%s:%s' % (os.path.abspath(spec.model_dir), size, mtime,
+                               spec.variant, preprocess.VERSION)
+
+
+def model_key(spec = None):
+    """
+    returns a short key identifying the model files and the settings which 
+    change inference results, so cached results can be invalidated. spec is
+    a ModelSpec, by default that of the default model
+    """
+    if spec is None:
+        spec = get_registry().spec(DEFAULT_MODEL)
+    key = '%s:%d:%r' % (_model_files_key(spec), FLAGS.num_top_predictions,
+                        FLAGS.threshold)
+    return result_cache.content_hash(key.encode('utf-8'))[:16]
+
+
+def results_key(image_hash, model = None):
+    """
+    returns the result cache key of an image's results from a model, by name,
+    or from a model_registry.Model. The default model's results are kept 
+    under the image's content hash, as the whole cache is dropped when it 
+    changes, see get_result_cache
+    """
+    if not isinstance(model, model_registry.Model):
+        if model is None or model == DEFAULT_MODEL:
+            return image_hash
+        model = get_registry().get(model, load = False)
+    if model.name == DEFAULT_MODEL:
+        return image_hash
+    key = '%s:%s' % (model.key, image_hash)
+    return result_cache.content_hash(key.encode('utf-8'))
+
+
+def embeddings_enabled():
+    """returns True if image embeddings are kept, see --embedding_index"""
+    return FLAGS.embedding_index not in ('', 'none')
+
+
+def get_embedding_index():
+    """
+    returns the process-wide EmbeddingIndex, creating it if necessary, or None
+    if embeddings are turned off
+    """
+    global _embedding_index
+    if not embeddings_enabled():
+        return None
+    with _engine_lock:
+        if _embedding_index is None:
+            path = None
+            if FLAGS.embedding_index != 'memory':
+                path = FLAGS.embedding_index
+            key = result_cache.content_hash(_model_files_key().encode('utf-8'))[:16]
+            _embedding_index = embedding_index.EmbeddingIndex(
+                path, InferenceEngine.embedding_size, FLAGS.embedding_dtype, key,
+                FLAGS.ivf_min_size, FLAGS.ivf_clusters, FLAGS.ivf_probes)
+        return _embedding_index
+
+
+def split_update(update):
+    """
+    separates an image record update from the content hash of the image it 
+    came from, if any. Returns the fields to store and the hash
+    """
+    update = dict(update)
+    return update, update.pop('content_hash', None)
+
+
+def link_images(pairs):
+    """
+    links images to their embeddings, given (img_id, content_hash) pairs, so
+    similar images can be found later. Pairs without a hash are skipped
+    """
+    index = get_embedding_index()
+    pairs = [(img_id, content_hash) for img_id, content_hash in pairs if content_hash]
+    if index is not None and pairs:
+        index.link_many(pairs)
+
+
+def unlink_image(img_id):
+    """forgets the embedding link of a deleted image"""
+    index = get_embedding_index()
+    if index is not None:
+        index.unlink(img_id)
+
+
+def get_result_cache():
+    """
+    returns the process-wide ResultCache, creating it if necessary. Results 
+    cached for a different model or settings are dropped, as told by the key
+    of the current version of the default model
+    """
+    global _result_cache
+    key = get_registry().get(load = False).key
+    with _engine_lock:
+        if _result_cache is None:
+            _result_cache = result_cache.ResultCache(
+                FLAGS.result_cache_size, FLAGS.result_cache_dir, key)
+        else:
+            _result_cache.set_model_key(key)
+        return _result_cache
+
+
+def get_http_pool():
+    """returns the process-wide HTTPPool for image downloads, creating it if necessary"""
+    global _http_pool
+    with _engine_lock:
+        if _http_pool is None:
+            _http_pool = http_pool.HTTPPool(
+                FLAGS.max_connections_per_host, FLAGS.fetch_timeout,
+                FLAGS.fetch_retries)
+        return _http_pool
+
+
+def get_async_pool():
+    """
+    returns the process-wide AsyncHTTPPool, creating it if necessary. Must be
+    called from the event loop which will use it
+    """
+    global _async_pool
+    loop = asyncio.get_running_loop()
+    # connections and limits belong to one loop
+    if _async_pool is None or _async_pool[0] is not loop:
+        _async_pool = (loop, async_fetch.AsyncHTTPPool(
+            FLAGS.max_connections_per_host, FLAGS.fetch_timeout,
+            FLAGS.fetch_retries, max_total = FLAGS.async_max_fetches))
+    return _async_pool[1]
+
+
+def close_async_pool():
+    """closes the idle connections of the AsyncHTTPPool, when its loop stops"""
+    global _async_pool
+    if _async_pool is not None:
+        _async_pool[1].close()
+        _async_pool = None
+
+
+def get_cpu_executor():
+    """returns the bounded thread pool which decodes images for the ASGI front end"""
+    global _cpu_executor
+    with _engine_lock:
+        if _cpu_executor is None:
+            _cpu_executor = ThreadPoolExecutor(FLAGS.decode_workers,
+                                               thread_name_prefix = 'decode')
+        return _cpu_executor
+
+
+def check_valid_url(imgURL, request_headers = None):
     """
     checks image URL for several possible errors: bad URL, URL is not an
-    accepted image format, and that the file cannot be opened (may be corrupted)
-    Returns error msg as a dictionary
+    accepted image format, the file is too large, and that the file cannot be 
+    opened (may be corrupted). The image is downloaded into memory, and 
+    returned as a fetcher.FetchedImage. Returns error msg as a dictionary
     """
     if imgURL.split('.')[-1] in ['jpg', 'png', 'gif']:
         try:
-            imagePath, headers = urllib.request.urlretrieve(imgURL)
-        except:
-            error_dict = {"error": "invalid URL"}
-            return error_dict, False
+            fetched = fetcher.fetch_image(imgURL, FLAGS.max_image_bytes,
+                                          request_headers, get_http_pool())
+        except fetcher.FetchError as e:
+            return e.error_dict, False
+        return fetched, True
+    else:
+        error_dict = {"error": "URL required for jpg, png or gif file"}
+        return error_dict, False
+
 
+async def check_valid_url_async(imgURL, request_headers = None):
+    """check_valid_url, downloading on the event loop"""
+    if imgURL.split('.')[-1] in ['jpg', 'png', 'gif']:
         try:
-            _ = Image.open(imagePath)
-            return imagePath, True
-        except IOError:
-            error_dict = {"error": "file cannot be opened"}
-            return error_dict, False
+            fetched = await async_fetch.fetch_image(
+                imgURL, FLAGS.max_image_bytes, request_headers, get_async_pool())
+        except fetcher.FetchError as e:
+            return e.error_dict, False
+        return fetched, True
     else:
         error_dict = {"error": "URL required for jpg, png or gif file"}
         return error_dict, False
 
 
+def error_update(error_dict):
+  """returns the image record update for an image which could not be classified"""
+  metrics.ERRORS.inc(error = error_dict.get('error', 'unknown'))
+  return {'results': error_dict, 'size': "", 'resize': False}
+
+
+def deadline_update():
+  """
+  returns the image record update for an image dropped because its caller's
+  deadline passed. It is not stored, see missed_deadline
+  """
+  return {'results': dict(DEADLINE_EXCEEDED), 'size': "", 'resize': False}
+
+
+def missed_deadline(update):
+  """whether an image record update is from deadline_update"""
+  return update.get('results') == DEADLINE_EXCEEDED
+
+
+def _fetch_before(fetch, deadline, item):
+  """runs the fetch stage of a pipeline unless the deadline has passed"""
+  if time.monotonic() > deadline:
+    return deadline_update(), False
+  return fetch(item)
+
+
+def fetch_image(imgURL, model = None):
+  """
+  downloads the image at imgURL after checking it. Returns the content hash and 
+  encoded image data, as a tuple, and True. If the image is already cached, or
+  there is an error, returns the image record update and False. Cached updates
+  carry the image's 'content_hash', see split_update. Cached results are
+  those of model, by name, the default model by default
+  """
+  cached, request_headers = _cached_url(imgURL, model)
+  [fetched_or_error, ok] = check_valid_url(imgURL, request_headers)
+  return _fetched(imgURL, fetched_or_error, ok, cached, model)
+
+
+async def fetch_image_async(imgURL, model = None):
+  """fetch_image, downloading on the event loop"""
+  cached, request_headers = _cached_url(imgURL, model)
+  [fetched_or_error, ok] = await check_valid_url_async(imgURL, request_headers)
+  return _fetched(imgURL, fetched_or_error, ok, cached, model)
+
+
+def _cached_url(imgURL, model = None):
+  """
+  looks up the last download from imgURL. Returns its content hash and 
+  cached update, or None, and the headers which ask the server to only send 
+  the image if it has changed
+  """
+  cache = get_result_cache()
+  entry = cache.get_url(imgURL)
+  request_headers = {}
+  if entry is None:
+    return None, request_headers
+  cached_hash, etag, last_modified = entry
+  cached_update = cache.get_results(results_key(cached_hash, model))
+  if cached_update is None:
+    return None, request_headers
+  if etag:
+    request_headers['If-None-Match'] = etag
+  elif last_modified:
+    request_headers['If-Modified-Since'] = last_modified
+  return (cached_hash, cached_update), request_headers
+
+
+def _fetched(imgURL, fetched_or_error, ok, cached, model = None):
+  """the rest of fetch_image, once the download is done"""
+  cache = get_result_cache()
+  if not ok:
+      return error_update(fetched_or_error), False
+  if fetched_or_error.not_modified:
+      cached_hash, cached_update = cached
+      return dict(cached_update, content_hash = cached_hash), False
+  image_data = fetched_or_error.data
+  headers = fetched_or_error.headers
+  image_hash = result_cache.content_hash(image_data)
+  cache.put_url(imgURL, image_hash, headers.get('ETag'), headers.get('Last-Modified'))
+  # the same image may have been seen at another URL
+  cached_update = cache.get_results(results_key(image_hash, model))
+  if cached_update is not None:
+    return dict(cached_update, content_hash = image_hash), False
+  return (image_hash, image_data), True
+
+
+def check_image_bytes(image_data, model = None):
+  """
+  checks uploaded image data, which needs no download: its size, and that it
+  is an accepted image format. Returns the same as fetch_image: the content 
+  hash and image data, as a tuple, and True, or the image record update for
+  a cached image or an error and False
+  """
+  if len(image_data) > FLAGS.max_image_bytes:
+    return error_update({"error": "image too large"}), False
+  try:
+    with metrics.STAGE_SECONDS.time(stage = 'validate'):
+      fetcher.check_image_data(image_data)
+  except fetcher.FetchError as e:
+    return error_update(e.error_dict), False
+  image_hash = result_cache.content_hash(image_data)
+  cached_update = get_result_cache().get_results(results_key(image_hash, model))
+  if cached_update is not None:
+    return dict(cached_update, content_hash = image_hash), False
+  return (image_hash, image_data), True
+
+
+def decode_image(fetched):
+  """
+  decodes and downscales encoded image data into model input. Takes the 
+  content hash and image data returned by fetch_image. Returns the content 
+  hash and a preprocess.PreprocessedImage, as a tuple, and True, or the image 
+  record update for an error and False
+  """
+  image_hash, image_data = fetched
+  image_size = get_engine().image_size
+  try:
+    with metrics.STAGE_SECONDS.time(stage = 'decode'):
+      image = preprocess.preprocess_image(image_data, image_size)
+  except preprocess.DECODE_ERRORS:
+    return error_update({"error": "file cannot be decoded"}), False
+  return (image_hash, image), True
+
+
+def postprocess_batch(predictions):
+  """
+  picks the top predictions above the threshold for a whole batch of 
+  prediction scores at once. Returns a postprocess.TopKResults, without 
+  class names, which are only looked up when results are serialised
+  """
+  embeddings = None
+  if isinstance(predictions, tuple):
+    predictions, embeddings = predictions
+  top = postprocess.top_k(predictions, FLAGS.num_top_predictions, FLAGS.threshold)
+  top.embeddings = embeddings
+  return top
+
+
+def format_results(results):
+  """
+  converts the top predictions of one image, postprocess.CompactResults, a
+  postprocess.TopKResults or a row of prediction scores, into the API 
+  dictionary of the top predictions above the threshold, as a class name and
+  score. Anything else, such as an error, is returned as it is
+  """
+  if isinstance(results, np.ndarray):
+    results = postprocess_batch(results)
+  if isinstance(results, postprocess.TopKResults):
+    results = postprocess.CompactResults.from_top(results)
+  if not isinstance(results, postprocess.CompactResults):
+    return results
+  with metrics.STAGE_SECONDS.time(stage = 'format'):
+    labels = results.labels
+    if labels is None:
+      try:
+        labels = get_node_lookup(results.model).node_lookup
+      except model_registry.UnknownModel:
+        # from a model which is no longer served
+        labels = None
+    return results.to_dict(labels)
+
+
+def infer_batch(decoded, priority = batching.PRIORITY_INTERACTIVE, deadline = None,
+                model = None):
+  """
+  runs decoded images through the batching scheduler, and caches the results.
+  Takes a list of content hash and preprocessed image tuples, from 
+  decode_image. Returns a list of image record updates, one per image: 
+  dictionaries with the 'results', as postprocess.CompactResults, 'size' and
+  'resize' fields, and the image's 'content_hash'. Embeddings, if kept, are
+  added to the index. Images still queued at the deadline, a time.monotonic()
+  time, get deadline_update(). model is the name of the model to run, the
+  default model by default. The version current when the batch starts runs
+  all of it, even if a new one is swapped in meanwhile
+  """
+  with get_registry().acquire(model) as loaded:
+    futures = [loaded.scheduler.submit(image.tensor, priority, deadline)
+               for _, image in decoded]
+    tops = []
+    for future in futures:
+      try:
+        tops.append(future.result())
+      except batching.DeadlineExceeded:
+        tops.append(None)
+  return _store_results(decoded, tops, loaded)
+
+
+async def infer_batch_async(decoded, priority = batching.PRIORITY_INTERACTIVE,
+                            deadline = None, model = None):
+  """
+  infer_batch, waiting on the event loop rather than in a thread for the 
+  batching scheduler
+  """
+  loop = asyncio.get_running_loop()
+  registry = get_registry()
+  # the first request for a model loads it
+  loaded = await loop.run_in_executor(get_cpu_executor(), registry.lease, model)
+  try:
+    futures = [asyncio.wrap_future(loaded.scheduler.submit(image.tensor, priority, deadline))
+               for _, image in decoded]
+    tops = await asyncio.gather(*futures, return_exceptions = True)
+  finally:
+    registry.release(loaded)
+  for top in tops:
+    if isinstance(top, Exception) and not isinstance(top, batching.DeadlineExceeded):
+      raise top
+  tops = [None if isinstance(top, Exception) else top for top in tops]
+  # caching and the embedding index may write to disk
+  return await loop.run_in_executor(
+      get_cpu_executor(), _store_results, decoded, tops, loaded)
+
+
+def _store_results(decoded, tops, loaded):
+  """
+  caches the results of inference, one postprocess.TopKResults per image, or
+  None for an image which missed its deadline, from loaded, the 
+  model_registry.Model which ran them. Results keep the label table of that
+  version, and those of models other than the default the model's name
+  """
+  model = None if loaded.name == DEFAULT_MODEL else loaded.name
+  labels = None if loaded.labels is None else loaded.labels.node_lookup
+  cache = get_result_cache()
+  index = get_embedding_index()
+  updates = []
+  embeddings = []
+  for (image_hash, image), top in zip(decoded, tops):
+    if top is None:
+      updates.append(deadline_update())
+      continue
+    update = {
+        'results': postprocess.CompactResults.from_top(top, model = model,
+                                                       labels = labels),
+        'size': image.size,
+        'resize': image.resized
+    }
+    cache.put_results(results_key(image_hash, loaded), update)
+    if top.embeddings is not None:
+      embeddings.append((image_hash, top.embeddings[0]))
+    updates.append(dict(update, content_hash = image_hash))
+  if index is not None and embeddings:
+    index.add_many(embeddings)
+  return updates
+
+
+def infer_image(imgURL, deadline = None, model = None):
+  """
+  Runs inference on an image. Argument is imgURL: the URL of an image. Returns
+  the image record update: a dictionary with the inference results, the 
+  original image size and whether the image was resized, and the content hash
+  of the image if it could be downloaded. If the deadline, a time.monotonic()
+  time, passes first, returns deadline_update(). model is the name of the 
+  model to run, the default model by default
+  """
+  if deadline is not None and time.monotonic() > deadline:
+    return deadline_update()
+  # check url is valid, and whether the results are already cached
+  [image_data_or_update, ok] = fetch_image(imgURL, model)
+  if not ok:
+      return image_data_or_update
+
+  # the engine keeps the graph and session alive between requests. Some useful 
+  # tensors:
+  # 'softmax:0': A tensor containing the normalized prediction across
+  #   1000 labels.
+  # 'pool_3:0': A tensor containing the next-to-last layer containing 2048
+  #   float description of the image, kept in the embedding index.
+  # 'Mul:0': A tensor containing the resized and normalized image, which the
+  #   engine replaces with a batch of images preprocessed outside the graph.
+  # the image is decoded on the request thread, then queued so that
+  # concurrent requests share one batched forward pass
+  [image_or_update, ok] = decode_image(image_data_or_update)
+  if not ok:
+      return image_or_update
+  return infer_batch([image_or_update], deadline = deadline, model = model)[0]
+
+
+async def infer_image_async(imgURL, priority = batching.PRIORITY_INTERACTIVE,
+                            deadline = None, model = None):
+  """
+  infer_image for the asyncio front end: the download is awaited on the 
+  event loop, decoding runs on the bounded decode threads, and the batched
+  forward pass is awaited without holding a thread
+  """
+  if deadline is not None and time.monotonic() > deadline:
+    return deadline_update()
+  [image_data_or_update, ok] = await fetch_image_async(imgURL, model)
+  if not ok:
+      return image_data_or_update
+  [image_or_update, ok] = await asyncio.get_running_loop().run_in_executor(
+      get_cpu_executor(), decode_image, image_data_or_update)
+  if not ok:
+      return image_or_update
+  return (await infer_batch_async([image_or_update], priority, deadline, model))[0]
+
+
 # this is the main TensorFlow function, where we have a TensorFlow session
 def run_inference_on_image(imgURL):
   """
   Runs inference on an image. Argument is imgURL: the URL of an image.Returns 
   a dictionary of inference (recognition) results, as a class name and score
   """
-  results_name = []
-  results_score = []
-  
-  # check url is valid
-  [image_path_or_error, ok] = check_valid_url(imgURL)
-  if not ok:
-      return image_path_or_error
-  
-  image_data = tf.gfile.FastGFile(image_path_or_error, 'rb').read()
-
-  # Creates graph from saved GraphDef.
-  create_graph()
-
-  with tf.Session() as sess:
-    # Some useful tensors:
-    # 'softmax:0': A tensor containing the normalized prediction across
-    #   1000 labels.
-    # 'pool_3:0': A tensor containing the next-to-last layer containing 2048
-    #   float description of the image.
-    # 'DecodeJpeg/contents:0': A tensor containing a string providing JPEG
-    #   encoding of the image.
-    # Runs the softmax tensor by feeding the image_data as input to the graph.
-    softmax_tensor = sess.graph.get_tensor_by_name('softmax:0')
-    predictions = sess.run(softmax_tensor,
-                           {'DecodeJpeg/contents:0': image_data})
-    predictions = np.squeeze(predictions)
-
-    # Creates node ID --> English string lookup.
-    node_lookup = NodeLookup()
-
-    top_k = predictions.argsort()[-FLAGS.num_top_predictions:][::-1]
-    for node_id in top_k:
-      human_string = node_lookup.id_to_string(node_id)
-      score = predictions[node_id]
-      #print('%s (score = %.5f)' % (human_string, score))
-      if (score > FLAGS.threshold):
-          results_name.append(human_string)
-          results_score.append(score)
-     
-    results_dict = {}
-    i = 0
-    for item in results_name:
-        results_dict[i] = {"results_score": format(results_score[i], '.4f'), "results_name": results_name[i]}
-        i += 1
-    
-    return results_dict        
+  return format_results(infer_image(imgURL)['results'])
+
+
+def get_pipeline(fetch = None, priority = batching.PRIORITY_BULK, deadline = None,
+                 model = None):
+  """
+  returns an InferencePipeline which downloads, decodes and runs inference on
+  many images at once. Its results are image record updates, as from 
+  infer_image. fetch replaces fetch_image as the first stage, e.g. with
+  check_image_bytes for uploaded images, and must look up cached results of
+  the same model. Images are batched at priority, and those not fetched or 
+  run by the deadline get deadline_update(). model is the name of the model
+  to run, the default model by default
+  """
+  fetch = fetch or functools.partial(fetch_image, model = model)
+  if deadline is not None:
+    fetch = functools.partial(_fetch_before, fetch, deadline)
+  return pipeline.InferencePipeline(
+      fetch, decode_image, 
+      functools.partial(infer_batch, priority = priority, deadline = deadline,
+                        model = model),
+      fetch_workers = FLAGS.fetch_workers,
+      decode_workers = FLAGS.decode_workers,
+      batch_size = FLAGS.max_batch_size,
+      queue_size = FLAGS.pipeline_queue_size,
+      error_result = lambda message: error_update({"error": message}))
+
+
+def infer_images(imgURLs, priority = batching.PRIORITY_BULK, deadline = None,
+                 model = None):
+  """
+  Runs inference on a list of image URLs, using the staged pipeline. Returns a 
+  list of image record updates, as from infer_image, in the same order as 
+  imgURLs
+  """
+  return get_pipeline(priority = priority, deadline = deadline,
+                      model = model).run_all(imgURLs)
+
+
+async def infer_images_async(imgURLs, priority = batching.PRIORITY_BULK,
+                             deadline = None, model = None):
+  """
+  infer_images for the asyncio front end. All the downloads are in flight
+  at once, up to --async_max_fetches, and concurrent forward passes are 
+  batched by the scheduler
+  """
+  return list(await asyncio.gather(*[infer_image_async(url, priority, deadline, model)
+                                     for url in imgURLs]))
+
+
+def infer_image_data(images, priority = batching.PRIORITY_BULK, deadline = None,
+                     model = None):
+  """
+  Runs inference on a list of encoded images held in memory, such as uploads,
+  using the staged pipeline without its download stage. Returns a list of 
+  image record updates, as from infer_image, in the same order as images
+  """
+  return get_pipeline(functools.partial(check_image_bytes, model = model),
+                      priority, deadline, model).run_all(images)
+
+
+# values the shared objects already count, read when /metrics is rendered.
+# Objects which haven't been created yet are left out
+metrics.GaugeFunc(
+    'recognition_result_cache_events_total',
+    'Result cache lookups by outcome, and evictions.',
+    lambda: None if _result_cache is None else {
+        (name,): value for name, value in _result_cache.stats().items()
+        if name not in ('urls', 'results')},
+    ['event'], kind = 'counter')
+metrics.GaugeFunc(
+    'recognition_result_cache_entries', 'Entries held in the result cache.',
+    lambda: None if _result_cache is None else {
+        (name,): _result_cache.stats()[name] for name in ('urls', 'results')},
+    ['table'])
+metrics.GaugeFunc(
+    'recognition_batch_queue_depth', 'Images waiting for a forward pass, by model.',
+    lambda: None if _registry is None else {
+        (name,): model.scheduler.stats()['queue_depth']
+        for name, model in _registry.models().items()},
+    ['model'])
+metrics.GaugeFunc(
+    'recognition_model_memory_bytes', 'Estimated memory held by each loaded model.',
+    lambda: None if _registry is None else {
+        (name,): model.memory for name, model in _registry.models().items()},
+    ['model'])
+metrics.GaugeFunc(
+    'recognition_fetch_events_total',
+    'Image download requests, retries and connections.',
+    lambda: None if _http_pool is None else {
+        (name,): value for name, value in _http_pool.stats().items()
+        if not name.endswith('_time')},
+    ['event'], kind = 'counter')
+metrics.GaugeFunc(
+    'recognition_embedding_index_vectors', 'Vectors held in the embedding index.',
+    lambda: None if _embedding_index is None else _embedding_index.stats()['vectors'])
+metrics.GaugeFunc(
+    'recognition_resident_memory_bytes', 'Resident set size of this process.',
+    resident_memory)
+
+
+def file_checksum(path, chunk_size = 1024 * 1024):
+  """returns the SHA-256 of a file, as hex"""
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _file_entry(path):
+  statinfo = os.stat(path)
+  return {'size': statinfo.st_size, 'mtime_ns': statinfo.st_mtime_ns,
+          'sha256': file_checksum(path)}
+
+
+def write_model_manifest(dest_directory, tarball_path, names):
+  """records the tarball and the extracted files, with their checksums"""
+  manifest = {
+      'tarball': _file_entry(tarball_path),
+      'files': dict((name, _file_entry(os.path.join(dest_directory, name)))
+                    for name in names)
+  }
+  tmp_path = os.path.join(dest_directory, '%s.%d.tmp' % (MODEL_MANIFEST_FILE, os.getpid()))
+  with open(tmp_path, 'w') as f:
+    json.dump(manifest, f, indent = 1, sort_keys = True)
+  os.replace(tmp_path, os.path.join(dest_directory, MODEL_MANIFEST_FILE))
+
+
+def model_files_current(dest_directory, tarball_path):
+  """
+  checks the extracted model files against the manifest written when they
+  were extracted. A file whose size and modification time are unchanged is
+  trusted, as git does, otherwise its checksum is compared. Returns False if
+  there is no manifest, the tarball has changed, or a file is missing or 
+  different
+  """
+  try:
+    with open(os.path.join(dest_directory, MODEL_MANIFEST_FILE)) as f:
+      manifest = json.load(f)
+    entries = [(tarball_path, manifest['tarball'])]
+    entries += [(os.path.join(dest_directory, name), entry)
+                for name, entry in manifest['files'].items()]
+    for path, entry in entries:
+      statinfo = os.stat(path)
+      if statinfo.st_size != entry['size']:
+        return False
+      if (statinfo.st_mtime_ns != entry['mtime_ns'] and
+          file_checksum(path) != entry['sha256']):
+        return False
+  except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+    return False
+  return True
 
 
 # needs internet connection, largish download
 def download_and_extract_model_if_needed():
-  """Download and extract  model tar file if not already downloaded"""
+  """
+  Download and extract model tar file if not already downloaded. Extraction
+  is skipped when the extracted files match the manifest of the last one
+  """
   dest_directory = FLAGS.model_dir
   if not os.path.exists(dest_directory):
     os.makedirs(dest_directory)
@@ -184,13 +1264,19 @@ def download_and_extract_model_if_needed():
     print()
     statinfo = os.stat(filepath)
     print('Successfully downloaded', filename, statinfo.st_size, 'bytes.')
-  tarfile.open(filepath, 'r:gz').extractall(dest_directory)
+  if model_files_current(dest_directory, filepath):
+    return
+  with tarfile.open(filepath, 'r:gz') as tar:
+    names = [member.name for member in tar.getmembers() if member.isfile()]
+    tar.extractall(dest_directory)
+  write_model_manifest(dest_directory, filepath, names)
 
 
-def parse_args():
+def parse_args(argv = None):
     """
     parses command line arguments for location of model data, number of inference 
-    (recognition) predictions, and a confidence threshold for inference
+    (recognition) predictions, and a confidence threshold for inference. argv
+    defaults to sys.argv
     """
     global FLAGS
     parser = argparse.ArgumentParser()
@@ -209,12 +1295,81 @@ def parse_args():
       imagenet_synset_to_human_label_map.txt, and
       imagenet_2012_challenge_label_map_proto.pbtxt.\
       """
+  )
+    parser.add_argument(
+      '--model_variant',
+      type = str,
+      default = 'original',
+      choices = sorted(graph_optimize.VARIANTS),
+      help = """\
+      Graph to run: original, or a variant made from it and kept in
+      --model_dir: optimized (folded constants and batch norms), fp16
+      (float16 weights) or quantized (eight-bit weights and ops).\
+      """
+  )
+    parser.add_argument(
+      '--models',
+      type = str,
+      default = '',
+      help = """\
+      More models to serve next to the default one, which requests choose
+      with ?model=name: comma separated name=model_dir or
+      name=model_dir:variant entries. Each is loaded on first use.\
+      """
+  )
+    parser.add_argument(
+      '--model_memory_budget_mb',
+      type = float,
+      default = 0,
+      help = """\
+      Memory the loaded models may use, in MB. Beyond it the least recently
+      used idle models are closed, other than the default. 0 for no limit.\
+      """
+  )
+    parser.add_argument(
+      '--workers',
+      type = int,
+      default = 1,
+      help = """\
+      Number of server processes, each pinned to its share of the cores. 1
+      runs the Flask development server in this process.\
+      """
+  )
+    parser.add_argument(
+      '--intra_op_threads',
+      type = int,
+      default = 0,
+      help = """\
+      TensorFlow threads used within one op. 0 lets TensorFlow decide, or
+      with several workers, splits each worker's cores.\
+      """
+  )
+    parser.add_argument(
+      '--inter_op_threads',
+      type = int,
+      default = 0,
+      help = 'TensorFlow ops run side by side, 0 to decide as for --intra_op_threads.'
+  )
+    parser.add_argument(
+      '--host',
+      type = str,
+      default = '0.0.0.0',
+      help = 'Address the server listens on.'
+  )
+    parser.add_argument(
+      '--port',
+      type = int,
+      default = 5000,
+      help = 'Port the server listens on.'
   )
     parser.add_argument(
       '--image_file',
       type = str,
       default = '',
-      help = 'Absolute path to image file.'
+      help = """\
+      Absolute path to image file, or to a manifest of image URLs or paths, 
+      for python -m recognition_server.bulk .\
+      """
   )
     parser.add_argument(
       '--num_top_predictions',
@@ -228,7 +1383,213 @@ def parse_args():
       default = 0.05,
       help = 'Only retain recognition scores above this threshold.'
   )
+    parser.add_argument(
+      '--max_batch_size',
+      type = int,
+      default = 16,
+      help = 'Maximum number of images run together in one forward pass.'
+  )
+    parser.add_argument(
+      '--batch_timeout_ms',
+      type = float,
+      default = 5.0,
+      help = 'Maximum time an image waits for others to join its batch.'
+  )
+    parser.add_argument(
+      '--fetch_workers',
+      type = int,
+      default = 16,
+      help = 'Number of threads downloading images for bulk inference.'
+  )
+    parser.add_argument(
+      '--decode_workers',
+      type = int,
+      default = 4,
+      help = 'Number of threads decoding images for bulk inference.'
+  )
+    parser.add_argument(
+      '--pipeline_queue_size',
+      type = int,
+      default = 64,
+      help = 'Maximum number of images waiting between bulk inference stages.'
+  )
+    parser.add_argument(
+      '--job_workers',
+      type = int,
+      default = 2,
+      help = 'Number of background inference jobs run at the same time.'
+  )
+    parser.add_argument(
+      '--result_cache_size',
+      type = int,
+      default = 10000,
+      help = 'Number of URLs and of image results kept in the result cache.'
+  )
+    parser.add_argument(
+      '--result_cache_dir',
+      type = str,
+      default = '',
+      help = 'Directory to also keep cached results in, none if empty.'
+  )
+    parser.add_argument(
+      '--max_image_bytes',
+      type = int,
+      default = 20 * 1024 * 1024,
+      help = 'Largest image, in bytes, which will be downloaded.'
+  )
+    parser.add_argument(
+      '--max_upload_bytes',
+      type = int,
+      default = 100 * 1024 * 1024,
+      help = """\
+      Largest request body, in bytes, e.g. of images uploaded to classify.
+      Bigger requests get 413 before the body is read. 0 for no limit.\
+      """
+  )
+    parser.add_argument(
+      '--fetch_timeout',
+      type = float,
+      default = 10.0,
+      help = 'Timeout in seconds for downloading an image.'
+  )
+    parser.add_argument(
+      '--max_connections_per_host',
+      type = int,
+      default = 8,
+      help = 'Most image downloads from one host at the same time.'
+  )
+    parser.add_argument(
+      '--fetch_retries',
+      type = int,
+      default = 2,
+      help = 'Times a failed image download is retried, with backoff.'
+  )
+    parser.add_argument(
+      '--async_max_fetches',
+      type = int,
+      default = 1000,
+      help = 'Most image downloads in flight at once with --frontend asgi.'
+  )
+    parser.add_argument(
+      '--embedding_index',
+      type = str,
+      default = 'none',
+      help = """\
+      Directory where image embeddings are kept for similarity search, memory
+      to keep them in memory only, or none, the default, to turn embeddings 
+      off. Keeping them fetches the 2048-value pool_3 layer with every 
+      forward pass.\
+      """
+  )
+    parser.add_argument(
+      '--embedding_dtype',
+      type = str,
+      default = 'float16',
+      choices = ['float16', 'float32'],
+      help = 'Type embeddings are stored as; float16 halves their size.'
+  )
+    parser.add_argument(
+      '--ivf_min_size',
+      type = int,
+      default = 50000,
+      help = """\
+      Number of embeddings from which similarity search uses an approximate
+      clustered (IVF) index instead of brute force. 0 to always use brute force.\
+      """
+  )
+    parser.add_argument(
+      '--ivf_clusters',
+      type = int,
+      default = 0,
+      help = 'Number of clusters in the IVF index, 0 for the square root of its size.'
+  )
+    parser.add_argument(
+      '--ivf_probes',
+      type = int,
+      default = 8,
+      help = 'Number of IVF clusters nearest a query which are searched.'
+  )
+    parser.add_argument(
+      '--image_store',
+      type = str,
+      default = 'sqlite:/tmp/imagenet/images.db',
+      help = """\
+      Where image records and results are kept: sqlite:<path> for a SQLite
+      database file, or memory to keep them in memory only.\
+      """
+  )
+    parser.add_argument(
+      '--warm_up',
+      type = str,
+      default = 'background',
+      choices = ['background', 'blocking'],
+      help = """\
+      Load the model in a background thread while the server starts answering
+      requests, or before it starts. /img/api/v1.0/ready reports when it is loaded.\
+      """
+  )
+    parser.add_argument(
+      '--json_encoder',
+      type = str,
+      default = 'orjson',
+      choices = ['orjson', 'json'],
+      help = 'JSON encoder for responses. orjson is used only if it is installed.'
+  )
+    parser.add_argument(
+      '--max_images_per_request',
+      type = int,
+      default = 1000,
+      help = 'Most images in one inference request or job. Bigger requests get 413.'
+  )
+    parser.add_argument(
+      '--max_queued_images',
+      type = int,
+      default = 512,
+      help = """\
+      Most images being classified at once, across requests and jobs. Requests
+      which would go over it get 503 with Retry-After.\
+      """
+  )
+    parser.add_argument(
+      '--bulk_share',
+      type = float,
+      default = 0.75,
+      help = """\
+      Share of --max_queued_images which requests for more than one image, and 
+      background jobs, may use. Beyond it they get 429, leaving room for 
+      single-image requests.\
+      """
+  )
+    parser.add_argument(
+      '--request_timeout',
+      type = float,
+      default = 0,
+      help = """\
+      Seconds after which the images of an inference request are dropped, 
+      unless the request sets an X-Request-Timeout header. 0 for no limit.\
+      """
+  )
+    parser.add_argument(
+      '--frontend',
+      type = str,
+      default = 'wsgi',
+      choices = ['wsgi', 'asgi'],
+      help = """\
+      Serve with Flask's threaded WSGI server, or on an asyncio event loop
+      under uvicorn, where image downloads don't hold a thread each.\
+      """
+  )
+    parser.add_argument(
+      '--profile_interval_ms',
+      type = float,
+      default = 0,
+      help = """\
+      Start the sampling profiler at startup, sampling every this many
+      milliseconds. 0 leaves it off until started with PUT /img/api/v1.0/profiler.\
+      """
+  )
     
-    FLAGS, _ = parser.parse_known_args()
+    FLAGS, _ = parser.parse_known_args(argv)
+    refresh_model_keys()
     
     
\ No newline at end of file
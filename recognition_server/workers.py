@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: serve the API from several worker processes
+
+One Python process can only decode images and encode JSON on one core at a
+time. WorkerSupervisor opens the listening socket once, then forks a number of
+worker processes which all accept connections from it, so the kernel spreads
+connections across them. Each worker is pinned to its own group of cores,
+and TensorFlow's thread pools are sized to that group, so the workers don't
+fight over cores. Read-only data is shared where the operating system allows:
+the label table is memory-mapped from one file, and the embedding index maps
+one vector file, so those pages are held once however many workers there are.
+The supervisor restarts workers which die.
+
+Background jobs live in the worker which started them. Their IDs start with
+the worker's index, and every worker also listens on a loopback port, so a
+request for another worker's job is passed on to that worker.
+"""
+
+import os
+import socket
+import signal
+import threading
+import time
+import logging
+import multiprocessing
+from werkzeug.serving import make_server
+try:
+    from recognition_server import http_pool
+except:
+    import http_pool
+
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait before restarting a worker which died
+RESTART_DELAY = 1.0
+
+# the WorkerInfo of this process, or None when serving from one process
+_worker = None
+# connections to the other workers, for passing on job requests
+_forward_pool = None
+_forward_pool_lock = threading.Lock()
+
+
+def available_cores():
+    """returns the sorted list of cores this process may run on"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def split_cores(num_workers, cores = None):
+    """
+    splits cores into num_workers groups of neighbouring cores, as evenly as
+    possible. With more workers than cores, workers share cores
+    """
+    if cores is None:
+        cores = available_cores()
+    if num_workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    size, extra = divmod(len(cores), num_workers)
+    groups = []
+    start = 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+def thread_counts(num_cores, intra_op_threads = 0, inter_op_threads = 0):
+    """
+    returns TensorFlow's (intra_op_threads, inter_op_threads) for a worker
+    with num_cores cores. Zero picks a count: Inception has parallel branches
+    worth running side by side on larger groups, and the threads of each op
+    share the rest, so intra * inter does not exceed the cores
+    """
+    if inter_op_threads <= 0:
+        inter_op_threads = 2 if num_cores >= 4 else 1
+    if intra_op_threads <= 0:
+        intra_op_threads = max(1, num_cores // inter_op_threads)
+    return intra_op_threads, inter_op_threads
+
+
+def pin_to_cores(cores):
+    """restricts this process to the given cores, where the OS allows it"""
+    try:
+        os.sched_setaffinity(0, cores)
+    except (AttributeError, OSError):
+        logger.warning('cannot pin worker %d to cores %s', os.getpid(), cores)
+
+
+def open_listener(host, port, backlog = 128):
+    """opens a listening TCP socket which forked workers can all accept from"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class WorkerInfo(object):
+    """
+    the index and cores of one worker process. ports is shared by all the
+    workers, and holds each worker's loopback port
+    """
+
+    def __init__(self, index, cores, ports):
+        self.index = index
+        self.cores = cores
+        self.ports = ports
+
+    @property
+    def job_prefix(self):
+        """start of the IDs of jobs started by this worker"""
+        return 'w%d-' % self.index
+
+    def owner(self, job_id):
+        """returns the index of the worker which started a job, or None"""
+        if not job_id.startswith('w') or '-' not in job_id:
+            return None
+        index = job_id[1:job_id.index('-')]
+        if not index.isdigit() or int(index) >= len(self.ports):
+            return None
+        return int(index)
+
+    def to_dict(self):
+        return {'index': self.index, 'pid': os.getpid(), 'cores': self.cores,
+                'workers': len(self.ports)}
+
+
+def current_worker():
+    """returns the WorkerInfo of this process, or None if not a worker"""
+    return _worker
+
+
+def _get_forward_pool():
+    global _forward_pool
+    with _forward_pool_lock:
+        if _forward_pool is None:
+            # results are streamed, so the wait between them has no limit
+            _forward_pool = http_pool.HTTPPool(max_per_host = 16, timeout = None,
+                                               retries = 0)
+        return _forward_pool
+
+
+def forward(job_id, path, headers = None):
+    """
+    passes a request about a job on to the worker which started the job, if
+    that is another worker. path is the request path and query string.
+    Returns the http_pool.PooledResponse, which must be closed, or None if
+    the job does not belong to another worker
+    """
+    worker = _worker
+    if worker is None:
+        return None
+    owner = worker.owner(job_id)
+    if owner is None or owner == worker.index or not worker.ports[owner]:
+        return None
+    url = 'http://127.0.0.1:%d%s' % (worker.ports[owner], path)
+    try:
+        return _get_forward_pool().get(url, headers)
+    except Exception:
+        # the worker has died, and its jobs with it
+        return None
+
+
+def serve_internal(app, worker):
+    """
+    serves a WSGI app on a loopback port in a background thread, for requests
+    passed on by other workers, and records the port for them
+    """
+    internal = make_server('127.0.0.1', 0, app, threaded = True)
+    worker.ports[worker.index] = internal.server_port
+    thread = threading.Thread(target = internal.serve_forever,
+                              name = 'internal-server')
+    thread.daemon = True
+    thread.start()
+
+
+def serve(app, sock, worker = None):
+    """
+    serves a WSGI app on an already listening socket, with a thread per
+    request. A worker also serves the app on a loopback port, for requests
+    passed on by other workers
+    """
+    if worker is not None:
+        serve_internal(app, worker)
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded = True, fd = sock.fileno())
+    logger.info('worker %d serving on %s:%d', os.getpid(), host, port)
+    server.serve_forever()
+
+
+def _worker_entry(index, cores, ports, sock, worker_main):
+    """runs in the forked worker process"""
+    global _worker
+    # the supervisor stops workers with SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pin_to_cores(cores)
+    _worker = WorkerInfo(index, cores, ports)
+    worker_main(_worker, sock)
+
+
+class WorkerSupervisor(object):
+    """
+    forks num_workers processes which serve from one listening socket, and
+    restarts any that die. worker_main(worker, sock) runs in each worker, with
+    its WorkerInfo and the listening socket, and should not return
+    """
+
+    def __init__(self, num_workers, worker_main, host = '0.0.0.0', port = 5000,
+                 cores = None):
+        self.num_workers = max(1, int(num_workers))
+        self.worker_main = worker_main
+        self.host = host
+        self.port = port
+        self.core_groups = split_cores(self.num_workers, cores)
+        self._context = multiprocessing.get_context('fork')
+        self._stopping = False
+        self._processes = {}
+
+    def _start(self, index):
+        self.ports[index] = 0
+        process = self._context.Process(
+            target = _worker_entry, name = 'worker-%d' % index,
+            args = (index, self.core_groups[index], self.ports, self.sock,
+                    self.worker_main))
+        process.start()
+        self._processes[index] = process
+        logger.info('started worker %d, pid %d, cores %s', index, process.pid,
+                    self.core_groups[index])
+
+    def _stop(self, *args):
+        self._stopping = True
+
+    def run(self):
+        """starts the workers and watches them until SIGTERM or SIGINT"""
+        self.sock = open_listener(self.host, self.port)
+        # shared between processes, each worker fills in its loopback port
+        self.ports = self._context.Array('i', self.num_workers, lock = False)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for index in range(self.num_workers):
+            self._start(index)
+        try:
+            while not self._stopping:
+                time.sleep(0.5)
+                for index, process in list(self._processes.items()):
+                    if not process.is_alive() and not self._stopping:
+                        logger.warning('worker %d exited with code %s, restarting',
+                                       index, process.exitcode)
+                        time.sleep(RESTART_DELAY)
+                        self._start(index)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """stops all the workers and closes the listening socket"""
+        self._stopping = True
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes.values():
+            process.join()
+        self.sock.close()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for admission.py
+"""
+
+from recognition_server import admission
+from recognition_server import batching
+import unittest
+import time
+
+
+class AdmissionControllerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.controller = admission.AdmissionController(
+            max_queued = 10, bulk_share = 0.5, max_images_per_request = 8)
+
+    def assertRejected(self, status, count, priority = None):
+        with self.assertRaises(admission.Rejected) as cm:
+            self.controller.admit(count, priority)
+        self.assertEqual(cm.exception.status, status)
+        return cm.exception
+
+    def test_too_many_images(self):
+        e = self.assertRejected(413, 9)
+        self.assertEqual(e.error_dict, {'error': 'too many images, at most 8 per request'})
+        self.assertEqual(e.headers(), {})
+
+    def test_bulk_leaves_room_for_interactive(self):
+        """Check that bulk requests get 429 beyond their share"""
+        bulk = self.controller.admit(4)
+        self.assertEqual(bulk.priority, batching.PRIORITY_BULK)
+        e = self.assertRejected(429, 2)
+        self.assertEqual(e.headers(), {'Retry-After': '1'})
+        interactive = [self.controller.admit(1) for _ in range(6)]
+        self.assertEqual(interactive[0].priority, batching.PRIORITY_INTERACTIVE)
+        # full
+        self.assertRejected(503, 1)
+        bulk.release()
+        self.controller.admit(1)
+        stats = self.controller.stats()
+        self.assertEqual(stats['max_bulk'], 5)
+        self.assertEqual(stats['interactive_in_progress'], 7)
+        self.assertEqual((stats['bulk_limit'], stats['queue_full']), (1, 1))
+
+    def test_tickets_release_once(self):
+        with self.controller.admit(5) as ticket:
+            self.assertEqual(self.controller.stats()['bulk_in_progress'], 5)
+        ticket.release()
+        self.assertEqual(self.controller.stats()['bulk_in_progress'], 0)
+
+    def test_large_request_admitted_when_idle(self):
+        """Check that a request over the bulk share can run on an idle server"""
+        self.controller.admit(8).release()
+        self.assertEqual(self.controller.stats()['admitted'], 1)
+
+    def test_retry_after_from_throughput(self):
+        for _ in range(3):
+            self.controller.admit(2).release()
+        self.controller.admit(5)
+        # 6 images done in the window, 3 over the limit
+        e = self.assertRejected(429, 3)
+        self.assertEqual(e.retry_after, 15)
+
+
+class DeadlineTestCase(unittest.TestCase):
+    def test_deadline_from_header(self):
+        deadline = admission.deadline_for({'X-Request-Timeout': '2.5'}, 30)
+        self.assertAlmostEqual(deadline - time.monotonic(), 2.5, places = 1)
+        self.assertFalse(admission.expired(deadline))
+
+    def test_default_deadline(self):
+        self.assertIsNone(admission.deadline_for({}, 0))
+        self.assertIsNone(admission.deadline_for({'X-Request-Timeout': 'soon'}, 0))
+        deadline = admission.deadline_for({}, 10)
+        self.assertAlmostEqual(deadline - time.monotonic(), 10, places = 1)
+
+    def test_expired(self):
+        self.assertTrue(admission.expired(time.monotonic() - 1))
+        self.assertFalse(admission.expired(None))
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for asgi.py, calling the ASGI app directly
+"""
+
+from recognition_server import asgi
+from recognition_server import recognition_server
+import unittest
+import asyncio
+import json
+
+
+def call(method, path, body = b'', query = b'', content_type = 'application/json'):
+    """runs one request through the ASGI app, returns the status, headers and body"""
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+             'http_version': '1.1', 'scheme': 'http', 'root_path': '',
+             'server': ('127.0.0.1', 5000), 'client': ('127.0.0.1', 50000),
+             'headers': [(b'content-type', content_type.encode('latin-1')),
+                         (b'host', b'127.0.0.1:5000')]}
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    start = sent[0]
+    body = b''.join(message.get('body', b'') for message in sent[1:])
+    return start['status'], dict(start['headers']), body
+
+
+class ASGITestCase(unittest.TestCase):
+    def setUp(self):
+        recognition_server.tf_operations.parse_args([])
+
+    def test_flask_routes_are_served(self):
+        """Check that routes without a native version go to the Flask app"""
+        status, headers, body = call('GET', '/img/api/v1.0/images', query = b'limit=1')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body.decode('utf-8'))['images']), 1)
+        self.assertEqual(headers[b'content-type'], b'application/json')
+
+    def test_streamed_flask_response(self):
+        status, _, body = call('GET', '/img/api/v1.0/images',
+                               query = b'format=ndjson&state=undone')
+        self.assertEqual(status, 200)
+        for line in body.splitlines():
+            self.assertEqual(json.loads(line.decode('utf-8'))['results'], '')
+
+    def test_unknown_route(self):
+        status, _, body = call('GET', '/img/api/v1.0/a-bad-address')
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body.decode('utf-8')), {'error': 'not found'})
+
+    def test_body_over_upload_limit(self):
+        """Check that a body over --max_upload_bytes gets 413"""
+        recognition_server.tf_operations.parse_args(['--max_upload_bytes', '100'])
+        status, _, body = call('POST', '/img/api/v1.0/classify', b'\xff' * 101,
+                               content_type = 'image/jpeg')
+        self.assertEqual(status, 413)
+        self.assertEqual(json.loads(body.decode('utf-8')), {'error': 'request too large'})
+
+    def test_infer_missing_image(self):
+        status, _, body = call('PUT', '/img/api/v1.0/infer/999999', b'{"id": 999999}')
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body.decode('utf-8')), {'error': 'not found'})
+
+    def test_infer_without_json(self):
+        status, _, _ = call('PUT', '/img/api/v1.0/infer/1', b'')
+        self.assertEqual(status, 400)
+
+    def test_imagesinfer_checks_urls(self):
+        """Check that imagesinfer runs natively, with the Flask route's statuses"""
+        new_imgs = [{'url': 'http://127.0.0.1:1/notes.txt', 'title': 'notes'}, {}]
+        status, _, body = call('POST', '/img/api/v1.0/imagesinfer',
+                               json.dumps({'new_imgs': new_imgs}).encode('utf-8'))
+        self.assertEqual(status, 410)
+        [image] = json.loads(body.decode('utf-8'))
+        self.assertEqual(image['title'], 'notes')
+        self.assertEqual(image['results'], {'error': 'URL required for jpg, png or gif file'})
+        self.assertEqual(recognition_server.metrics.REQUESTS.value(
+            endpoint = '/img/api/v1.0/imagesinfer', method = 'POST', status = '410'), 1)
+
+    def test_unknown_model(self):
+        new_imgs = [{'url': 'http://127.0.0.1:1/a.jpg'}]
+        status, _, body = call('POST', '/img/api/v1.0/imagesinfer',
+                               json.dumps({'new_imgs': new_imgs}).encode('utf-8'),
+                               query = b'model=nope')
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body.decode('utf-8')), {'error': 'unknown model nope'})
+
+    def test_async_requests_go_to_flask(self):
+        self.assertIsNone(asgi.find_route({'method': 'PUT', 'path': '/img/api/v1.0/inferundone',
+                                           'query_string': b'async=true'}))
+        self.assertIsNotNone(asgi.find_route({'method': 'PUT', 'path': '/img/api/v1.0/inferundone',
+                                              'query_string': b''}))
+
+    def test_lifespan(self):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        asyncio.run(asgi.app({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+
+if __name__ == '__main__':
+        unittest.main()
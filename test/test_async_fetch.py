@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for async_fetch.py, against a local HTTP server
+"""
+
+from recognition_server import async_fetch
+from recognition_server import fetcher
+import unittest
+import threading
+import asyncio
+import time
+import io
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+
+def make_png():
+    buf = io.BytesIO()
+    Image.new('RGB', (16, 16), (10, 200, 10)).save(buf, format = 'PNG')
+    return buf.getvalue()
+
+
+PNG = make_png()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def send_body(self, status, body = b'', headers = ()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/slow.png':
+            time.sleep(0.2)
+            self.send_body(200, PNG)
+        elif self.path == '/green.png':
+            self.send_body(200, PNG, [('ETag', '"v1"')])
+        elif self.path == '/chunked':
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for part in (b'hello', b' world'):
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(part), part))
+            self.wfile.write(b'0\r\n\r\n')
+        elif self.path == '/big.png':
+            self.send_body(200, b'\x89PNG' + b'\0' * 100000)
+        elif self.path == '/page.png':
+            self.send_body(200, b'<html>' + b' ' * 1000000 + b'</html>')
+        elif self.path == '/moved':
+            self.send_body(302, headers = [('Location', '/green.png')])
+        else:
+            self.send_body(404, b'not found')
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    # room for every connection opened at once, the default is 5
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class AsyncHTTPPoolTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = Server(('127.0.0.1', 0), Handler)
+        cls.base = 'http://127.0.0.1:%d' % cls.server.server_port
+        thread = threading.Thread(target = cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def run_with_pool(self, fn, **kwargs):
+        async def run():
+            pool = async_fetch.AsyncHTTPPool(timeout = 5, backoff = 0.01, **kwargs)
+            try:
+                return await fn(pool), pool.stats()
+            finally:
+                pool.close()
+        return asyncio.run(run())
+
+    def test_connections_are_reused(self):
+        """Check that sequential requests share one keep-alive connection"""
+        async def fn(pool):
+            return [(await pool.get(self.base + '/green.png')).body for _ in range(3)]
+        bodies, stats = self.run_with_pool(fn)
+        self.assertEqual(bodies, [PNG] * 3)
+        self.assertEqual(stats['connections_opened'], 1)
+        self.assertEqual(stats['connections_reused'], 2)
+
+    def test_many_downloads_in_flight(self):
+        """Check that slow downloads wait together, not one after another"""
+        async def fn(pool):
+            return await asyncio.gather(*[pool.get(self.base + '/slow.png')
+                                          for _ in range(40)])
+        start = time.perf_counter()
+        responses, _ = self.run_with_pool(fn, max_per_host = 40)
+        self.assertEqual(set(response.status for response in responses), set([200]))
+        # one at a time would take 8 seconds
+        self.assertLess(time.perf_counter() - start, 4)
+
+    def test_chunked_body(self):
+        async def fn(pool):
+            return await pool.get(self.base + '/chunked')
+        response, _ = self.run_with_pool(fn)
+        self.assertEqual(response.body, b'hello world')
+
+    def test_body_too_large(self):
+        async def fn(pool):
+            return await pool.get(self.base + '/big.png', max_bytes = 1000)
+        self.assertRaises(async_fetch.BodyTooLarge, self.run_with_pool, fn)
+
+    def test_images_only(self):
+        """Check that a body which isn't an image is dropped after its first chunk"""
+        async def fn(pool):
+            return await pool.get(self.base + '/page.png', images_only = True)
+        self.assertRaises(async_fetch.NotAnImage, self.run_with_pool, fn)
+        async def fn(pool):
+            return await pool.get(self.base + '/missing.png', images_only = True)
+        response, _ = self.run_with_pool(fn)
+        self.assertEqual((response.status, response.body), (404, b''))
+
+    def test_redirects_are_followed(self):
+        async def fn(pool):
+            return await pool.get(self.base + '/moved')
+        response, _ = self.run_with_pool(fn)
+        self.assertEqual((response.status, response.body), (200, PNG))
+        self.assertTrue(response.url.endswith('/green.png'))
+
+    def test_fetch_image(self):
+        """Check that images are downloaded and checked like fetcher.fetch_image"""
+        async def fn(pool):
+            return await async_fetch.fetch_image(self.base + '/green.png', pool = pool)
+        fetched, _ = self.run_with_pool(fn)
+        self.assertEqual(fetched.data, PNG)
+        self.assertEqual(fetched.format, 'png')
+        self.assertEqual(fetched.headers['ETag'], '"v1"')
+
+    def test_fetch_image_errors(self):
+        for path, max_bytes, error in [('/missing.png', 1000, 'invalid URL'),
+                                       ('/big.png', 1000, 'image too large'),
+                                       ('/page.png', 2000000, 'file cannot be opened')]:
+            async def fn(pool):
+                return await async_fetch.fetch_image(self.base + path, max_bytes,
+                                                     pool = pool)
+            with self.assertRaises(fetcher.FetchError) as cm:
+                self.run_with_pool(fn)
+            self.assertEqual(cm.exception.error_dict, {'error': error})
+
+
+if __name__ == '__main__':
+        unittest.main()
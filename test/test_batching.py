@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for batching.py
+"""
+
+from recognition_server import batching
+import unittest
+import threading
+import time
+import numpy as np
+
+
+class EchoEngine(object):
+    """stands in for InferenceEngine, returns each image's values as its scores"""
+    def __init__(self):
+        self.batches = []
+
+    def predict_batch(self, image_tensors):
+        batch = np.concatenate(image_tensors, axis = 0)
+        self.batches.append(len(batch))
+        return batch.reshape(len(batch), -1)
+
+
+class BatchSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = EchoEngine()
+        self.scheduler = batching.BatchScheduler(self.engine, max_batch_size = 4,
+                                                 max_wait_ms = 200)
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_results_return_to_callers(self):
+        """Check that each caller gets back the row for its own image"""
+        futures = [self.scheduler.submit(np.full((1, 2), i, dtype = np.float32))
+                   for i in range(10)]
+        for i, future in enumerate(futures):
+            self.assertEqual(future.result(timeout = 5).tolist(), [i, i])
+        self.assertEqual(sum(self.engine.batches), 10)
+        self.assertTrue(max(self.engine.batches) <= 4)
+
+    def test_concurrent_requests_are_batched(self):
+        """Check that concurrent submissions share forward passes"""
+        threads = [threading.Thread(target = self.scheduler.predict,
+                                    args = (np.zeros((1, 2)),)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['num_images'], 8)
+        self.assertTrue(stats['num_batches'] < 8)
+        self.assertTrue(stats['mean_occupancy'] > 0.25)
+
+    def test_engine_errors_reach_callers(self):
+        """Check that a failed forward pass raises in every waiting caller"""
+        def fail(image_tensors):
+            raise ValueError('bad batch')
+        self.engine.predict_batch = fail
+        future = self.scheduler.submit(np.zeros((1, 2)))
+        self.assertRaises(ValueError, future.result, 5)
+
+    def test_postprocess_runs_on_whole_batch(self):
+        """Check that postprocess sees each batch once and callers get their row"""
+        seen = []
+        def postprocess(predictions):
+            seen.append(len(predictions))
+            return predictions * 10
+        self.scheduler.postprocess = postprocess
+        futures = [self.scheduler.submit(np.full((1, 2), i, dtype = np.float32))
+                   for i in range(6)]
+        for i, future in enumerate(futures):
+            self.assertEqual(future.result(timeout = 5).tolist(), [i * 10, i * 10])
+        self.assertEqual(seen, self.engine.batches)
+
+    def test_interactive_images_run_first(self):
+        """Check that queued interactive images overtake bulk ones"""
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+        predict_batch = self.engine.predict_batch
+        def blocking(image_tensors):
+            started.set()
+            release.wait(5)
+            order.extend(int(tensor[0, 0]) for tensor in image_tensors)
+            return predict_batch(image_tensors)
+        self.engine.predict_batch = blocking
+        self.scheduler.max_batch_size = 1
+        first = self.scheduler.submit(np.full((1, 2), 0, dtype = np.float32))
+        started.wait(5)
+        futures = [self.scheduler.submit(np.full((1, 2), 1, dtype = np.float32),
+                                         batching.PRIORITY_BULK),
+                   self.scheduler.submit(np.full((1, 2), 2, dtype = np.float32),
+                                         batching.PRIORITY_BULK),
+                   self.scheduler.submit(np.full((1, 2), 3, dtype = np.float32),
+                                         batching.PRIORITY_INTERACTIVE)]
+        release.set()
+        for future in [first] + futures:
+            future.result(timeout = 5)
+        self.assertEqual(order, [0, 3, 1, 2])
+
+    def test_expired_images_are_dropped(self):
+        """Check that images past their deadline are not run"""
+        future = self.scheduler.submit(np.zeros((1, 2)), deadline = time.monotonic() - 1)
+        live = self.scheduler.submit(np.ones((1, 2)), deadline = time.monotonic() + 60)
+        self.assertRaises(batching.DeadlineExceeded, future.result, 5)
+        self.assertEqual(live.result(timeout = 5).tolist(), [1, 1])
+        self.assertEqual(self.scheduler.stats()['num_expired'], 1)
+        self.assertEqual(sum(self.engine.batches), 1)
+
+
+if __name__ == '__main__':
+        unittest.main()
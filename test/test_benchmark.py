@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for benchmark.py, without the model
+"""
+
+from recognition_server import benchmark
+import unittest
+import tempfile
+import shutil
+import os
+import json
+import urllib.request
+from PIL import Image
+import io
+
+
+class CorpusTestCase(unittest.TestCase):
+    def test_images_are_reproducible(self):
+        """Check the same seed gives the same image bytes"""
+        self.assertEqual(benchmark.make_image(3, seed = 1), benchmark.make_image(3, seed = 1))
+        self.assertNotEqual(benchmark.make_image(3, seed = 1), benchmark.make_image(3, seed = 2))
+
+    def test_server_serves_images(self):
+        corpus = benchmark.CorpusServer(5)
+        try:
+            urls = corpus.urls(1, 3)
+            self.assertEqual(len(urls), 3)
+            for url in urls:
+                with urllib.request.urlopen(url) as response:
+                    img = Image.open(io.BytesIO(response.read()))
+                    self.assertIn(img.format.lower(), url.rsplit('.', 1)[-1].replace('jpg', 'jpeg'))
+        finally:
+            corpus.close()
+
+
+class StatsTestCase(unittest.TestCase):
+    def test_latency_summary(self):
+        summary = benchmark.latency_summary([i / 1000.0 for i in range(1, 101)])
+        self.assertEqual(summary['requests'], 100)
+        self.assertAlmostEqual(summary['p50_ms'], 50.5, places = 3)
+        self.assertTrue(summary['p95_ms'] < summary['p99_ms'] <= summary['max_ms'])
+        self.assertEqual(benchmark.latency_summary([]), {'requests': 0})
+
+    def test_rss_sampler(self):
+        values = iter(range(100, 10000, 100))
+        sampler = benchmark.RSSSampler(lambda: next(values) * 1000000, interval = 0.01)
+        memory = sampler.stop()
+        self.assertTrue(memory['rss_growth_mb'] > 0)
+        self.assertEqual(memory['rss_start_mb'], 100)
+
+    def test_run_timed(self):
+        latencies, results, wall = benchmark.run_timed(lambda x: x * 2, range(10), 4)
+        self.assertEqual(results, [x * 2 for x in range(10)])
+        self.assertEqual(len(latencies), 10)
+
+    def test_compare(self):
+        directory = tempfile.mkdtemp()
+        try:
+            paths = []
+            for name, p50 in (('old', 10.0), ('new', 5.0)):
+                paths.append(os.path.join(directory, name + '.json'))
+                with open(paths[-1], 'w') as f:
+                    json.dump({'scenarios': {'infer/sockets': {'p50_ms': p50}}}, f)
+            table = benchmark.compare(*paths)
+            self.assertIn('infer/sockets', table)
+            self.assertIn('-50.0%', table)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+        unittest.main()
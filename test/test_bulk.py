@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for bulk.py
+"""
+
+from recognition_server import bulk
+from recognition_server import pipeline
+from recognition_server import tf_operations
+import unittest
+import tempfile
+import shutil
+import json
+import os
+import io
+from PIL import Image
+
+
+def write_png(path, colour):
+    Image.new('RGB', (8, 8), colour).save(path, format = 'PNG')
+
+
+def echo_pipeline(base_dir):
+    """reads local files like the real pipeline, but 'classifies' by content hash"""
+    def decode(fetched):
+        return fetched, True
+
+    def infer_batch(decoded):
+        return [{'results': {'hash': image_hash[:8]}, 'size': '8x8', 'resize': False,
+                 'content_hash': image_hash} for image_hash, _ in decoded]
+    return pipeline.InferencePipeline(
+        lambda source: bulk.fetch_source(source, base_dir), decode, infer_batch,
+        fetch_workers = 2, decode_workers = 2, batch_size = 4, queue_size = 4)
+
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with io.open(path, 'w', encoding = 'utf-8') as f:
+            f.write(text)
+        return path
+
+    def test_jsonl_manifest(self):
+        path = self.write('m.jsonl', '{"id": "a", "url": "http://x/a.jpg"}\n\n'
+                          '{"path": "b.png"}\n"http://x/c.jpg"\n{"title": "no image"}\n')
+        self.assertEqual(list(bulk.read_manifest(path)), [
+            (0, 'a', 'http://x/a.jpg'), (1, 1, 'b.png'), (2, 2, 'http://x/c.jpg'),
+            (3, 3, None)])
+
+    def test_csv_manifest(self):
+        path = self.write('m.csv', 'id,file\nfirst,a.png\n,b.png\n')
+        self.assertEqual(list(bulk.read_manifest(path)), [
+            (0, 'first', 'a.png'), (1, 1, 'b.png')])
+
+    def test_text_manifest(self):
+        path = self.write('m.txt', 'a.png\n\nhttp://x/b.jpg\n')
+        self.assertEqual(list(bulk.read_manifest(path)), [
+            (0, 0, 'a.png'), (1, 1, 'http://x/b.jpg')])
+
+    def test_progress(self):
+        progress = bulk.Progress()
+        for line in (1, 2, 0, 5):
+            progress.mark_done(line)
+        self.assertEqual((progress.next_line, progress.done), (3, set([5])))
+        self.assertTrue(progress.is_done(5))
+        self.assertFalse(progress.is_done(4))
+
+
+class ClassifyManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        tf_operations.parse_args([])
+        self.dir = tempfile.mkdtemp()
+        lines = []
+        for i in range(12):
+            write_png(os.path.join(self.dir, '%d.png' % i), (i * 20, 0, 0))
+            lines.append(json.dumps({'id': 'img%d' % i, 'path': '%d.png' % i}))
+        lines.append(json.dumps({'path': 'missing.png'}))
+        self.manifest = os.path.join(self.dir, 'manifest.jsonl')
+        with open(self.manifest, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.output = os.path.join(self.dir, 'results.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read_output(self):
+        with open(self.output) as f:
+            return [json.loads(line) for line in f]
+
+    def test_results_are_written(self):
+        counts = bulk.classify_manifest(self.manifest, self.output, checkpoint_every = 5,
+                                        pipeline = echo_pipeline(self.dir))
+        self.assertEqual(counts, {'done': 13, 'skipped': 0, 'failed': 1})
+        records = {record['line']: record for record in self.read_output()}
+        self.assertEqual(sorted(records), list(range(13)))
+        self.assertEqual(records[3]['id'], 'img3')
+        self.assertEqual(records[3]['size'], '8x8')
+        self.assertEqual(records[12]['results'], {'error': 'file cannot be opened'})
+        with open(self.output + bulk.CHECKPOINT_SUFFIX) as f:
+            self.assertEqual(json.load(f)['next_line'], 13)
+
+    def test_resume_after_crash(self):
+        """Check that a crashed run resumes from its checkpoint, with no duplicates"""
+        result_record = bulk.result_record
+        written = []
+        def crash_after_seven(*args):
+            if len(written) == 7:
+                raise RuntimeError('crash')
+            written.append(args)
+            return result_record(*args)
+        bulk.result_record = crash_after_seven
+        try:
+            self.assertRaises(RuntimeError, bulk.classify_manifest, self.manifest,
+                              self.output, checkpoint_every = 3,
+                              pipeline = echo_pipeline(self.dir))
+        finally:
+            bulk.result_record = result_record
+        counts = bulk.classify_manifest(self.manifest, self.output, checkpoint_every = 3,
+                                        pipeline = echo_pipeline(self.dir))
+        self.assertEqual(counts['done'] + counts['skipped'], 13)
+        self.assertTrue(counts['skipped'] >= 6)
+        lines = [record['line'] for record in self.read_output()]
+        self.assertEqual(sorted(lines), list(range(13)))
+
+    def test_restart(self):
+        bulk.classify_manifest(self.manifest, self.output, pipeline = echo_pipeline(self.dir))
+        counts = bulk.classify_manifest(self.manifest, self.output, restart = True,
+                                        pipeline = echo_pipeline(self.dir))
+        self.assertEqual(counts['skipped'], 0)
+        self.assertEqual(len(self.read_output()), 13)
+
+    def test_finished_run_is_skipped(self):
+        bulk.classify_manifest(self.manifest, self.output, pipeline = echo_pipeline(self.dir))
+        counts = bulk.classify_manifest(self.manifest, self.output,
+                                        pipeline = echo_pipeline(self.dir))
+        self.assertEqual(counts, {'done': 0, 'skipped': 13, 'failed': 0})
+        self.assertEqual(len(self.read_output()), 13)
+
+    @unittest.skipIf(bulk.pyarrow is None, 'pyarrow is not installed')
+    def test_parquet_output(self):
+        output = os.path.join(self.dir, 'results.parquet')
+        self.output = output
+        bulk.classify_manifest(self.manifest, output, 'parquet', checkpoint_every = 5,
+                               pipeline = echo_pipeline(self.dir))
+        table = bulk.pyarrow.parquet.read_table(output)
+        self.assertEqual(table.num_rows, 13)
+
+
+if __name__ == '__main__':
+        unittest.main()
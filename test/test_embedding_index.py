@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for embedding_index.py
+"""
+
+from recognition_server import embedding_index
+import unittest
+import tempfile
+import shutil
+import numpy as np
+
+
+def random_vectors(count, dim = 16, seed = 0):
+    return np.random.RandomState(seed).randn(count, dim).astype(np.float32)
+
+
+class EmbeddingIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_index(self, **kwargs):
+        kwargs.setdefault('dim', 16)
+        kwargs.setdefault('dtype', 'float32')
+        return embedding_index.EmbeddingIndex(**kwargs)
+
+    def fill(self, index, vectors):
+        index.add_many([('h%d' % i, v) for i, v in enumerate(vectors)])
+        index.link_many([(i + 1, 'h%d' % i) for i in range(len(vectors))])
+
+    def test_exact_search_matches_numpy(self):
+        """Check brute force search gives the highest cosine similarities"""
+        vectors = random_vectors(3000)
+        index = self.make_index()
+        self.fill(index, vectors)
+        unit = embedding_index.normalise(vectors)
+        expected = np.argsort(-(unit @ unit[7]))[1:6] + 1
+        similar = index.similar(8, 5)
+        self.assertEqual([img_id for img_id, _ in similar], expected.tolist())
+        self.assertTrue(similar[0][1] >= similar[-1][1])
+
+    def test_duplicates_share_a_vector(self):
+        """Check images with the same content are linked to one vector"""
+        index = self.make_index()
+        self.fill(index, random_vectors(10))
+        index.add('h3', random_vectors(1, seed = 5)[0])
+        index.link(42, 'h3')
+        self.assertEqual(len(index), 10)
+        similar = index.similar(4, 3)
+        self.assertEqual(similar[0][0], 42)
+        self.assertAlmostEqual(similar[0][1], 1.0, places = 5)
+
+    def test_unlink_and_missing(self):
+        index = self.make_index()
+        self.fill(index, random_vectors(5))
+        index.unlink(2)
+        self.assertIsNone(index.similar(2))
+        self.assertNotIn(2, [img_id for img_id, _ in index.similar(1, 10)])
+        self.assertIsNone(index.similar(99))
+
+    def test_persists_and_grows(self):
+        """Check vectors and links survive reopening, after the file has grown"""
+        vectors = random_vectors(embedding_index.INITIAL_CAPACITY + 10)
+        index = self.make_index(path = self.dir, dtype = 'float16')
+        self.fill(index, vectors)
+        before = index.similar(3, 5)
+        index.close()
+        index = self.make_index(path = self.dir, dtype = 'float16')
+        self.assertEqual(len(index), len(vectors))
+        self.assertEqual(index.similar(3, 5), before)
+        self.assertEqual(index.stats()['dtype'], 'float16')
+        index.close()
+
+    def test_shared_between_instances(self):
+        """Check two indexes on one directory, as in two processes, see each other's writes"""
+        first = self.make_index(path = self.dir)
+        second = self.make_index(path = self.dir)
+        vectors = random_vectors(embedding_index.INITIAL_CAPACITY + 10)
+        self.fill(first, vectors[:20])
+        second.add_many([('h%d' % i, v) for i, v in enumerate(vectors)])
+        second.link_many([(i + 1, 'h%d' % i) for i in range(20, len(vectors))])
+        self.assertEqual(len(first), len(vectors))
+        self.assertEqual(len(second), len(vectors))
+        self.assertEqual(first.similar(30, 5), second.similar(30, 5))
+        first.unlink(30)
+        self.assertIsNone(second.similar(30))
+        first.close()
+        second.close()
+
+    def test_new_model_clears_index(self):
+        index = self.make_index(path = self.dir, model_key = 'a')
+        self.fill(index, random_vectors(5))
+        index.close()
+        index = self.make_index(path = self.dir, model_key = 'b')
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.similar(1))
+        index.close()
+
+    def test_ivf_search(self):
+        """Check the clustered index finds near duplicates"""
+        centres = random_vectors(20, seed = 1) * 5
+        vectors = np.repeat(centres, 50, axis = 0) + random_vectors(1000, seed = 2) * 0.1
+        index = self.make_index(ivf_min_size = 500, ivf_clusters = 20, ivf_probes = 3)
+        self.fill(index, vectors)
+        similar = index.similar(1, 10)
+        self.assertEqual(index.stats()['ivf_clusters'], 20)
+        # the nearest images all come from the same cluster as image 1
+        self.assertEqual(len(similar), 10)
+        self.assertTrue(all(img_id <= 50 for img_id, _ in similar))
+
+
+if __name__ == '__main__':
+        unittest.main()
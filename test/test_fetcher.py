@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for fetcher.py, against a local HTTP server
+"""
+
+from recognition_server import fetcher
+import unittest
+import threading
+import io
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+
+def make_jpeg():
+    buf = io.BytesIO()
+    Image.new('RGB', (32, 32), (200, 10, 10)).save(buf, format = 'JPEG')
+    return buf.getvalue()
+
+
+FILES = {
+    '/red.jpg': make_jpeg(),
+    '/big.jpg': b'\xff\xd8\xff' + b'\0' * 300000,
+    '/page.jpg': b'<html>' + b' ' * 100 + b'</html>',
+    '/broken.jpg': b'\xff\xd8\xff\xe0 not really a jpeg'
+}
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in FILES:
+            self.send_error(404)
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = FILES[self.path]
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetcherTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), ImageHandler)
+        cls.base = 'http://127.0.0.1:%d' % cls.server.server_port
+        thread = threading.Thread(target = cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_fetch_into_memory(self):
+        """Check that an image is downloaded into memory and checked"""
+        fetched = fetcher.fetch_image(self.base + '/red.jpg')
+        self.assertEqual(fetched.data, FILES['/red.jpg'])
+        self.assertEqual(fetched.format, 'jpg')
+        self.assertEqual(fetched.headers['ETag'], '"v1"')
+
+    def test_not_modified(self):
+        """Check that a conditional request can find the image unchanged"""
+        fetched = fetcher.fetch_image(self.base + '/red.jpg',
+                                      request_headers = {'If-None-Match': '"v1"'})
+        self.assertTrue(fetched.not_modified)
+        self.assertIsNone(fetched.data)
+
+    def test_errors(self):
+        """Check the errors for missing, too large and non-image files"""
+        cases = [('/missing.jpg', 'invalid URL'),
+                 ('/big.jpg', 'image too large'),
+                 ('/page.jpg', 'file cannot be opened'),
+                 ('/broken.jpg', 'file cannot be opened')]
+        for path, message in cases:
+            with self.assertRaises(fetcher.FetchError) as cm:
+                fetcher.fetch_image(self.base + path, max_bytes = 100000)
+            self.assertEqual(cm.exception.error_dict, {"error": message})
+
+    def test_sniff_format(self):
+        """Check that image formats are found from magic numbers"""
+        self.assertEqual(fetcher.sniff_format(b'GIF89a...'), 'gif')
+        self.assertEqual(fetcher.sniff_format(b'\x89PNG\r\n\x1a\n...'), 'png')
+        self.assertIsNone(fetcher.sniff_format(b'BM...'))
+
+
+if __name__ == '__main__':
+        unittest.main()
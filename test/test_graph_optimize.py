@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for graph_optimize.py, on a small stand-in graph
+"""
+
+from recognition_server import graph_optimize
+import unittest
+import tempfile
+import shutil
+import os
+import numpy as np
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+
+def write_toy_graph(model_dir):
+    """
+    writes a GraphDef with the names the engine uses: Mul in, pool_3 and
+    softmax out, plus nodes the transforms should remove
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        image = tf.placeholder(tf.float32, [None, 4], name = 'input')
+        scaled = tf.multiply(image, tf.constant(2.0), name = 'Mul')
+        checked = tf.check_numerics(scaled, 'bad values')
+        hidden = tf.identity(tf.matmul(checked, tf.constant(
+            np.random.RandomState(0).rand(4, 2048).astype(np.float32))))
+        pool = tf.nn.relu(hidden, name = 'pool_3')
+        with tf.variable_scope('softmax'):
+            weights = tf.constant(np.random.RandomState(1).rand(2048, 8)
+                                  .astype(np.float32) / 2048, name = 'weights')
+            biases = tf.constant(np.zeros(8, dtype = np.float32), name = 'biases')
+        tf.nn.softmax(tf.matmul(pool, weights) + biases, name = 'softmax')
+    path = os.path.join(model_dir, graph_optimize.GRAPH_FILE)
+    with open(path, 'wb') as f:
+        f.write(graph.as_graph_def().SerializeToString())
+    return path
+
+
+def run_graph(path, values):
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_optimize.load_graph_def(path), name = '')
+    with tf.Session(graph = graph) as sess:
+        return sess.run('softmax:0', {'Mul:0': values})
+
+
+class VariantPathTestCase(unittest.TestCase):
+    def test_variant_paths(self):
+        model_dir = '/tmp/imagenet'
+        source = os.path.join(model_dir, graph_optimize.GRAPH_FILE)
+        self.assertEqual(graph_optimize.variant_path(model_dir), source)
+        self.assertNotEqual(graph_optimize.variant_path(model_dir, 'fp16'), source)
+        self.assertRaises(ValueError, graph_optimize.variant_path, model_dir, 'int4')
+
+    def test_variant_current(self):
+        """Check that a variant older than the original graph is built again"""
+        model_dir = tempfile.mkdtemp()
+        try:
+            source = os.path.join(model_dir, graph_optimize.GRAPH_FILE)
+            path = graph_optimize.variant_path(model_dir, 'fp16')
+            open(source, 'wb').close()
+            self.assertFalse(graph_optimize.variant_current(model_dir, 'fp16'))
+            open(path, 'wb').close()
+            os.utime(path, (os.path.getmtime(source) + 10,) * 2)
+            self.assertTrue(graph_optimize.variant_current(model_dir, 'fp16'))
+            self.assertTrue(graph_optimize.variant_current(model_dir, 'original'))
+            # nothing to build, so no subprocess
+            self.assertEqual(graph_optimize.ensure_variant_in_subprocess(model_dir, 'fp16'),
+                             path)
+            os.utime(path, (os.path.getmtime(source) - 10,) * 2)
+            self.assertFalse(graph_optimize.variant_current(model_dir, 'fp16'))
+        finally:
+            shutil.rmtree(model_dir)
+
+
+@unittest.skipIf(tf is None, 'TensorFlow is not installed')
+class GraphOptimizeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.model_dir = tempfile.mkdtemp()
+        self.source = write_toy_graph(self.model_dir)
+        self.values = np.random.RandomState(2).rand(3, 4).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.model_dir)
+
+    def test_optimized_gives_same_results(self):
+        """Check the optimised graph is smaller and computes the same scores"""
+        path = graph_optimize.ensure_variant(self.model_dir, 'optimized')
+        before = graph_optimize.load_graph_def(self.source)
+        after = graph_optimize.load_graph_def(path)
+        self.assertTrue(len(after.node) < len(before.node))
+        self.assertFalse(any(node.op == 'CheckNumerics' for node in after.node))
+        np.testing.assert_allclose(run_graph(path, self.values),
+                                   run_graph(self.source, self.values), rtol = 1e-5)
+
+    def test_fp16_weights(self):
+        """Check large weights become float16, and results stay close"""
+        path = graph_optimize.ensure_variant(self.model_dir, 'fp16')
+        nodes = graph_optimize.load_graph_def(path).node
+        self.assertTrue(any(node.name == 'softmax/weights' and node.op == 'Cast'
+                            for node in nodes))
+        np.testing.assert_allclose(run_graph(path, self.values),
+                                   run_graph(self.source, self.values), atol = 1e-3)
+
+    def test_variant_is_cached(self):
+        """Check a variant is only rebuilt when the original graph changes"""
+        path = graph_optimize.ensure_variant(self.model_dir, 'optimized')
+        mtime = os.path.getmtime(path)
+        graph_optimize.ensure_variant(self.model_dir, 'optimized')
+        self.assertEqual(os.path.getmtime(path), mtime)
+        # an original newer than the variant means a new model was downloaded
+        stale = os.path.getmtime(self.source) - 100
+        os.utime(path, (stale, stale))
+        graph_optimize.ensure_variant(self.model_dir, 'optimized')
+        self.assertTrue(os.path.getmtime(path) > stale)
+
+
+if __name__ == '__main__':
+        unittest.main()
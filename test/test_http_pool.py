@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for http_pool.py, against a local HTTP server
+"""
+
+from recognition_server import http_pool
+import unittest
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive needs HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+    in_flight = 0
+    most_in_flight = 0
+    failures_left = 0
+
+    def send_body(self, status, body = b'', headers = ()):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        cls = Handler
+        with cls.lock:
+            cls.in_flight += 1
+            cls.most_in_flight = max(cls.most_in_flight, cls.in_flight)
+        try:
+            if self.path == '/slow':
+                time.sleep(0.05)
+                self.send_body(200, b'slow')
+            elif self.path == '/flaky':
+                with cls.lock:
+                    fail = cls.failures_left > 0
+                    cls.failures_left -= 1
+                self.send_body(503 if fail else 200, b'ok')
+            elif self.path == '/flaky_big':
+                with cls.lock:
+                    fail = cls.failures_left > 0
+                    cls.failures_left -= 1
+                self.send_body(503 if fail else 200, b'x' * 1000000 if fail else b'ok')
+            elif self.path == '/drip':
+                # a byte at a time, each well within the socket timeout
+                self.send_response(200)
+                self.send_header('Content-Length', '40')
+                self.end_headers()
+                for _ in range(40):
+                    self.wfile.write(b'x')
+                    self.wfile.flush()
+                    time.sleep(0.05)
+            elif self.path == '/moved':
+                self.send_body(302, headers = [('Location', '/hello')])
+            else:
+                self.send_body(200, b'hello')
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPPoolTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.server.daemon_threads = True
+        cls.base = 'http://127.0.0.1:%d' % cls.server.server_port
+        thread = threading.Thread(target = cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.pool = http_pool.HTTPPool(max_per_host = 2, timeout = 5,
+                                       retries = 2, backoff = 0.01)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def get(self, path):
+        with self.pool.get(self.base + path) as response:
+            return response.status, response.read()
+
+    def test_connections_are_reused(self):
+        """Check that sequential requests share one keep-alive connection"""
+        for _ in range(5):
+            self.assertEqual(self.get('/hello'), (200, b'hello'))
+        stats = self.pool.stats()
+        self.assertEqual(stats['connections_opened'], 1)
+        self.assertEqual(stats['connections_reused'], 4)
+        self.assertTrue(stats['connect_time'] > 0)
+        self.assertTrue(stats['transfer_time'] > 0)
+
+    def test_per_host_limit(self):
+        """Check that no more than max_per_host requests run at once"""
+        Handler.most_in_flight = 0
+        threads = [threading.Thread(target = self.get, args = ('/slow',))
+                   for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(Handler.most_in_flight <= 2)
+
+    def test_retries_with_backoff(self):
+        """Check that 503 responses are retried"""
+        Handler.failures_left = 2
+        self.assertEqual(self.get('/flaky'), (200, b'ok'))
+        self.assertEqual(self.pool.stats()['retries'], 2)
+
+    def test_big_bodies_of_retries_are_not_read(self):
+        """Check that a big 503 body is dropped with its connection, a small one read"""
+        Handler.failures_left = 1
+        self.assertEqual(self.get('/flaky_big'), (200, b'ok'))
+        self.assertEqual(self.pool.stats()['connections_opened'], 2)
+        Handler.failures_left = 1
+        self.assertEqual(self.get('/flaky'), (200, b'ok'))
+        self.assertEqual(self.pool.stats()['connections_opened'], 2)
+
+    def test_gives_up_after_retries(self):
+        """Check that the last failed response is returned"""
+        Handler.failures_left = 5
+        self.assertEqual(self.get('/flaky')[0], 503)
+        Handler.failures_left = 0
+
+    def test_redirects_are_followed(self):
+        """Check that redirects are followed on the pool"""
+        self.assertEqual(self.get('/moved'), (200, b'hello'))
+
+    def test_timeout_is_for_the_whole_body(self):
+        """Check that a body sent a byte at a time is cut off at the timeout"""
+        pool = http_pool.HTTPPool(timeout = 0.5)
+        start = time.monotonic()
+        with pool.get(self.base + '/drip') as response:
+            with self.assertRaises(OSError):
+                while response.read1(1024):
+                    pass
+        self.assertTrue(time.monotonic() - start < 1.5)
+        pool.close()
+
+    def test_connection_refused(self):
+        """Check that connection errors are raised after the retries"""
+        self.assertRaises(OSError, self.pool.get, 'http://127.0.0.1:1/x')
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for image_store.py
+"""
+
+from recognition_server import image_store
+from recognition_server import postprocess
+import unittest
+import threading
+import tempfile
+import shutil
+import os
+
+
+class ImageStoreTestCase(unittest.TestCase):
+    def make_store(self, images):
+        return image_store.ImageStore(images)
+
+    def setUp(self):
+        self.store = self.make_store([
+            {'id': 1, 'title': u'Nikes', 'url': 'http://a/nike.jpg',
+             'results': '', 'resize': False, 'size': ""},
+            {'id': 2, 'title': u'Altra', 'url': 'http://a/altra.jpg',
+             'results': {0: {'results_name': 'shoe'}}, 'resize': False, 'size': ""}
+        ])
+
+    def test_add_and_get(self):
+        """Check that new images get the next id and can be looked up"""
+        img = self.store.add('http://a/new.jpg', 'new')
+        self.assertEqual(img['id'], 3)
+        self.assertEqual(self.store.get(3), img)
+        self.assertIsNone(self.store.get(4))
+        self.assertEqual([i['id'] for i in self.store.all()], [1, 2, 3])
+
+    def test_ids_not_reused_after_delete(self):
+        """Check that deleting the newest image doesn't reuse its id"""
+        img = self.store.add('http://a/new.jpg')
+        self.assertTrue(self.store.delete(img['id']))
+        self.assertFalse(self.store.delete(img['id']))
+        self.assertEqual(self.store.add('http://a/newer.jpg')['id'], 4)
+
+    def test_add_many(self):
+        """Check that images added in a batch get the next ids, in order"""
+        self.store.add('http://a/new.jpg')
+        self.store.delete(3)
+        imgs = self.store.add_many([
+            {'url': 'http://a/x.jpg', 'title': 'x'},
+            {'url': 'http://a/y.jpg', 'results': {"error": "invalid URL"}}])
+        self.assertEqual([img['id'] for img in imgs], [4, 5])
+        self.assertEqual(self.store.get(4), imgs[0])
+        self.assertEqual(self.store.get(5)['results'], {"error": "invalid URL"})
+        self.assertEqual([img['id'] for img in self.store.undone()], [1, 4])
+        self.assertEqual(self.store.add_many([]), [])
+
+    def test_undone_index(self):
+        """Check that the pending index follows results and deletes"""
+        self.assertEqual([i['id'] for i in self.store.undone()], [1])
+        self.store.add('http://a/new.jpg')
+        self.store.set_results(1, {})
+        self.assertEqual([i['id'] for i in self.store.undone()], [3])
+        self.store.delete(3)
+        self.assertEqual(self.store.undone(), [])
+        self.assertIsNone(self.store.set_results(3, {}))
+
+    def test_concurrent_adds(self):
+        """Check that concurrent adds all get distinct ids"""
+        def add_many():
+            for _ in range(200):
+                self.store.add('http://a/x.jpg')
+        threads = [threading.Thread(target = add_many) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.store), 802)
+        self.assertEqual(len(set(i['id'] for i in self.store.all())), 802)
+
+    def test_iter_images_in_pages(self):
+        """Check that paging through images gives each image once, in order"""
+        for _ in range(10):
+            self.store.add('http://a/x.jpg')
+        self.store.delete(5)
+        ids = [i['id'] for i in self.store.iter_images(after_id = 2, page_size = 3)]
+        self.assertEqual(ids, [3, 4, 6, 7, 8, 9, 10, 11, 12])
+
+    def test_iter_images_by_state(self):
+        """Check that paging by inference state stays in order as images change state"""
+        for _ in range(6):
+            self.store.add('http://a/x.jpg')
+        self.store.set_results_many([(img_id, {"error": "invalid URL"})
+                                     for img_id in (1, 4, 6)])
+        self.store.set_results(2, '')
+        ids = [i['id'] for i in self.store.iter_images(page_size = 2, state = 'undone')]
+        self.assertEqual(ids, [2, 3, 5, 7, 8])
+        ids = [i['id'] for i in self.store.iter_images(after_id = 1, page_size = 2,
+                                                       state = 'done')]
+        self.assertEqual(ids, [4, 6])
+
+    def test_set_results_many(self):
+        """Check that results written in a batch are stored and indexed"""
+        self.store.add('http://a/x.jpg')
+        self.store.set_results_many([(1, {'0': {'results_name': 'shoe'}}),
+                                     (3, {"error": "invalid URL"})])
+        self.assertEqual(self.store.get(3)['results'], {"error": "invalid URL"})
+        self.assertEqual(self.store.undone(), [])
+
+    def test_records_read_like_dicts(self):
+        """Check that records are compact objects with the old dict interface"""
+        img = self.store.get(1)
+        self.assertIsInstance(img, image_store.ImageRecord)
+        self.assertFalse(hasattr(img, '__dict__'))
+        self.assertEqual(dict(img), {'id': 1, 'title': u'Nikes', 'url': 'http://a/nike.jpg',
+                                     'results': '', 'resize': False, 'size': ""})
+        self.assertEqual(img.get('missing', 'default'), 'default')
+        with self.assertRaises(KeyError):
+            img['missing']
+
+    def test_compact_results(self):
+        """Check that compact results are stored and mark the image done"""
+        results = postprocess.CompactResults([2, 1], [0.75, 0.125])
+        self.store.set_results(1, results)
+        self.assertEqual(self.store.get(1)['results'], results)
+        self.assertEqual(self.store.undone(), [])
+
+
+class SQLiteImageStoreTestCase(ImageStoreTestCase):
+    def make_store(self, images):
+        self.db_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.db_dir, 'images.db')
+        return image_store.open_store('sqlite:' + self.db_path, images)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.db_dir)
+
+    def test_survives_restart(self):
+        """Check that images and results are still there after reopening"""
+        img = self.store.add('http://a/new.jpg', 'new')
+        self.store.set_results(1, {'0': {'results_name': 'shoe'}})
+        self.store.delete(img['id'])
+        self.store.close()
+        # the initial images are not added again to an existing database
+        self.store = image_store.open_store('sqlite:' + self.db_path, [
+            {'id': 1, 'title': u'Other', 'url': 'http://a/other.jpg',
+             'results': '', 'resize': False, 'size': ""}])
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(self.store.get(1)['title'], 'Nikes')
+        self.assertEqual(self.store.get(1)['results'], {'0': {'results_name': 'shoe'}})
+        self.assertEqual(self.store.undone(), [])
+        self.assertEqual(self.store.add('http://a/newer.jpg')['id'], 4)
+
+    def test_emptied_database_is_not_seeded_again(self):
+        """Check that deleting every image and reopening doesn't reuse ids"""
+        self.assertEqual(self.store.add('http://a/new.jpg')['id'], 3)
+        for img_id in (1, 2, 3):
+            self.store.delete(img_id)
+        self.store.close()
+        self.store = image_store.open_store('sqlite:' + self.db_path, [
+            {'id': 1, 'title': u'Nikes', 'url': 'http://a/nike.jpg',
+             'results': '', 'resize': False, 'size': ""}])
+        self.assertEqual(len(self.store), 0)
+        self.assertEqual(self.store.add('http://a/newer.jpg')['id'], 4)
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for jobs.py
+"""
+
+from recognition_server import jobs
+import unittest
+import threading
+
+
+class JobManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.manager = jobs.JobManager(max_workers = 2, max_jobs = 2)
+
+    def tearDown(self):
+        self.manager.shutdown()
+
+    def test_job_runs_in_background(self):
+        """Check that a job returns at once and its results can be streamed"""
+        release = threading.Event()
+        def work(job):
+            for i in range(3):
+                job.add_result({'id': i})
+                release.wait(5)
+        job = self.manager.submit(work, 3)
+        self.assertIs(self.manager.get(job.id), job)
+        self.assertEqual(job.to_dict()['total'], 3)
+        # the first result is available before the job finishes
+        first = next(job.iter_results(timeout = 5))
+        self.assertEqual(first, {'id': 0})
+        release.set()
+        self.assertEqual([r['id'] for r in job.iter_results(timeout = 5)], [0, 1, 2])
+        self.assertEqual(job.to_dict()['status'], 'done')
+        self.assertEqual(job.to_dict()['completed'], 3)
+
+    def test_failed_job(self):
+        """Check that an exception in a job is recorded as a failure"""
+        def work(job):
+            raise RuntimeError('model not loaded')
+        job = self.manager.submit(work, 1)
+        self.assertEqual(list(job.iter_results(timeout = 5)), [])
+        self.assertEqual(job.to_dict()['status'], 'failed')
+        self.assertEqual(job.to_dict()['error'], 'model not loaded')
+
+    def test_old_finished_jobs_are_forgotten(self):
+        """Check that only the most recent max_jobs finished jobs are kept"""
+        submitted = []
+        for _ in range(4):
+            job = self.manager.submit(lambda job: None, 0)
+            list(job.iter_results(timeout = 5))
+            submitted.append(job)
+        self.assertIsNone(self.manager.get(submitted[0].id))
+        self.assertIs(self.manager.get(submitted[-1].id), submitted[-1])
+
+
+if __name__ == '__main__':
+        unittest.main()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for lazy_module.py
+"""
+
+from recognition_server import lazy_module
+import unittest
+import sys
+
+
+class LazyModuleTestCase(unittest.TestCase):
+    def test_imports_on_first_use(self):
+        sys.modules.pop('colorsys', None)
+        colorsys = lazy_module.LazyModule('colorsys')
+        self.assertFalse(colorsys.loaded)
+        self.assertNotIn('colorsys', sys.modules)
+        self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+        self.assertTrue(colorsys.loaded)
+        self.assertIn('colorsys', sys.modules)
+
+    def test_missing_module(self):
+        missing = lazy_module.LazyModule('no_such_module_here')
+        with self.assertRaises(ImportError):
+            missing.anything
+        self.assertFalse(missing.loaded)
+
+    def test_setattr_reaches_module(self):
+        module = lazy_module.LazyModule('colorsys')
+        module.test_value = 1
+        self.assertEqual(sys.modules['colorsys'].test_value, 1)
+        del sys.modules['colorsys'].test_value
+
+
+if __name__ == '__main__':
+        unittest.main()
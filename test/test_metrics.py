@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for metrics.py
+"""
+
+from recognition_server import metrics
+import unittest
+import threading
+
+
+class CounterTestCase(unittest.TestCase):
+    def test_counts_by_label(self):
+        counter = metrics.Counter('test_counter_total', 'a test counter', ['kind'])
+        counter.inc(kind = 'a')
+        counter.inc(kind = 'a')
+        counter.inc(3, kind = 'b')
+        self.assertEqual(counter.value(kind = 'a'), 2)
+        self.assertEqual(counter.value(kind = 'b'), 3)
+        self.assertEqual(counter.value(kind = 'c'), 0)
+
+    def test_concurrent_increments(self):
+        counter = metrics.Counter('test_concurrent_total', 'a test counter')
+
+        def work():
+            for _ in range(1000):
+                counter.inc()
+        threads = [threading.Thread(target = work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.value(), 8000)
+
+
+class HistogramTestCase(unittest.TestCase):
+    def test_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('test_seconds', 'a test histogram', ['stage'],
+                                      buckets = (0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            histogram.observe(value, stage = 'x')
+        samples = dict(((name, labels), value)
+                       for name, labels, value in histogram.samples())
+        self.assertEqual(samples[('test_seconds_bucket', '{stage="x",le="0.1"}')], 1)
+        self.assertEqual(samples[('test_seconds_bucket', '{stage="x",le="1"}')], 3)
+        self.assertEqual(samples[('test_seconds_bucket', '{stage="x",le="+Inf"}')], 4)
+        self.assertEqual(samples[('test_seconds_count', '{stage="x"}')], 4)
+        self.assertAlmostEqual(samples[('test_seconds_sum', '{stage="x"}')], 6.05)
+        self.assertEqual(histogram.count(stage = 'x'), 4)
+
+    def test_bucket_bounds_are_inclusive(self):
+        histogram = metrics.Histogram('test_bound_seconds', 'a test histogram',
+                                      buckets = (1.0,))
+        histogram.observe(1.0)
+        samples = dict(((name, labels), value)
+                       for name, labels, value in histogram.samples())
+        self.assertEqual(samples[('test_bound_seconds_bucket', '{le="1"}')], 1)
+
+    def test_time(self):
+        histogram = metrics.Histogram('test_time_seconds', 'a test histogram', ['stage'])
+        with histogram.time(stage = 'fetch'):
+            pass
+        self.assertEqual(histogram.count(stage = 'fetch'), 1)
+
+    def test_time_records_on_exception(self):
+        histogram = metrics.Histogram('test_raise_seconds', 'a test histogram')
+        with self.assertRaises(ValueError):
+            with histogram.time():
+                raise ValueError()
+        self.assertEqual(histogram.count(), 1)
+
+
+class RenderTestCase(unittest.TestCase):
+    def test_text_format(self):
+        counter = metrics.Counter('test_render_total', 'rendered counter', ['error'])
+        counter.inc(error = 'say "hi"\n')
+        text = metrics.render()
+        self.assertIn('# HELP test_render_total rendered counter\n', text)
+        self.assertIn('# TYPE test_render_total counter\n', text)
+        self.assertIn('test_render_total{error="say \\"hi\\"\\n"} 1\n', text)
+        self.assertTrue(text.endswith('\n'))
+
+    def test_gauge_func(self):
+        metrics.GaugeFunc('test_gauge', 'a gauge', lambda: 2.5)
+        metrics.GaugeFunc('test_labelled_gauge', 'a gauge',
+                          lambda: {('a',): 1, ('b',): 2}, ['table'])
+        metrics.GaugeFunc('test_missing_gauge', 'not created yet', lambda: None)
+        metrics.GaugeFunc('test_broken_gauge', 'fails', lambda: 1 / 0)
+        text = metrics.render()
+        self.assertIn('test_gauge 2.5\n', text)
+        self.assertIn('test_labelled_gauge{table="b"} 2\n', text)
+        self.assertNotIn('test_missing_gauge', text)
+        self.assertNotIn('test_broken_gauge', text)
+
+    def test_empty_metrics_are_left_out(self):
+        metrics.Counter('test_unused_total', 'never incremented')
+        self.assertNotIn('test_unused_total', metrics.render())
+
+
+if __name__ == '__main__':
+        unittest.main()
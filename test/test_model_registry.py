@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for model_registry.py, with stand-in engines
+"""
+
+from recognition_server import model_registry
+import unittest
+import threading
+
+
+class FakeEngine(object):
+    """loads instantly, or when release is set, and 'uses' memory bytes"""
+
+    def __init__(self, memory = 100, release = None, fail = False):
+        self.memory = memory
+        self.release = release
+        self.fail = fail
+        self.loads = 0
+        self.closed = False
+        self.graph_path = None
+        self.rss_before_load = 0
+        self.rss_after_load = 0
+
+    def warm_up(self):
+        if self.release is not None:
+            self.release.wait(5)
+        if self.fail:
+            raise IOError('no graph')
+        self.loads += 1
+        self.rss_after_load = self.memory
+
+    def close(self):
+        self.closed = True
+
+
+class FakeScheduler(object):
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class ModelRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        # name -> keyword arguments for the next FakeEngine
+        self.engine_args = {}
+        self.registry = self.make_registry()
+
+    def make_registry(self, memory_budget = 0):
+        def make_model(spec, version):
+            engine = FakeEngine(**self.engine_args.get(spec.name, {}))
+            return model_registry.Model(spec, engine, FakeScheduler(),
+                                        '%s-%d' % (spec.name, version), version)
+        registry = model_registry.ModelRegistry(make_model, memory_budget)
+        for name in ('default', 'a', 'b', 'c'):
+            registry.register(model_registry.ModelSpec(name, '/models/' + name))
+        return registry
+
+    def test_models_load_on_first_use(self):
+        model = self.registry.get('a', load = False)
+        self.assertEqual(model.state, 'not loaded')
+        with self.registry.acquire('a') as leased:
+            self.assertIs(leased, model)
+            self.assertEqual(model.leases, 1)
+        self.registry.get('a')
+        self.assertEqual((model.state, model.engine.loads), ('ready', 1))
+        self.assertEqual(self.registry.get().name, 'default')
+        self.assertEqual(self.registry.stats()['loads'], 2)
+
+    def test_on_load(self):
+        """Check that on_load is called once the engine is loaded, not before"""
+        loaded = []
+        model = model_registry.Model(model_registry.ModelSpec('a', '/models/a'),
+                                     FakeEngine(), FakeScheduler(), 'a-1',
+                                     on_load = loaded.append)
+        self.assertEqual(loaded, [])
+        model.warm_up()
+        model.warm_up()
+        self.assertEqual(loaded, [model])
+
+    def test_unknown_model(self):
+        with self.assertRaises(model_registry.UnknownModel) as cm:
+            self.registry.get('nope')
+        self.assertEqual(cm.exception.error_dict, {'error': 'unknown model nope'})
+        self.assertRaises(KeyError, self.registry.spec, 'nope')
+
+    def test_swap_waits_for_running_requests(self):
+        """Check that the old version is only closed once its last lease is released"""
+        old = self.registry.lease('a')
+        new = self.registry.swap(model_registry.ModelSpec('a', '/models/a2'),
+                                 background = False)
+        self.assertEqual(new.version, 2)
+        self.assertIs(self.registry.get('a'), new)
+        self.assertEqual(self.registry.spec('a').model_dir, '/models/a2')
+        self.assertFalse(old.engine.closed or old.scheduler.stopped)
+        self.registry.release(old)
+        self.assertTrue(old.engine.closed and old.scheduler.stopped)
+        self.assertFalse(new.engine.closed)
+
+    def test_requests_use_old_version_while_new_one_loads(self):
+        self.registry.get('a')
+        release = threading.Event()
+        self.engine_args['a'] = {'release': release}
+        new = self.registry.swap(model_registry.ModelSpec('a', '/models/a2'))
+        with self.registry.acquire('a') as model:
+            self.assertEqual(model.version, 1)
+        self.assertEqual(self.registry.stats()['models']['a']['loading_version'], 2)
+        release.set()
+        for thread in threading.enumerate():
+            if thread.name == 'model-swap-a':
+                thread.join()
+        with self.registry.acquire('a') as model:
+            self.assertIs(model, new)
+        self.assertEqual(self.registry.stats()['swaps'], 1)
+
+    def test_failed_swap_keeps_old_version(self):
+        old = self.registry.get('a')
+        self.engine_args['a'] = {'fail': True}
+        new = self.registry.swap(model_registry.ModelSpec('a', '/models/a2'),
+                                 background = False)
+        self.assertEqual(new.state, 'failed')
+        self.assertIs(self.registry.get('a'), old)
+        self.assertEqual(self.registry.spec('a').model_dir, '/models/a')
+
+    def test_least_recently_used_model_is_evicted(self):
+        """Check that idle models are closed, oldest first, over the memory budget"""
+        registry = self.make_registry(memory_budget = 250)
+        default = registry.get()
+        a = registry.get('a')
+        b = registry.get('b')
+        self.assertTrue(a.engine.closed)
+        self.assertFalse(default.engine.closed or b.engine.closed)
+        stats = registry.stats()
+        self.assertEqual((stats['evictions'], stats['memory']), (1, 200))
+        self.assertEqual(stats['models']['a']['state'], 'not loaded')
+        # loaded again on next use
+        self.assertEqual(registry.get('a').version, 2)
+        self.assertTrue(b.engine.closed)
+
+    def test_models_in_use_are_not_evicted(self):
+        registry = self.make_registry(memory_budget = 250)
+        registry.get()
+        with registry.acquire('a') as a:
+            b = registry.get('b')
+            self.assertFalse(a.engine.closed or b.engine.closed)
+            registry.get('c')
+            self.assertTrue(b.engine.closed)
+            self.assertFalse(a.engine.closed)
+
+    def test_evict(self):
+        model = self.registry.get('b')
+        self.assertTrue(self.registry.evict('b'))
+        self.assertTrue(model.engine.closed)
+        self.assertFalse(self.registry.evict('b'))
+
+
+class ModelSpecTestCase(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(model_registry.ModelSpec.parse(' v2=/models/v2:fp16'),
+                         model_registry.ModelSpec('v2', '/models/v2', 'fp16'))
+        self.assertEqual(model_registry.ModelSpec.parse('v2=/models/v2').variant, 'original')
+        self.assertRaises(ValueError, model_registry.ModelSpec.parse, '/models/v2')
+
+
+if __name__ == '__main__':
+        unittest.main()
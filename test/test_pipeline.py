@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for pipeline.py
+"""
+
+from recognition_server import pipeline
+import unittest
+import threading
+import time
+
+
+def fetch(item):
+    if item < 0:
+        return {"error": "invalid URL"}, False
+    time.sleep(0.01)
+    return item, True
+
+
+def decode(data):
+    if data == 13:
+        return {"error": "file cannot be decoded"}, False
+    return data * 10, True
+
+
+class InferencePipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.pipeline = pipeline.InferencePipeline(
+            fetch, decode, self.infer_batch, fetch_workers = 8,
+            decode_workers = 2, batch_size = 4, queue_size = 4)
+
+    def infer_batch(self, tensors):
+        self.batches.append(len(tensors))
+        return [{"value": tensor} for tensor in tensors]
+
+    def test_results_in_order(self):
+        """Check that every item gets its own result, errors included"""
+        items = list(range(20)) + [-1]
+        results = self.pipeline.run_all(items)
+        self.assertEqual(len(results), 21)
+        self.assertEqual(results[3], {"value": 30})
+        self.assertEqual(results[13], {"error": "file cannot be decoded"})
+        self.assertEqual(results[20], {"error": "invalid URL"})
+        self.assertTrue(max(self.batches) <= 4)
+
+    def test_fetches_run_concurrently(self):
+        """Check that slow fetches overlap, rather than running one by one"""
+        start = time.time()
+        self.pipeline.run_all(range(80))
+        # 80 sequential fetches would take at least 0.8s
+        self.assertTrue(time.time() - start < 0.6)
+
+    def test_empty_input(self):
+        """Check that an empty list finishes straight away"""
+        self.assertEqual(self.pipeline.run_all([]), [])
+
+    def test_stopping_early_releases_threads(self):
+        """Check that abandoning a run does not leave threads blocked"""
+        before = threading.active_count()
+        for _ in self.pipeline.run(range(200)):
+            break
+        time.sleep(0.5)
+        self.assertTrue(threading.active_count() <= before + 1)
+
+
+if __name__ == '__main__':
+        unittest.main()
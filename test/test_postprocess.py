@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for postprocess.py
+"""
+
+from recognition_server import postprocess
+import unittest
+import json
+import numpy as np
+
+
+def reference_top_k(row, k, threshold):
+    """the old per-image loop: full sort, then threshold"""
+    top = row.argsort()[-k:][::-1]
+    return [(int(i), float(row[i])) for i in top if row[i] > threshold]
+
+
+class TopKTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        logits = rng.randn(8, 1008).astype(np.float32) * 3
+        self.predictions = np.exp(logits) / np.exp(logits).sum(axis = 1, keepdims = True)
+
+    def test_matches_full_sort(self):
+        """Check the top k of every row agree with a full argsort"""
+        for threshold in (0.0, 0.01, 0.05):
+            top = postprocess.top_k(self.predictions, 5, threshold)
+            for row in range(len(self.predictions)):
+                expected = reference_top_k(self.predictions[row], 5, threshold)
+                count = top.counts[row]
+                self.assertEqual(count, len(expected))
+                self.assertEqual(top.ids[row, :count].tolist(), [i for i, _ in expected])
+                np.testing.assert_allclose(top.scores[row, :count],
+                                           [s for _, s in expected], rtol = 1e-6)
+                self.assertTrue(np.all(top.ids[row, count:] == -1))
+
+    def test_compact_arrays(self):
+        top = postprocess.top_k(self.predictions, 3)
+        self.assertEqual(top.ids.shape, (8, 3))
+        self.assertEqual(top.ids.dtype, np.int32)
+        self.assertEqual(top.scores.dtype, np.float32)
+
+    def test_single_row_and_large_k(self):
+        top = postprocess.top_k(np.array([0.1, 0.6, 0.3]), 10)
+        self.assertEqual(top.ids.tolist(), [[1, 2, 0]])
+        top = postprocess.top_k(np.array([0.1, 0.6, 0.3]), 0)
+        self.assertEqual(top.to_dicts(), [{}])
+
+    def test_labels_and_dicts(self):
+        """Check labels are gathered, and ids without a label get an empty name"""
+        labels = np.array(['', 'cat', 'dog'])
+        predictions = np.array([[0.05, 0.15, 0.2, 0.6], [0.7, 0.1, 0.2, 0.0]])
+        top = postprocess.top_k(predictions, 3, 0.1, labels)
+        self.assertEqual(top.to_dicts(), [
+            {0: {"results_score": "0.6000", "results_name": ""},
+             1: {"results_score": "0.2000", "results_name": "dog"},
+             2: {"results_score": "0.1500", "results_name": "cat"}},
+            {0: {"results_score": "0.7000", "results_name": ""},
+             1: {"results_score": "0.2000", "results_name": "dog"}}])
+
+    def test_row(self):
+        """Check one image can be taken out of a batch"""
+        labels = np.array(['a', 'b', 'c', 'd'])
+        predictions = np.array([[0.1, 0.2, 0.3, 0.4], [0.7, 0.1, 0.1, 0.1]])
+        top = postprocess.top_k(predictions, 2, 0.15, labels)[1]
+        self.assertEqual(len(top), 1)
+        self.assertEqual(top.ids.tolist(), [[0]])
+        self.assertEqual(top.to_dicts()[0][0]["results_name"], 'a')
+
+
+class CompactResultsTestCase(unittest.TestCase):
+    def setUp(self):
+        predictions = np.array([[0.1, 0.2, 0.3, 0.4], [0.7, 0.1, 0.1, 0.1]])
+        self.top = postprocess.top_k(predictions, 3, 0.15)
+
+    def test_from_top_drops_padding(self):
+        """Check that one row is copied into small fixed-width arrays"""
+        results = postprocess.CompactResults.from_top(self.top, 1)
+        self.assertEqual(results.ids.dtype, np.int16)
+        self.assertEqual(results.scores.dtype, np.float32)
+        self.assertEqual(results.ids.tolist(), [0])
+        self.assertFalse(np.shares_memory(results.scores, self.top.scores))
+
+    def test_to_dict_matches_top_k_results(self):
+        """Check that the API format is unchanged"""
+        labels = np.array(['a', 'b', 'c', 'd'])
+        results = postprocess.CompactResults.from_top(self.top, 0)
+        labelled = postprocess.top_k(
+            np.array([[0.1, 0.2, 0.3, 0.4]]), 3, 0.15, labels)
+        self.assertEqual(results.to_dict(labels), labelled.to_dicts()[0])
+        self.assertEqual(results.to_dict()[0]["results_name"], '3')
+
+    def test_json_round_trip(self):
+        """Check that results are stored as arrays and read back"""
+        results = postprocess.CompactResults.from_top(self.top, 0)
+        text = json.dumps({'results': results}, default = postprocess.json_default)
+        self.assertIn('"top_ids": [3, 2, 1]', text)
+        loaded = json.loads(text, object_hook = postprocess.json_object_hook)
+        self.assertEqual(loaded['results'], results)
+        self.assertNotEqual(loaded['results'], '')
+
+    def test_model_name_is_kept(self):
+        """Check that results of another model keep its name, and the default's don't"""
+        results = postprocess.CompactResults.from_top(self.top, 0, model = 'fp16')
+        self.assertEqual(results.to_json()['model'], 'fp16')
+        self.assertNotIn('model', postprocess.CompactResults([1], [0.5]).to_json())
+        text = json.dumps(results, default = postprocess.json_default)
+        loaded = json.loads(text, object_hook = postprocess.json_object_hook)
+        self.assertEqual(loaded.model, 'fp16')
+        self.assertEqual(loaded, results)
+        self.assertNotEqual(loaded, postprocess.CompactResults.from_top(self.top, 0))
+
+
+class AgreementTestCase(unittest.TestCase):
+    def test_identical(self):
+        predictions = np.random.RandomState(1).rand(6, 50)
+        report = postprocess.top_k_agreement(predictions, predictions, 5)
+        self.assertEqual(report['top1_agreement'], 1.0)
+        self.assertEqual(report['topk_agreement'], 1.0)
+        self.assertEqual(report['topk_overlap'], 1.0)
+        self.assertEqual(report['max_abs_difference'], 0.0)
+
+    def test_partial_agreement(self):
+        reference = np.array([[0.5, 0.3, 0.1, 0.05, 0.05],
+                              [0.1, 0.2, 0.3, 0.4, 0.0]])
+        # first image: top two swapped, second image: completely reversed
+        candidate = np.array([[0.3, 0.5, 0.1, 0.05, 0.05],
+                              [0.4, 0.3, 0.2, 0.1, 0.0]])
+        report = postprocess.top_k_agreement(reference, candidate, 2)
+        self.assertEqual(report['k'], 2)
+        self.assertEqual(report['top1_agreement'], 0.0)
+        self.assertEqual(report['topk_agreement'], 0.5)
+        self.assertEqual(report['topk_overlap'], 0.5)
+        self.assertAlmostEqual(report['max_abs_difference'], 0.3, places = 6)
+
+
+if __name__ == '__main__':
+        unittest.main()
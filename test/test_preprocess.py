@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for preprocess.py
+"""
+
+from recognition_server import preprocess
+import unittest
+import io
+import numpy as np
+from PIL import Image
+
+
+def encode(size, image_format, colour = (200, 10, 10)):
+    buf = io.BytesIO()
+    Image.new('RGB', size, colour).save(buf, format = image_format)
+    return buf.getvalue()
+
+
+class TestPreprocess(unittest.TestCase):
+
+    def test_large_jpeg(self):
+        image = preprocess.preprocess_image(encode((1600, 1200), 'JPEG'))
+        self.assertEqual(image.tensor.shape, (1, 299, 299, 3))
+        self.assertEqual(image.tensor.dtype, np.float32)
+        self.assertEqual(image.size, '1600x1200')
+        self.assertTrue(image.resized)
+
+    def test_normalised(self):
+        image = preprocess.preprocess_image(encode((64, 64), 'PNG', (255, 0, 128)))
+        self.assertTrue(np.all(image.tensor >= -1.0))
+        self.assertTrue(np.all(image.tensor <= 1.0))
+        self.assertAlmostEqual(float(image.tensor[0, 0, 0, 0]), 127 / 128.0, places = 5)
+        self.assertAlmostEqual(float(image.tensor[0, 0, 0, 1]), -1.0, places = 5)
+
+    def test_png_and_gif(self):
+        for image_format in ('PNG', 'GIF'):
+            image = preprocess.preprocess_image(encode((40, 30), image_format))
+            self.assertEqual(image.tensor.shape, (1, 299, 299, 3))
+            self.assertEqual(image.size, '40x30')
+            self.assertTrue(image.resized)
+
+    def test_exact_size_not_resized(self):
+        image = preprocess.preprocess_image(encode((299, 299), 'PNG'))
+        self.assertFalse(image.resized)
+
+    def test_garbage(self):
+        with self.assertRaises(preprocess.DECODE_ERRORS):
+            preprocess.preprocess_image(b'\xff\xd8\xff not really a jpeg')
+
+
+if __name__ == '__main__':
+        unittest.main()
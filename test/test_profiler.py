@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for profiler.py
+"""
+
+from recognition_server import profiler
+import unittest
+import threading
+import time
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class SamplingProfilerTestCase(unittest.TestCase):
+    def test_samples_other_threads(self):
+        sampler = profiler.SamplingProfiler(interval_ms = 1)
+        stop = threading.Event()
+        thread = threading.Thread(target = busy_loop, args = (stop,), name = 'busy')
+        thread.start()
+        try:
+            sampler.start()
+            time.sleep(0.2)
+            sampler.stop()
+        finally:
+            stop.set()
+            thread.join()
+        stats = sampler.stats()
+        self.assertFalse(stats['running'])
+        self.assertGreater(stats['samples'], 0)
+        folded = sampler.folded()
+        busy = [line for line in folded.splitlines() if line.startswith('busy;')]
+        self.assertTrue(busy)
+        self.assertIn(':busy_loop:', busy[0])
+        self.assertTrue(busy[0].rsplit(' ', 1)[1].isdigit())
+        # the profiler doesn't sample itself
+        self.assertNotIn('profiler;', folded)
+
+    def test_reset(self):
+        sampler = profiler.SamplingProfiler()
+        sampler.sample()
+        self.assertEqual(sampler.stats()['samples'], 1)
+        sampler.reset()
+        self.assertEqual(sampler.stats()['samples'], 0)
+        self.assertEqual(sampler.folded(), '')
+
+    def test_stop_when_not_running(self):
+        sampler = profiler.SamplingProfiler()
+        sampler.stop()
+        self.assertFalse(sampler.running)
+
+
+if __name__ == '__main__':
+        unittest.main()
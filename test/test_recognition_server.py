@@ -7,8 +7,13 @@ Created on Sat Aug 12 19:16:24 2017
 """
 
 from recognition_server import recognition_server
+from recognition_server import postprocess
+from recognition_server import admission
 import unittest
 import json
+import io
+import time
+import numpy as np
 
 
 class Recognition_ServerTestCase(unittest.TestCase):
@@ -26,6 +31,29 @@ class Recognition_ServerTestCase(unittest.TestCase):
         self.assertEqual(rv.status_code, 200)
         assert b'images' in rv.data
       
+    def test_get_imgs_paginated(self):
+        """Check that images can be listed a page at a time, with a cursor"""
+        rv = self.app.get('/img/api/v1.0/images?limit=1&fields=id,url')
+        self.assertEqual(rv.status_code, 200)
+        page = json.loads(rv.data)
+        self.assertEqual(len(page['images']), 1)
+        self.assertEqual(set(page['images'][0]), set(['id', 'url']))
+        rv = self.app.get('/img/api/v1.0/images?limit=1&after_id=%d'
+                          % page['next_after_id'])
+        self.assertTrue(json.loads(rv.data)['images'][0]['id'] > page['next_after_id'])
+
+    def test_get_imgs_ndjson(self):
+        """Check that images can be streamed one per line"""
+        rv = self.app.get('/img/api/v1.0/images?format=ndjson&state=undone')
+        self.assertEqual(rv.status_code, 200)
+        for line in rv.data.splitlines():
+            self.assertEqual(json.loads(line)['results'], '')
+
+    def test_get_imgs_bad_state(self):
+        """Check that 400 gets thrown for an unknown inference state"""
+        rv = self.app.get('/img/api/v1.0/images?state=sideways')
+        self.assertEqual(rv.status_code, 400)
+
     def test_non_existing_function(self):
         """Check that 404 gets thrown for a function that doesn't exist"""
         rv = self.app.get('/img/api/v1.0/a-bad-address')
@@ -75,6 +103,200 @@ class Recognition_ServerTestCase(unittest.TestCase):
         self.assertEqual(rv.status_code, 200)
         self.assertIn(b'0.5944', rv.data)
     
+    def test_get_engine_stats(self):
+        """Check that engine statistics are reported"""
+        rv = self.app.get('/img/api/v1.0/stats')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'rss_current', rv.data)
+
+    def test_not_ready_before_warm_up(self):
+        """Check that readiness is 503 until the model has been loaded"""
+        rv = self.app.get('/img/api/v1.0/ready')
+        self.assertEqual(rv.status_code, 503)
+        self.assertFalse(json.loads(rv.data.decode('utf-8'))['ready'])
+
+    def test_get_metrics(self):
+        """Check that requests are counted in the Prometheus metrics"""
+        self.app.get('/img/api/v1.0/images')
+        rv = self.app.get('/metrics')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn(b'# TYPE recognition_http_requests_total counter', rv.data)
+        self.assertIn(b'endpoint="/img/api/v1.0/images",method="GET",status="200"', rv.data)
+
+    def test_classify_raw_upload(self):
+        """Check that a raw upload is checked and keyed by its id"""
+        rv = self.app.post('/img/api/v1.0/classify?id=doc',
+           data = b'not an image', content_type = 'application/octet-stream')
+        self.assertEqual(rv.status_code, 200)
+        results = json.loads(rv.data.decode('utf-8'))['results']
+        self.assertEqual(results['doc']['results'], {'error': 'file cannot be opened'})
+
+    def test_classify_multipart_upload(self):
+        """Check that each part of a multipart upload gets a result"""
+        # the large part would be spooled to a temporary file by default
+        data = {
+            'first': (io.BytesIO(b'not an image'), 'first.jpg'),
+            'second': (io.BytesIO(b'x' * (600 * 1024)), 'second.jpg'),
+            'same': [(io.BytesIO(b'a'), 'a.jpg'), (io.BytesIO(b'b'), 'b.jpg')]
+        }
+        rv = self.app.post('/img/api/v1.0/classify', data = data,
+                           content_type = 'multipart/form-data')
+        self.assertEqual(rv.status_code, 200)
+        results = json.loads(rv.data.decode('utf-8'))['results']
+        self.assertEqual(set(results), set(['first', 'second', 'a.jpg', 'b.jpg']))
+        self.assertEqual(results['second']['results'], {'error': 'file cannot be opened'})
+
+    def test_classify_without_data(self):
+        """Check that 400 gets thrown when no image is uploaded"""
+        rv = self.app.post('/img/api/v1.0/classify')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_compact_results_keep_response_format(self):
+        """Check that compact results are returned with class names and scores"""
+        tf_operations = recognition_server.tf_operations
+        lookup = tf_operations._node_lookup
+        tf_operations._node_lookup = type('Labels', (), {
+            'node_lookup': np.array(['', 'shoe', 'boot'])})()
+        results = postprocess.CompactResults([2, 1], [0.75, 0.125])
+        img = recognition_server.images.add('http://a/boot.jpg', 'boot', results)
+        try:
+            for encoder in ('json', 'orjson'):
+                tf_operations.FLAGS.json_encoder = encoder
+                rv = self.app.get('/img/api/v1.0/images/%d' % img['id'])
+                self.assertEqual(json.loads(rv.data.decode('utf-8'))['img']['results'], {
+                    '0': {'results_name': 'boot', 'results_score': '0.7500'},
+                    '1': {'results_name': 'shoe', 'results_score': '0.1250'}})
+                rv = self.app.get('/img/api/v1.0/images?format=ndjson&state=done')
+                self.assertIn(b'"results_name":"boot"', rv.data.replace(b' ', b''))
+        finally:
+            tf_operations._node_lookup = lookup
+            recognition_server.images.delete(img['id'])
+
+    def test_upload_over_limit(self):
+        """Check that 413 gets thrown for an upload over --max_upload_bytes"""
+        recognition_server.tf_operations.parse_args(['--max_upload_bytes', '100'])
+        recognition_server.set_upload_limit()
+        try:
+            rv = self.app.post('/img/api/v1.0/classify?id=big', data = b'\xff' * 101,
+                               content_type = 'image/jpeg')
+            self.assertEqual(rv.status_code, 413)
+            self.assertEqual(json.loads(rv.data.decode('utf-8')), {'error': 'request too large'})
+            rv = self.app.post('/img/api/v1.0/classify',
+                               data = {'big': (io.BytesIO(b'\xff' * 101), 'big.jpg')},
+                               content_type = 'multipart/form-data')
+            self.assertEqual(rv.status_code, 413)
+        finally:
+            recognition_server.tf_operations.parse_args()
+            recognition_server.set_upload_limit()
+
+    def test_similar_without_embeddings(self):
+        """Check that similarity search says when embeddings are turned off"""
+        rv = self.app.get('/img/api/v1.0/similar/1')
+        self.assertEqual(rv.status_code, 501)
+        self.assertIn(b'--embedding_index', rv.data)
+
+    def test_get_models(self):
+        """Check that the served models are listed"""
+        rv = self.app.get('/img/api/v1.0/models')
+        self.assertEqual(rv.status_code, 200)
+        models = json.loads(rv.data.decode('utf-8'))['models']
+        self.assertIn('default', models['models'])
+        self.assertEqual(models['default'], 'default')
+
+    def test_unknown_model(self):
+        """Check that 404 gets thrown for a model which isn't served"""
+        rv = self.app.post('/img/api/v1.0/classify?model=nope',
+           data = b'not an image', content_type = 'application/octet-stream')
+        self.assertEqual(rv.status_code, 404)
+        self.assertEqual(json.loads(rv.data.decode('utf-8')), {'error': 'unknown model nope'})
+        rv = self.app.delete('/img/api/v1.0/models/nope')
+        self.assertEqual(rv.status_code, 404)
+
+    def test_put_model_needs_known_variant(self):
+        """Check that 400 gets thrown for a new model without files, or a bad variant"""
+        rv = self.app.put('/img/api/v1.0/models/new',
+           data = json.dumps({'variant': 'fp16'}), content_type = 'application/json')
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.put('/img/api/v1.0/models/default',
+           data = json.dumps({'variant': 'fp8'}), content_type = 'application/json')
+        self.assertEqual(rv.status_code, 400)
+
+    def test_too_many_images_per_request(self):
+        """Check that 413 gets thrown for more images than allowed per request"""
+        new_imgs = [{'url': 'http://a/%d.jpg' % i} for i in range(1001)]
+        rv = self.app.post('/img/api/v1.0/imagesinfer',
+           data = json.dumps(dict(new_imgs = new_imgs)),
+           content_type = 'application/json')
+        self.assertEqual(rv.status_code, 413)
+
+    def test_infer_undone_takes_at_most_the_cap(self):
+        """Check that a backlog bigger than the per-request cap is done a part at a time"""
+        control = recognition_server.admission_control
+        store = recognition_server.images
+        recognition_server.admission_control = admission.AdmissionController(
+            max_images_per_request = 2)
+        recognition_server.images = recognition_server.image_store.ImageStore()
+        try:
+            for i in range(5):
+                # refused at once, so the images are done with an error
+                recognition_server.images.add('http://127.0.0.1:1/%d.jpg' % i)
+            rv = self.app.put('/img/api/v1.0/inferundone')
+            self.assertEqual(rv.status_code, 200)
+            body = json.loads(rv.data.decode('utf-8'))
+            self.assertEqual([img['id'] for img in body['images']], [1, 2])
+            self.assertEqual(body['remaining'], 3)
+            rv = self.app.put('/img/api/v1.0/inferundone?async=true')
+            self.assertEqual(rv.status_code, 202)
+            body = json.loads(rv.data.decode('utf-8'))
+            self.assertEqual(body['remaining'], 1)
+            # the job writes to this store, so it must finish before it is put back
+            job = recognition_server.job_manager.get(body['job']['id'])
+            for _ in job.iter_results(10):
+                pass
+            for _ in range(1000):
+                if job.done:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(recognition_server.images.undone_count(), 1)
+        finally:
+            recognition_server.admission_control = control
+            recognition_server.images = store
+
+    def test_overloaded_server_sheds_requests(self):
+        """Check that 429 and 503 with Retry-After are returned when full"""
+        control = recognition_server.admission_control
+        recognition_server.admission_control = admission.AdmissionController(
+            max_queued = 2, bulk_share = 0.5)
+        try:
+            recognition_server.admission_control.admit(1)
+            new_imgs = [{'url': 'http://a/1.jpg'}, {'url': 'http://a/2.jpg'}]
+            rv = self.app.post('/img/api/v1.0/imagesinfer?async=true',
+               data = json.dumps(dict(new_imgs = new_imgs)),
+               content_type = 'application/json')
+            self.assertEqual(rv.status_code, 429)
+            self.assertEqual(rv.headers['Retry-After'], '1')
+            recognition_server.admission_control.admit(1)
+            rv = self.app.put('/img/api/v1.0/infer/1',
+               data = json.dumps(dict(id = 1)), content_type = 'application/json')
+            self.assertEqual(rv.status_code, 503)
+            self.assertIn(b'overloaded', rv.data)
+        finally:
+            recognition_server.admission_control = control
+
+    def test_expired_deadline(self):
+        """Check that 504 gets thrown when the caller's deadline has passed"""
+        rv = self.app.put('/img/api/v1.0/infer/1',
+           data = json.dumps(dict(id = 1)), content_type = 'application/json',
+           headers = {'X-Request-Timeout': '0.000001'})
+        self.assertEqual(rv.status_code, 504)
+        self.assertEqual(json.loads(rv.data.decode('utf-8')), {'error': 'deadline exceeded'})
+        self.assertEqual(recognition_server.images.get(1)['results'], '')
+
+    def test_get_non_existing_job(self):
+        """Check that 404 gets thrown for a job that doesn't exist"""
+        rv = self.app.get('/img/api/v1.0/jobs/not-a-job')
+        self.assertEqual(rv.status_code, 404)
+
     def test_add_and_inference_on_image(self):
         """Use POST to run inference and add image"""
         new_im = {"url": "https://farm4.static.flickr.com/3118/3275588806_33384d2638.jpg"}
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for result_cache.py
+"""
+
+from recognition_server import result_cache
+from recognition_server import postprocess
+import unittest
+import tempfile
+import shutil
+
+
+RESULTS = {0: {"results_score": "0.5944", "results_name": "running shoe"}}
+
+
+class ResultCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = result_cache.ResultCache(max_entries = 2, model_key = 'a')
+
+    def test_url_level(self):
+        """Check that URLs map to content hashes and validators"""
+        self.assertIsNone(self.cache.get_url('http://a/x.jpg'))
+        self.cache.put_url('http://a/x.jpg', 'abc', etag = '"1"')
+        self.assertEqual(self.cache.get_url('http://a/x.jpg'), ('abc', '"1"', None))
+        self.cache.forget_url('http://a/x.jpg')
+        self.assertIsNone(self.cache.get_url('http://a/x.jpg'))
+        stats = self.cache.stats()
+        self.assertEqual((stats['url_hits'], stats['url_misses']), (1, 2))
+
+    def test_lru_eviction(self):
+        """Check that the least recently used results are evicted first"""
+        for key in ['h1', 'h2']:
+            self.cache.put_results(key, RESULTS)
+        self.cache.get_results('h1')
+        self.cache.put_results('h3', RESULTS)
+        self.assertIsNone(self.cache.get_results('h2'))
+        self.assertEqual(self.cache.get_results('h1'), RESULTS)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_model_key_change_drops_results(self):
+        """Check that results are dropped when the model or settings change"""
+        self.cache.put_results('h1', RESULTS)
+        self.cache.put_url('http://a/x.jpg', 'h1')
+        self.cache.set_model_key('b')
+        self.assertIsNone(self.cache.get_results('h1'))
+        self.assertIsNotNone(self.cache.get_url('http://a/x.jpg'))
+
+    def test_disk_tier(self):
+        """Check that results survive in the on-disk tier, per model key"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = result_cache.ResultCache(cache_dir = cache_dir, model_key = 'a')
+            cache.put_results('h1', RESULTS)
+            cache = result_cache.ResultCache(cache_dir = cache_dir, model_key = 'a')
+            self.assertEqual(cache.get_results('h1')['0']['results_name'], 'running shoe')
+            self.assertEqual(cache.stats()['disk_hits'], 1)
+            cache = result_cache.ResultCache(cache_dir = cache_dir, model_key = 'b')
+            self.assertIsNone(cache.get_results('h1'))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_disk_tier_compact_results(self):
+        """Check that compact results are read back from disk"""
+        cache_dir = tempfile.mkdtemp()
+        try:
+            results = postprocess.CompactResults([2, 1], [0.75, 0.125])
+            cache = result_cache.ResultCache(cache_dir = cache_dir, model_key = 'a')
+            cache.put_results('h1', {'results': results, 'size': '', 'resize': False})
+            cache = result_cache.ResultCache(cache_dir = cache_dir, model_key = 'a')
+            self.assertEqual(cache.get_results('h1')['results'], results)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_content_hash(self):
+        """Check that identical bytes give identical hashes"""
+        self.assertEqual(result_cache.content_hash(b'abc'),
+                         result_cache.content_hash(b'abc'))
+        self.assertNotEqual(result_cache.content_hash(b'abc'),
+                            result_cache.content_hash(b'abd'))
+
+
+if __name__ == '__main__':
+        unittest.main()
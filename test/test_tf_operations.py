@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for tf_operations.py
+"""
+
+from recognition_server import tf_operations
+import unittest
+import tempfile
+import tarfile
+import shutil
+import io
+import os
+import numpy as np
+from PIL import Image
+
+
+UID_LINES = 'n01440764\ttench, Tinca tinca\nn01443537\tgoldfish, Carassius auratus\n'
+LABEL_LINES = """entry {
+  target_class: 449
+  target_class_string: "n01440764"
+}
+entry {
+  target_class: 450
+  target_class_string: "n01443537"
+}
+"""
+
+
+class NodeLookupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.model_dir = tempfile.mkdtemp()
+        self.uid_path = os.path.join(self.model_dir, 'uid.txt')
+        self.label_path = os.path.join(self.model_dir, 'label.pbtxt')
+        with open(self.uid_path, 'w') as f:
+            f.write(UID_LINES)
+        with open(self.label_path, 'w') as f:
+            f.write(LABEL_LINES)
+
+    def tearDown(self):
+        shutil.rmtree(self.model_dir)
+
+    def test_id_to_string(self):
+        """Check that node IDs are looked up, and unknown IDs give ''"""
+        lookup = tf_operations.NodeLookup(self.label_path, self.uid_path)
+        self.assertEqual(lookup.id_to_string(449), 'tench, Tinca tinca')
+        self.assertEqual(lookup.id_to_string(450), 'goldfish, Carassius auratus')
+        self.assertEqual(lookup.id_to_string(1), '')
+        self.assertEqual(lookup.id_to_string(5000), '')
+
+    def test_sidecar_file_is_reused(self):
+        """Check that the compiled label table is written and memory-mapped"""
+        tf_operations.NodeLookup(self.label_path, self.uid_path)
+        cache_path = os.path.join(self.model_dir, tf_operations.LABELS_CACHE_FILE)
+        self.assertTrue(os.path.exists(cache_path))
+        # text files are no longer needed once the sidecar is up to date
+        os.utime(cache_path, (os.path.getmtime(self.uid_path) + 10,) * 2)
+        lookup = tf_operations.NodeLookup(self.label_path, self.uid_path)
+        self.assertEqual(lookup.id_to_string(450), 'goldfish, Carassius auratus')
+
+
+class ModelFilesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.model_dir = tempfile.mkdtemp()
+        tf_operations.parse_args(['--model_dir', self.model_dir])
+        self.tarball = os.path.join(self.model_dir, tf_operations.DATA_URL.split('/')[-1])
+        with tarfile.open(self.tarball, 'w:gz') as tar:
+            for name, data in [('graph.pb', b'graph'), ('labels.txt', b'labels')]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        self.graph_path = os.path.join(self.model_dir, 'graph.pb')
+
+    def tearDown(self):
+        shutil.rmtree(self.model_dir)
+        tf_operations.parse_args([])
+
+    def write_graph(self, data, keep_mtime = True):
+        statinfo = os.stat(self.graph_path)
+        with open(self.graph_path, 'wb') as f:
+            f.write(data)
+        if keep_mtime:
+            os.utime(self.graph_path, ns = (statinfo.st_atime_ns, statinfo.st_mtime_ns))
+
+    def read_graph(self):
+        with open(self.graph_path, 'rb') as f:
+            return f.read()
+
+    def test_extracts_and_writes_manifest(self):
+        """Check that the tarball is extracted once and recorded"""
+        self.assertFalse(tf_operations.model_files_current(self.model_dir, self.tarball))
+        tf_operations.download_and_extract_model_if_needed()
+        self.assertEqual(self.read_graph(), b'graph')
+        self.assertTrue(tf_operations.model_files_current(self.model_dir, self.tarball))
+
+    def test_unchanged_files_are_not_extracted_again(self):
+        """Check that extraction is skipped when size and time are unchanged"""
+        tf_operations.download_and_extract_model_if_needed()
+        self.write_graph(b'GRAPH')
+        tf_operations.download_and_extract_model_if_needed()
+        self.assertEqual(self.read_graph(), b'GRAPH')
+
+    def test_touched_files_are_checksummed(self):
+        """Check that a file with a new time is kept if its checksum matches"""
+        tf_operations.download_and_extract_model_if_needed()
+        os.utime(self.graph_path, (1, 1))
+        self.assertTrue(tf_operations.model_files_current(self.model_dir, self.tarball))
+        self.write_graph(b'GRAPH', keep_mtime = False)
+        self.assertFalse(tf_operations.model_files_current(self.model_dir, self.tarball))
+        tf_operations.download_and_extract_model_if_needed()
+        self.assertEqual(self.read_graph(), b'graph')
+
+    def test_missing_files_are_extracted_again(self):
+        """Check that a deleted model file is restored"""
+        tf_operations.download_and_extract_model_if_needed()
+        os.remove(self.graph_path)
+        tf_operations.download_and_extract_model_if_needed()
+        self.assertEqual(self.read_graph(), b'graph')
+
+
+class CheckImageBytesTestCase(unittest.TestCase):
+    def setUp(self):
+        tf_operations.parse_args([])
+
+    def test_accepts_image(self):
+        """Check that uploaded image data is passed on with its hash"""
+        buf = io.BytesIO()
+        Image.new('RGB', (8, 8)).save(buf, format = 'PNG')
+        (image_hash, data), ok = tf_operations.check_image_bytes(buf.getvalue())
+        self.assertTrue(ok)
+        self.assertEqual(data, buf.getvalue())
+        self.assertEqual(len(image_hash), 64)
+
+    def test_rejects_bad_data(self):
+        """Check that data which isn't an accepted image gets an error"""
+        update, ok = tf_operations.check_image_bytes(b'not an image')
+        self.assertFalse(ok)
+        self.assertEqual(update['results'], {'error': 'file cannot be opened'})
+
+    def test_rejects_large_data(self):
+        """Check that data over --max_image_bytes gets an error"""
+        tf_operations.FLAGS.max_image_bytes = 4
+        update, ok = tf_operations.check_image_bytes(b'\x89PNG\r\n\x1a\n')
+        self.assertFalse(ok)
+        self.assertEqual(update['results'], {'error': 'image too large'})
+
+
+class ModelsTestCase(unittest.TestCase):
+    def setUp(self):
+        tf_operations.parse_args(['--models', 'small=/tmp/small:fp16, big=/tmp/big'])
+        self.registry = tf_operations._registry
+        tf_operations._registry = None
+
+    def tearDown(self):
+        tf_operations._registry = self.registry
+        tf_operations.parse_args([])
+
+    def test_models_flag(self):
+        """Check that --models are served next to the default model"""
+        registry = tf_operations.get_registry()
+        self.assertEqual(registry.names(), ['big', 'default', 'small'])
+        self.assertEqual(registry.spec('small').variant, 'fp16')
+        self.assertEqual(registry.spec('big').variant, 'original')
+        self.assertRaises(ValueError, tf_operations.parse_models, 'a=/tmp/a:fp8')
+
+    def test_engines_are_not_loaded_up_front(self):
+        engine = tf_operations.get_engine('small')
+        self.assertEqual(engine.model.model_dir, '/tmp/small')
+        self.assertFalse(engine.stats()['loaded'])
+        self.assertIsNot(engine, tf_operations.get_engine())
+
+    def test_results_are_cached_per_model(self):
+        """Check that each model's results have their own cache keys"""
+        image_hash = 'ab' * 32
+        self.assertEqual(tf_operations.results_key(image_hash), image_hash)
+        keys = set(tf_operations.results_key(image_hash, model)
+                   for model in ('small', 'big'))
+        self.assertEqual(len(keys), 2)
+        self.assertNotIn(image_hash, keys)
+        self.assertRaises(tf_operations.model_registry.UnknownModel,
+                          tf_operations.results_key, image_hash, 'nope')
+
+    def test_model_keys_are_kept_until_settings_change(self):
+        """Check that a model's key is computed once, and again by parse_args"""
+        model = tf_operations.get_registry().get('small', load = False)
+        key = model.key
+        self.assertEqual(key, tf_operations.model_key(model.spec))
+        # results_key uses the key on the model, rather than computing it
+        model.key = 'kept'
+        self.assertEqual(tf_operations.results_key('ab' * 32, 'small'),
+                         tf_operations.result_cache.content_hash(
+                             ('kept:' + 'ab' * 32).encode('utf-8')))
+        tf_operations.parse_args(['--models', 'small=/tmp/small:fp16, big=/tmp/big',
+                                  '--threshold', '0.5'])
+        self.assertNotIn(model.key, ('kept', key))
+
+    def test_results_keep_the_labels_of_their_version(self):
+        """Check that results are labelled by the version which made them, after a swap"""
+        registry = tf_operations.get_registry()
+        old = registry.get('small', load = False)
+        old.labels = type('Labels', (), {'node_lookup': np.array(['', 'shoe', 'boot'])})()
+        image = type('Image', (), {'size': (32, 32), 'resized': False})()
+        top = tf_operations.postprocess.top_k(np.array([[0.1, 0.2, 0.7]]), 2)
+        update, = tf_operations._store_results([('cd' * 32, image)], [top], old)
+        # the new version's labels would be read from here
+        registry.register(tf_operations.model_registry.ModelSpec(
+            'small', '/tmp/small2', 'fp16'))
+        self.assertEqual(tf_operations.format_results(update['results']), {
+            0: {'results_name': 'boot', 'results_score': '0.7000'},
+            1: {'results_name': 'shoe', 'results_score': '0.2000'}})
+        self.assertEqual(update['results'].model, 'small')
+
+    def test_swap_model_checks_settings(self):
+        self.assertRaises(ValueError, tf_operations.swap_model, 'new')
+        self.assertRaises(ValueError, tf_operations.swap_model, 'small', variant = 'fp8')
+
+
+class WarmUpTestCase(unittest.TestCase):
+    def test_readiness_before_warm_up(self):
+        """Check that the model is not reported ready before it is loaded"""
+        status = tf_operations.readiness()
+        self.assertFalse(status['ready'])
+        self.assertIn(status['state'], ('not started', 'loading', 'failed'))
+
+    def test_tensorflow_is_not_imported_by_the_module(self):
+        """Check that TensorFlow is only imported when the model is used"""
+        self.assertIsInstance(tf_operations.tf, tf_operations.lazy_module.LazyModule)
+
+
+if __name__ == '__main__':
+        unittest.main()
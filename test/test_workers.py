@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+@purpose: run unit tests for workers.py
+"""
+
+from recognition_server import workers
+import unittest
+import multiprocessing
+import socket
+import time
+import json
+import urllib.request
+from flask import Flask, Response
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def worker_main(worker, sock):
+    """serves a small app, whose jobs belong to whichever worker the ID names"""
+    app = Flask(__name__)
+
+    @app.route('/jobs/<job_id>')
+    def get_job(job_id):
+        if worker.owner(job_id) == worker.index:
+            return json.dumps({'job': job_id, 'worker': worker.index})
+        response = workers.forward(job_id, '/jobs/' + job_id)
+        if response is None:
+            return 'not found', 404
+        with response:
+            return Response(response.read(), status = response.status)
+
+    workers.serve(app, sock, worker)
+
+
+def run_supervisor(port):
+    workers.WorkerSupervisor(2, worker_main, '127.0.0.1', port, cores = [0]).run()
+
+
+class CoreSplitTestCase(unittest.TestCase):
+    def test_split_cores(self):
+        self.assertEqual(workers.split_cores(3, list(range(8))),
+                         [[0, 1, 2], [3, 4, 5], [6, 7]])
+        self.assertEqual(workers.split_cores(3, [0, 1]), [[0], [1], [0]])
+
+    def test_thread_counts(self):
+        self.assertEqual(workers.thread_counts(8), (4, 2))
+        self.assertEqual(workers.thread_counts(2), (2, 1))
+        self.assertEqual(workers.thread_counts(8, 3, 0), (3, 2))
+
+    def test_job_owner(self):
+        worker = workers.WorkerInfo(1, [0], [0, 0, 0])
+        self.assertEqual(worker.owner(worker.job_prefix + 'abc'), 1)
+        self.assertEqual(worker.owner('w2-abc'), 2)
+        self.assertIsNone(worker.owner('w5-abc'))
+        self.assertIsNone(worker.owner('abc'))
+
+
+class SupervisorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.port = free_port()
+        self.process = multiprocessing.get_context('fork').Process(
+            target = run_supervisor, args = (self.port,))
+        self.process.start()
+
+    def tearDown(self):
+        self.process.terminate()
+        self.process.join(10)
+
+    def get(self, path):
+        url = 'http://127.0.0.1:%d%s' % (self.port, path)
+        deadline = time.time() + 10
+        while True:
+            try:
+                with urllib.request.urlopen(url, timeout = 5) as response:
+                    return json.loads(response.read().decode('utf-8'))
+            except OSError:
+                # workers still starting
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def test_jobs_reach_their_worker(self):
+        """Check a job request reaches the worker which owns it, whichever worker accepts it"""
+        for _ in range(5):
+            for index in (0, 1):
+                body = self.get('/jobs/w%d-abc' % index)
+                self.assertEqual(body['worker'], index)
+
+
+if __name__ == '__main__':
+        unittest.main()